@@ -0,0 +1,575 @@
+import glob
+import json
+import tempfile
+import time
+from argparse import ArgumentParser
+from os.path import join
+
+import numpy as np
+import torch
+from pesq import pesq
+from soundfile import info
+from torchaudio import load
+
+from flowmse.backbones.ncsnpp_utils.layerspp import AttnBlockpp
+from flowmse.data_module import spec_fwd, spec_back
+from flowmse.model import VFModel
+from flowmse.sampling import ScheduleRegistry, CUDAGraphCache, get_white_box_solver
+from flowmse.sampling.export import FixedStepSampler, trace_sampler, compile_sampler, check_parity, to_real
+from flowmse.util.inference import bucket_by_frames, enhance_batch
+from flowmse.util.streaming import StreamingEnhancer
+from flowmse.util.metrics import batch_energy_ratios, batch_si_sdr, batch_si_sdr_components, batch_snr_dB
+from flowmse.util.other import si_sdr, energy_ratios, si_sdr_components, snr_dB
+from flowmse.util.precision import AUTOCAST_DTYPES
+
+
+def cpu_memory(fn):
+    """Peak memory (MB) allocated by `fn()` on the CPU, from the profiler's memory timeline (PyTorch >= 2.1).
+    Falls back to the total memory allocated by `fn()` for older versions."""
+    timeline = hasattr(torch.profiler.profile, "export_memory_timeline")
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True, record_shapes=timeline, with_stack=timeline) as prof:
+        fn()
+    if not timeline:
+        return sum(max(e.self_cpu_memory_usage, 0) for e in prof.key_averages()) / 2**20
+    with tempfile.TemporaryDirectory() as tmp:
+        prof.export_memory_timeline(join(tmp, "timeline.json"), device="cpu")
+        with open(join(tmp, "timeline.json")) as f:
+            _, sizes = json.load(f)
+    return max(sum(s) for s in sizes) / 2**20 if sizes else 0.
+
+
+def measure(fn, device, repeats=20, memory=True):
+    """Mean runtime (ms) of `fn()` and the peak memory it allocates (MB), see `cpu_memory` for the CPU. The memory
+    is None without `memory`."""
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    runtime = (time.time() - start) / repeats * 1000
+    if not memory:
+        return runtime, None
+    if device.type == "cuda":
+        memory = (torch.cuda.max_memory_allocated() - base) / 2**20
+    else:
+        memory = cpu_memory(fn)
+    return runtime, memory
+
+
+def load_model(file, device):
+    """A `VFModel` checkpoint (.ckpt) in eval mode with the EMA weights, or an artifact of `flowmse.enhancer`."""
+    if file.endswith(".ckpt"):
+        model = VFModel.load_from_checkpoint(file, base_dir="", batch_size=8, num_workers=4, kwargs=dict(gpu=False), map_location=device)
+        model.eval(no_ema=False)
+        return model.to(device)
+    from flowmse.enhancer import load_enhancer
+    return load_enhancer(file, device)
+
+
+def load_test_set(test_dir, num_files=None):
+    """Noisy waveforms, clean signals (numpy) and lengths of the test set, or of `num_files` files spread over it."""
+    noisy_files = sorted(glob.glob(join(test_dir, "test", "noisy", "*.wav")))
+    if num_files is not None:
+        indices = np.linspace(0, len(noisy_files) - 1, num_files).round().astype(int)
+        noisy_files = [noisy_files[i] for i in indices]
+    clean_files = [join(test_dir, "test", "clean", f.split('/')[-1]) for f in noisy_files]
+    ys = [load(f)[0] for f in noisy_files]
+    xs = [load(f)[0].squeeze().numpy() for f in clean_files]
+    lengths = [info(f).frames for f in noisy_files]
+    return ys, xs, lengths
+
+
+def reference_spec_fwd(spec, transform_type, e, spec_factor):
+    # the previous implementation of SpecsDataModule.spec_fwd
+    if transform_type == "exponent":
+        if e != 1:
+            spec = spec.abs()**e * torch.exp(1j * spec.angle())
+        spec = spec * spec_factor
+    elif transform_type == "log":
+        spec = torch.log(1 + spec.abs()) * torch.exp(1j * spec.angle())
+        spec = spec * spec_factor
+    return spec
+
+
+def reference_spec_back(spec, transform_type, e, spec_factor):
+    # the previous implementation of SpecsDataModule.spec_back
+    if transform_type == "exponent":
+        spec = spec / spec_factor
+        if e != 1:
+            spec = spec.abs()**(1/e) * torch.exp(1j * spec.angle())
+    elif transform_type == "log":
+        spec = spec / spec_factor
+        spec = (torch.exp(spec.abs()) - 1) * torch.exp(1j * spec.angle())
+    return spec
+
+
+def benchmark_spec_transform(args):
+    device = torch.device(args.device)
+    spec = torch.randn(args.batch_size, 1, 256, args.num_frames, dtype=torch.complex64, device=device)
+    out = torch.empty_like(spec)
+    scripted_fwd = torch.jit.script(spec_fwd)
+    scripted_back = torch.jit.script(spec_back)
+    e, spec_factor = args.spec_abs_exponent, args.spec_factor
+
+    print(f"{'transform':<10} {'direction':<9} {'variant':<10} {'ms':>8} {'MB':>8} {'speedup':>8}")
+    for transform_type in ("exponent", "log", "none"):
+        # the inverse transformation is benchmarked on transformed spectrograms, as seen during enhancement
+        transformed = reference_spec_fwd(spec, transform_type, e, spec_factor)
+        for direction, reference, fused, scripted, x in (
+            ("fwd", reference_spec_fwd, spec_fwd, scripted_fwd, spec),
+            ("back", reference_spec_back, spec_back, scripted_back, transformed),
+        ):
+            variants = {
+                "reference": lambda: reference(x, transform_type, e, spec_factor),
+                "fused": lambda: fused(x, transform_type, e, spec_factor),
+                "fused_out": lambda: fused(x, transform_type, e, spec_factor, out=out),
+                "scripted": lambda: scripted(x, transform_type, e, spec_factor, out),
+            }
+            expected = variants["reference"]()
+            error = ((expected - variants["fused"]()).abs().max() / expected.abs().max()).item()
+            base_runtime = None
+            for name, fn in variants.items():
+                runtime, memory = measure(fn, device, args.repeats)
+                base_runtime = base_runtime or runtime
+                print(f"{transform_type:<10} {direction:<9} {name:<10} {runtime:8.3f} {memory:8.1f} {base_runtime / runtime:8.2f}")
+            print(f"{transform_type:<10} {direction:<9} max relative difference to reference: {error:.2e}")
+
+
+def benchmark_attention(args):
+    """Runtime, memory and output difference of the attention implementations of `AttnBlockpp`."""
+    device = torch.device(args.device)
+    # the attention blocks of NCSN++ run at the 16x16 resolution level, i.e. on 16 x num_frames/16 positions
+    x = torch.randn(args.batch_size, args.channels, 16, args.num_frames // 16, device=device)
+    reference = AttnBlockpp(args.channels, skip_rescale=True, init_scale=1.).to(device)
+    print(f"{'attention':<10} {'ms':>9} {'MB':>9} {'max abs diff':>13}")
+    with torch.no_grad():
+        expected = reference(x)
+        for attention_type in ("einsum", "sdpa", "chunked"):
+            block = AttnBlockpp(args.channels, skip_rescale=True, attention_type=attention_type, attention_chunk_size=args.chunk_size).to(device)
+            # the same parameters as the reference, as when loading a checkpoint
+            block.load_state_dict(reference.state_dict())
+            error = (block(x) - expected).abs().max().item()
+            runtime, memory = measure(lambda: block(x), device, args.repeats)
+            print(f"{block.attention_type:<10} {runtime:9.2f} {memory:9.1f} {error:13.2e}")
+
+
+def benchmark_solvers(args):
+    """Mean PESQ and SI-SDR versus the number of function evaluations, for every checkpoint, solver and N."""
+    ys, xs, lengths = load_test_set(args.test_dir, args.num_files)
+
+    print(f"schedule: {args.stepsize_type}")
+    print(f"{'ode':<22} {'solver':<9} {'N':>4} {'NFE':>6} {'PESQ':>6} {'SI-SDR':>7}")
+    for ckpt in args.ckpts:
+        model = VFModel.load_from_checkpoint(ckpt, base_dir="", batch_size=8, num_workers=4, kwargs=dict(gpu=False))
+        model.eval(no_ema=False)
+        model.to(args.device)
+        batches = bucket_by_frames(lengths, model.data_module.hop_length, args.batch_size)
+
+        # every solver step calls the backbone, so count its forward passes per batch
+        nfe = [0]
+        hook = model.dnn.register_forward_hook(lambda *_: nfe.__setitem__(0, nfe[0] + 1))
+        for odesolver in args.odesolvers:
+            for N in args.N:
+                _pesq, _si_sdr, _nfe = [], [], []
+                for batch in batches:
+                    nfe[0] = 0
+                    torch.manual_seed(0)
+                    x_hats, _ = enhance_batch(
+                        model, [ys[i] for i in batch], odesolver=odesolver,
+                        T_rev=model.T_rev, t_eps=model.t_eps, N=N, stepsize_type=args.stepsize_type,
+                        rho=args.rho, schedule_file=args.schedule_file
+                    )
+                    for i, x_hat in zip(batch, x_hats):
+                        x_hat = x_hat.squeeze().cpu().numpy()
+                        _pesq.append(pesq(16000, xs[i], x_hat, 'wb'))
+                        _si_sdr.append(si_sdr(xs[i], x_hat))
+                    _nfe += [nfe[0]] * len(batch)
+                print(f"{model.hparams.ode:<22} {odesolver:<9} {N:>4} {np.mean(_nfe):6.1f} {np.mean(_pesq):6.3f} {np.mean(_si_sdr):7.2f}")
+        hook.remove()
+        benchmark_adaptive(model, ys, xs, args.tolerances)
+
+
+def benchmark_adaptive(model, ys, xs, tolerances):
+    """
+    Runtime per utterance, NFE and PESQ of the adaptive 'dopri5' solver on the device versus the scipy RK45 path of
+    `get_black_box_solver` at the same tolerance, one utterance at a time from the same prior sample, and the
+    largest difference between their enhanced signals.
+    """
+    def enhance(i, odesolver_type, tolerance):
+        torch.manual_seed(i)
+        if model.device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.time()
+        (x_hat,), (nfe,) = enhance_batch(
+            model, [ys[i]], odesolver_type=odesolver_type, odesolver="dopri5", T_rev=model.T_rev, t_eps=model.t_eps,
+            rtol=tolerance, atol=tolerance
+        )
+        x_hat = x_hat.squeeze().cpu().numpy()
+        return x_hat, nfe, time.time() - start
+
+    if not tolerances:
+        return
+    print(f"{'ode':<22} {'solver':<10} {'tol':>7} {'NFE':>6} {'s/utt':>7} {'PESQ':>6} {'max abs diff':>13}")
+    for tolerance in tolerances:
+        results = {"dopri5": [], "scipy RK45": []}
+        for i in range(len(ys)):
+            reference = enhance(i, "black", tolerance)
+            x_hat = enhance(i, "adaptive", tolerance)
+            results["scipy RK45"].append((*reference, 0.))
+            results["dopri5"].append((*x_hat, np.abs(x_hat[0] - reference[0]).max()))
+        for name, rows in results.items():
+            _pesq = np.mean([pesq(16000, xs[i], row[0], 'wb') for i, row in enumerate(rows)])
+            _nfe, _time, _diff = (np.mean([row[k] for row in rows]) for k in (1, 2, 3))
+            diff = f"{max(row[3] for row in rows):13.2e}" if name == "dopri5" else f"{'':>13}"
+            print(f"{model.hparams.ode:<22} {name:<10} {tolerance:7.0e} {_nfe:6.1f} {_time:7.2f} {_pesq:6.3f} {diff}")
+
+
+def benchmark_streaming(args):
+    """Real-time factor and latency of `StreamingEnhancer`, fed with chunks of `chunk_ms` as in a live call."""
+    device = torch.device(args.device)
+    model = VFModel.load_from_checkpoint(args.ckpt, base_dir="", batch_size=8, num_workers=4, kwargs=dict(gpu=False), map_location=device)
+    model.eval(no_ema=False)
+    model.to(device)
+    sr = 16000
+    if args.wav is not None:
+        y, sr = load(args.wav)
+        y = y[0]
+    else:
+        y = 0.1 * torch.randn(int(args.duration * sr))
+
+    enhancer = StreamingEnhancer(
+        model, context_frames=args.context_frames, hop_frames=args.hop_frames, lookahead_frames=args.lookahead_frames,
+        odesolver=args.odesolver, N=args.N, stepsize_type=args.stepsize_type
+    )
+    chunk = int(args.chunk_ms * sr / 1000)
+    call_times = []
+    for start in range(0, y.numel(), chunk):
+        t0 = time.time()
+        enhancer.process(y[start:start+chunk])
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        call_times.append(time.time() - t0)
+    enhancer.flush()
+
+    call_times = np.array(call_times) * 1000
+    latency = enhancer.latency / sr * 1000
+    print(f"context {args.context_frames} / hop {args.hop_frames} / lookahead {args.lookahead_frames} frames, N={args.N}, {args.odesolver}, chunks of {args.chunk_ms} ms on {device}")
+    print(f"real-time factor:          {call_times.sum() / 1000 / (y.numel() / sr):.3f}")
+    print(f"algorithmic latency:       {latency:.1f} ms")
+    print(f"processing per chunk:      mean {call_times.mean():.1f} ms, p95 {np.percentile(call_times, 95):.1f} ms, max {call_times.max():.1f} ms")
+    # a sample waits for the rest of its chunk, the algorithmic latency and the processing of the chunk that emits it
+    print(f"end-to-end latency:        p95 {latency + args.chunk_ms + np.percentile(call_times, 95):.1f} ms, max {latency + args.chunk_ms + call_times.max():.1f} ms")
+
+
+def benchmark_export(args):
+    """Runtime of the eager sampler versus `FixedStepSampler` traced into TorchScript and compiled, with parity."""
+    device = torch.device(args.device)
+    model = load_model(args.model, device)
+    sampler = FixedStepSampler(model, args.N, args.odesolver, args.stepsize_type).eval()
+    Y = torch.randn(args.batch_size, 1, sampler.num_freqs, args.num_frames, dtype=torch.complex64, device=device)
+    x, _ = model.ode.prior_sampling(Y.shape, Y)
+
+    def eager():
+        with torch.no_grad():
+            get_white_box_solver(args.odesolver, model.ode, model, Y, T_rev=model.T_rev, t_eps=model.t_eps, N=args.N, stepsize_type=args.stepsize_type)()
+
+    graphs = {"torchscript": trace_sampler(sampler, args.batch_size, args.num_frames, device)}
+    if args.compile:
+        graphs["torch.compile"] = compile_sampler(sampler)
+    print(f"{args.odesolver}, N={args.N}, batch {args.batch_size} x {args.num_frames} frames on {device}")
+    print(f"{'sampler':<14} {'ms':>9} {'MB':>9} {'max abs diff':>13}")
+    runtime, memory = measure(eager, device, args.repeats)
+    print(f"{'eager':<14} {runtime:9.1f} {memory:9.1f} {0:13.2e}")
+    for name, graph in graphs.items():
+        run_graph = lambda x, y: graph(x, y)
+        with torch.no_grad():
+            error, _ = check_parity(run_graph, model, Y, args.N, args.odesolver, args.stepsize_type)
+            x_real, y_real = to_real(x), to_real(Y)
+            runtime, memory = measure(lambda: graph(x_real, y_real), device, args.repeats)
+        print(f"{name:<14} {runtime:9.1f} {memory:9.1f} {error:13.2e}")
+
+
+def benchmark_cuda_graphs(args):
+    """Latency of the white-box sampler with and without `CUDAGraphCache`, and the difference of the results."""
+    device = torch.device(args.device)
+    model = load_model(args.model, device)
+    cache = CUDAGraphCache(max_graphs=args.max_graphs)
+    print(f"{args.odesolver}, batch {args.batch_size} x {args.num_frames} frames on {device}")
+    print(f"{'N':>4} {'eager ms':>9} {'graph ms':>9} {'max abs diff':>13}")
+    for N in args.N:
+        Y = torch.randn(args.batch_size, 1, model.data_module.n_fft // 2 + 1, args.num_frames, dtype=torch.complex64, device=device)
+        results = {}
+
+        def sample(cuda_graphs):
+            torch.manual_seed(0)
+            return get_white_box_solver(
+                args.odesolver, model.ode, model, Y, T_rev=model.T_rev, t_eps=model.t_eps, N=N, cuda_graphs=cuda_graphs
+            )()[0]
+
+        for name, cuda_graphs in (("eager", None), ("graph", cache)):
+            results[name] = sample(cuda_graphs)
+            results[name + " ms"], _ = measure(lambda: sample(cuda_graphs), device, args.repeats)
+        error = (results["graph"] - results["eager"]).abs().max().item()
+        print(f"{N:>4} {results['eager ms']:9.2f} {results['graph ms']:9.2f} {error:13.2e}")
+    print(f"{len(cache)} graphs cached")
+
+
+def benchmark_precision(args):
+    """
+    Runtime, peak memory and deviation from float32 of the white-box sampler with the backbone under autocast, and
+    with --test_dir the mean PESQ and SI-SDR of each precision.
+    """
+    device = torch.device(args.device)
+    model = load_model(args.model, device)
+    Y = torch.randn(args.batch_size, 1, model.data_module.n_fft // 2 + 1, args.num_frames, dtype=torch.complex64, device=device)
+    if args.test_dir is not None:
+        ys, xs, lengths = load_test_set(args.test_dir, args.num_files)
+        batches = bucket_by_frames(lengths, model.data_module.hop_length, args.batch_size)
+
+    def sample():
+        torch.manual_seed(0)
+        return get_white_box_solver(args.odesolver, model.ode, model, Y, T_rev=model.T_rev, t_eps=model.t_eps, N=args.N)()[0]
+
+    print(f"{args.odesolver}, N={args.N}, batch {args.batch_size} x {args.num_frames} frames on {device}")
+    print(f"{'precision':<10} {'ms':>9} {'MB':>9} {'rel. diff':>10} {'PESQ':>6} {'SI-SDR':>7}")
+    reference = None
+    for precision in ["float32"] + args.autocast:
+        model.autocast = None if precision == "float32" else precision
+        result = sample()
+        if reference is None:
+            reference = result
+        error = ((result - reference).abs().max() / reference.abs().max()).item()
+        runtime, memory = measure(sample, device, args.repeats)
+        line = f"{precision:<10} {runtime:9.1f} {memory:9.1f} {error:10.2e}"
+        if args.test_dir is not None:
+            _pesq, _si_sdr = [], []
+            for batch in batches:
+                torch.manual_seed(0)
+                x_hats, _ = enhance_batch(model, [ys[i] for i in batch], odesolver=args.odesolver, T_rev=model.T_rev, t_eps=model.t_eps, N=args.N)
+                for i, x_hat in zip(batch, x_hats):
+                    x_hat = x_hat.squeeze().cpu().numpy()
+                    _pesq.append(pesq(16000, xs[i], x_hat, 'wb'))
+                    _si_sdr.append(si_sdr(xs[i], x_hat))
+            line += f" {np.mean(_pesq):6.3f} {np.mean(_si_sdr):7.2f}"
+        print(line)
+
+
+def benchmark_conditioning(args):
+    """
+    Runtime and peak memory of the white-box sampler with the model's plain `forward`, with its
+    `ConditionedVectorField`, and with the latter and a channels-last backbone, and the difference of the results.
+    """
+    device = torch.device(args.device)
+    model = load_model(args.model, device)
+    Y = torch.randn(args.batch_size, 1, model.data_module.n_fft // 2 + 1, args.num_frames, dtype=torch.complex64, device=device)
+    # a plain function, so the sampler cannot use `model.conditioned`
+    plain = lambda x, t, y: model(x, t, y)
+
+    def sample(VF_fn):
+        torch.manual_seed(0)
+        return get_white_box_solver(args.odesolver, model.ode, VF_fn, Y, T_rev=model.T_rev, t_eps=model.t_eps, N=args.N)()[0]
+
+    print(f"{args.odesolver}, N={args.N}, batch {args.batch_size} x {args.num_frames} frames on {device}")
+    print(f"{'forward':<26} {'ms':>9} {'MB':>9} {'max abs diff':>13}")
+    reference = sample(plain)
+    for name, VF_fn, memory_format in (
+        ("plain", plain, torch.contiguous_format), ("conditioned", model, torch.contiguous_format),
+        ("conditioned, channels-last", model, torch.channels_last)
+    ):
+        model.dnn.to(memory_format=memory_format)
+        error = (sample(VF_fn) - reference).abs().max().item()
+        runtime, memory = measure(lambda: sample(VF_fn), device, args.repeats)
+        print(f"{name:<26} {runtime:9.1f} {memory:9.1f} {error:13.2e}")
+
+
+def check_metrics(device, batch_size=5, num_samples=8000):
+    """
+    Assert that the batched torch metrics of `flowmse.util.metrics` in float64 equal the numpy metrics of
+    `flowmse.util.other` of each signal cut to its length, for signals of different lengths with large values beyond
+    the length.
+    """
+    generator = torch.Generator().manual_seed(1)
+    lengths = torch.randint(num_samples // 4, num_samples + 1, (batch_size,), generator=generator)
+    lengths[0] = num_samples
+    s = torch.randn(batch_size, num_samples, generator=generator, dtype=torch.float64)
+    n = 0.5 * torch.randn(batch_size, num_samples, generator=generator, dtype=torch.float64)
+    s_hat = s + 0.3 * n + 0.1 * torch.randn(batch_size, num_samples, generator=generator, dtype=torch.float64)
+    padding = torch.arange(num_samples) >= lengths[:, None]
+    s_hat[padding], s[padding], n[padding] = 1e3, -1e3, 1e3
+
+    components = [x.cpu().numpy() for x in batch_si_sdr_components(*(x.to(device) for x in (s_hat, s, n)), lengths.to(device))]
+    ratios = torch.stack(batch_energy_ratios(*(x.to(device) for x in (s_hat, s, n)), lengths.to(device)), 1).cpu().numpy()
+    sdrs = batch_si_sdr(s.to(device), s_hat.to(device), lengths.to(device)).cpu().numpy()
+    snrs = batch_snr_dB(s.to(device), n.to(device), lengths.to(device)).cpu().numpy()
+    for i, length in enumerate(lengths.tolist()):
+        _s_hat, _s, _n = (x[i, :length].numpy() for x in (s_hat, s, n))
+        for component, reference in zip(components, si_sdr_components(_s_hat, _s, _n)):
+            np.testing.assert_allclose(component[i, :length], reference, rtol=1e-9, atol=1e-12)
+            np.testing.assert_array_equal(component[i, length:], 0)
+        np.testing.assert_allclose(ratios[i], energy_ratios(_s_hat, _s, _n), rtol=1e-9)
+        np.testing.assert_allclose(sdrs[i], si_sdr(_s, _s_hat), rtol=1e-9)
+        np.testing.assert_allclose(snrs[i], snr_dB(_s, _n), rtol=1e-9)
+
+
+def benchmark_metrics(args):
+    """
+    Runtime of SI-SDR/SIR/SAR for a batch of signals with the numpy functions of `flowmse.util.other`, one signal at
+    a time after copying it to the host, and with the batched torch functions of `flowmse.util.metrics` on the
+    device. The largest difference to the numpy results is given for the torch functions in float64 and float32.
+    """
+    device = torch.device(args.device)
+    check_metrics(device)
+    print(f"The float64 torch metrics on {device} equal the numpy metrics")
+    if args.check_only:
+        return
+    generator = torch.Generator().manual_seed(0)
+    num_samples = int(args.duration * 16000)
+    print(f"{'batch':>5} {'numpy ms':>9} {'torch ms':>9} {'speedup':>8} {'diff float64':>13} {'diff float32':>13}")
+    for batch_size in args.batch_size:
+        # zero-padded signals of random lengths, with noise beyond the length that must be ignored
+        lengths = torch.randint(num_samples // 2, num_samples + 1, (batch_size,), generator=generator)
+        lengths[0] = num_samples
+        s = torch.randn(batch_size, num_samples, generator=generator, dtype=torch.float64)
+        n = 0.5 * torch.randn(batch_size, num_samples, generator=generator, dtype=torch.float64)
+        s_hat = s + 0.3 * n + 0.1 * torch.randn(batch_size, num_samples, generator=generator, dtype=torch.float64)
+        s, n, s_hat = s.to(device), n.to(device), s_hat.to(device)
+        lengths = lengths.to(device)
+
+        def numpy_metrics(s_hat=s_hat.float(), s=s.float(), n=n.float()):
+            values = []
+            for i, length in enumerate(lengths.tolist()):
+                _s_hat, _s, _n = (x[i, :length].cpu().numpy().astype(np.float64) for x in (s_hat, s, n))
+                values.append((*energy_ratios(_s_hat, _s, _n), si_sdr(_s, _s_hat)))
+            return np.array(values)
+
+        def torch_metrics(s_hat=s_hat.float(), s=s.float(), n=n.float()):
+            return torch.stack((*batch_energy_ratios(s_hat, s, n, lengths), batch_si_sdr(s, s_hat, lengths)), 1)
+
+        reference = numpy_metrics(s_hat, s, n)
+        error64 = np.abs(torch_metrics(s_hat, s, n).cpu().numpy() - reference).max()
+        error32 = np.abs(torch_metrics().cpu().numpy() - reference).max()
+        numpy_runtime, _ = measure(numpy_metrics, device, args.repeats, memory=False)
+        torch_runtime, _ = measure(lambda: torch_metrics().cpu(), device, args.repeats, memory=False)
+        print(f"{batch_size:>5} {numpy_runtime:9.2f} {torch_runtime:9.2f} {numpy_runtime / torch_runtime:8.1f} {error64:13.2e} {error32:13.2e}")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    spec_parser = subparsers.add_parser("spec_transform", help="Compare the spectrogram transformations with the previous implementation.")
+    spec_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    spec_parser.add_argument("--batch_size", type=int, default=8)
+    spec_parser.add_argument("--num_frames", type=int, default=256)
+    spec_parser.add_argument("--spec_abs_exponent", type=float, default=0.5)
+    spec_parser.add_argument("--spec_factor", type=float, default=0.15)
+    spec_parser.add_argument("--repeats", type=int, default=20)
+
+    attention_parser = subparsers.add_parser("attention", help="Compare the attention implementations of AttnBlockpp.")
+    attention_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    attention_parser.add_argument("--batch_size", type=int, default=1)
+    attention_parser.add_argument("--channels", type=int, default=256)
+    attention_parser.add_argument("--num_frames", type=int, default=1024, help="Number of STFT frames of the spectrogram.")
+    attention_parser.add_argument("--chunk_size", type=int, default=1024)
+    attention_parser.add_argument("--repeats", type=int, default=5)
+
+    solver_parser = subparsers.add_parser("solvers", help="Compare PESQ and SI-SDR of the ODE solvers versus the number of function evaluations.")
+    solver_parser.add_argument("--ckpts", type=str, nargs="+", required=True, help="Model checkpoints, e.g. one per ODE class.")
+    solver_parser.add_argument("--test_dir", type=str, required=True, help="Directory containing the test data.")
+    solver_parser.add_argument("--odesolvers", type=str, nargs="+", default=["euler", "heun", "ab2", "ab3", "ab4", "dpmpp2m"])
+    solver_parser.add_argument("--N", type=int, nargs="+", default=[2, 3, 5, 10, 20, 30], help="Numbers of reverse steps.")
+    solver_parser.add_argument("--stepsize_type", type=str, default="uniform", choices=ScheduleRegistry.get_all_names())
+    solver_parser.add_argument("--rho", type=float, default=7., help="Exponent of the 'karras' schedule.")
+    solver_parser.add_argument("--schedule_file", type=str, default=None, help="JSON file of the 'json' schedule.")
+    solver_parser.add_argument("--num_files", type=int, default=None, help="Evaluate on this many files spread over the test set instead of all.")
+    solver_parser.add_argument("--tolerances", type=float, nargs="*", default=[1e-3, 1e-4, 1e-5], help="Tolerances (rtol = atol) at which 'dopri5' is compared with the scipy RK45 path. None skips the comparison.")
+    solver_parser.add_argument("--batch_size", type=int, default=8)
+    solver_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    stream_parser = subparsers.add_parser("streaming", help="Measure real-time factor and latency of the streaming enhancer.")
+    stream_parser.add_argument("--ckpt", type=str, required=True, help="Path to model checkpoint.")
+    stream_parser.add_argument("--wav", type=str, default=None, help="Noisy input file. White noise of --duration seconds by default.")
+    stream_parser.add_argument("--duration", type=float, default=10.)
+    stream_parser.add_argument("--chunk_ms", type=float, default=10., help="Size of the chunks fed to the enhancer in ms. 10 by default.")
+    stream_parser.add_argument("--context_frames", type=int, default=64)
+    stream_parser.add_argument("--hop_frames", type=int, default=16)
+    stream_parser.add_argument("--lookahead_frames", type=int, default=0)
+    stream_parser.add_argument("--odesolver", type=str, default="euler")
+    stream_parser.add_argument("--N", type=int, default=5)
+    stream_parser.add_argument("--stepsize_type", type=str, default="gerkmann", choices=ScheduleRegistry.get_all_names())
+    stream_parser.add_argument("--device", type=str, default="cpu")
+
+    export_parser = subparsers.add_parser("export", help="Compare the eager sampler with its TorchScript and torch.compile versions.")
+    export_parser.add_argument("--model", type=str, required=True, help="Model checkpoint (.ckpt) or an artifact of `python -m flowmse.enhancer`.")
+    export_parser.add_argument("--odesolver", type=str, default="euler", choices=("euler", "midpoint", "heun"))
+    export_parser.add_argument("--N", type=int, default=5)
+    export_parser.add_argument("--stepsize_type", type=str, default="uniform", choices=ScheduleRegistry.get_all_names())
+    export_parser.add_argument("--batch_size", type=int, default=1)
+    export_parser.add_argument("--num_frames", type=int, default=256)
+    export_parser.add_argument("--compile", action="store_true", help="Also measure torch.compile (PyTorch >= 2.0).")
+    export_parser.add_argument("--repeats", type=int, default=5)
+    export_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    graphs_parser = subparsers.add_parser("cuda_graphs", help="Compare the latency of the white-box sampler with and without CUDA graphs.")
+    graphs_parser.add_argument("--model", type=str, required=True, help="Model checkpoint (.ckpt) or an artifact of `python -m flowmse.enhancer`.")
+    graphs_parser.add_argument("--odesolver", type=str, default="euler")
+    graphs_parser.add_argument("--N", type=int, nargs="+", default=[1, 2, 5, 10])
+    graphs_parser.add_argument("--batch_size", type=int, default=1)
+    graphs_parser.add_argument("--num_frames", type=int, default=256)
+    graphs_parser.add_argument("--max_graphs", type=int, default=8)
+    graphs_parser.add_argument("--repeats", type=int, default=20)
+    graphs_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    precision_parser = subparsers.add_parser("precision", help="Compare the white-box sampler in float32 and with the backbone under autocast.")
+    precision_parser.add_argument("--model", type=str, required=True, help="Model checkpoint (.ckpt) or an artifact of `python -m flowmse.enhancer`.")
+    precision_parser.add_argument("--autocast", type=str, nargs="+", default=["bfloat16"], choices=tuple(AUTOCAST_DTYPES), help="Precisions compared with float32. bfloat16 by default.")
+    precision_parser.add_argument("--odesolver", type=str, default="euler")
+    precision_parser.add_argument("--N", type=int, default=5)
+    precision_parser.add_argument("--batch_size", type=int, default=1)
+    precision_parser.add_argument("--num_frames", type=int, default=256)
+    precision_parser.add_argument("--test_dir", type=str, default=None, help="Also compare PESQ and SI-SDR on this test set.")
+    precision_parser.add_argument("--num_files", type=int, default=None, help="Evaluate on this many files spread over the test set instead of all.")
+    precision_parser.add_argument("--repeats", type=int, default=5)
+    precision_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    conditioning_parser = subparsers.add_parser("conditioning", help="Compare the white-box sampler with and without the prepared conditioning buffer and a channels-last backbone.")
+    conditioning_parser.add_argument("--model", type=str, required=True, help="Model checkpoint (.ckpt) or an artifact of `python -m flowmse.enhancer`.")
+    conditioning_parser.add_argument("--odesolver", type=str, default="euler")
+    conditioning_parser.add_argument("--N", type=int, default=5)
+    conditioning_parser.add_argument("--batch_size", type=int, default=1)
+    conditioning_parser.add_argument("--num_frames", type=int, default=256)
+    conditioning_parser.add_argument("--repeats", type=int, default=5)
+    conditioning_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    metrics_parser = subparsers.add_parser("metrics", help="Compare the numpy SI-SDR/SIR/SAR with the batched torch implementation.")
+    metrics_parser.add_argument("--batch_size", type=int, nargs="+", default=[1, 4, 16, 64])
+    metrics_parser.add_argument("--duration", type=float, default=4., help="Length of the longest signal in seconds at 16 kHz.")
+    metrics_parser.add_argument("--repeats", type=int, default=10)
+    metrics_parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    metrics_parser.add_argument("--check_only", action="store_true", help="Only check that the torch metrics equal the numpy metrics, e.g. on the CPU.")
+
+    args = parser.parse_args()
+
+    if args.command == "spec_transform":
+        benchmark_spec_transform(args)
+    elif args.command == "attention":
+        benchmark_attention(args)
+    elif args.command == "solvers":
+        benchmark_solvers(args)
+    elif args.command == "streaming":
+        benchmark_streaming(args)
+    elif args.command == "export":
+        benchmark_export(args)
+    elif args.command == "cuda_graphs":
+        benchmark_cuda_graphs(args)
+    elif args.command == "precision":
+        benchmark_precision(args)
+    elif args.command == "conditioning":
+        benchmark_conditioning(args)
+    elif args.command == "metrics":
+        benchmark_metrics(args)
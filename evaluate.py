@@ -1,56 +1,178 @@
 import time
-import numpy as np
 import glob
-from soundfile import read, write
+import hashlib
+import json
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from soundfile import write, info
 from tqdm import tqdm
-from pesq import pesq
-from pystoi import stoi
 from torchaudio import load
 import torch
 from argparse import ArgumentParser
 from os.path import join
 import pandas as pd
 
-from flowmse.data_module import SpecsDataModule
-from flowmse.odes import OTFLOW
-from flowmse.model import VFModel
-import pdb
+from flowmse.enhancer import load_enhancer
 import os
-from flowmse.util.other import pad_spec
-from flowmse.sampling import get_white_box_solver, get_black_box_solver
+from flowmse.util.inference import bucket_by_frames, enhance_batch, enhance_long, file_metrics
+from flowmse.sampling import ScheduleRegistry, CUDAGraphCache
 
-# GPU 2번과 3번만 사용하도록 설정
-os.environ["CUDA_VISIBLE_DEVICES"] = "2,3"
 
+from utils import ensure_dir, print_mean_std
 
-from utils import energy_ratios, ensure_dir, print_mean_std
 
-import pdb
+def write_outputs(output_queue, records_file, errors, fingerprint):
+    """
+    Write the enhanced wav files and the result records put on `output_queue` until it yields None.
+
+    The items are (wav file, signal, row), with the row of the results or a future of it. The record of a file is
+    appended to `records_file` after its wav file is written, so that files with a record are complete, with the
+    `fingerprint` of the settings that produced it. Errors of the metrics or of writing a wav file are collected in
+    `errors`, and their files get no record. An error of the records file is collected too, and stops the thread.
+    """
+    try:
+        with open(records_file, 'a+') as records:
+            # end a line cut off by a crash, so the next record starts on a new one
+            if records.tell() > 0:
+                records.seek(records.tell() - 1)
+                if records.read(1) != "\n":
+                    records.write("\n")
+            while True:
+                item = output_queue.get()
+                if item is None:
+                    return
+                wav_file, x_hat, row = item
+                try:
+                    write(wav_file, x_hat, 16000)
+                    row = row.result() if isinstance(row, Future) else row
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                records.write(json.dumps({**row, "settings": fingerprint}) + "\n")
+                records.flush()
+    except Exception as e:
+        errors.append(e)
+
+
+def put_output(output_queue, item, writer, errors):
+    """Put `item` on the queue of the `writer` thread of `write_outputs`, failing instead of waiting for a full
+    queue if the writer has stopped."""
+    while True:
+        if not writer.is_alive():
+            raise RuntimeError("Writing the outputs stopped") from (errors[0] if errors else None)
+        try:
+            output_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def settings_fingerprint(settings):
+    """A short hash of the settings that determine the results, see `check_settings`."""
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def check_settings(target_dir, settings):
+    """
+    Refuse to resume or add a shard to the run in `target_dir` if its records were written with other `settings`.
+    The settings of the run are kept in `_settings.json`, and every record has their fingerprint. Returns it.
+    """
+    fingerprint = settings_fingerprint(settings)
+    settings_file = join(target_dir, "_settings.json")
+    previous = None
+    fingerprints = {row.get("settings") for row in read_records(target_dir).values()}
+    if os.path.exists(settings_file):
+        with open(settings_file) as file:
+            previous = json.load(file)
+        fingerprints.add(settings_fingerprint(previous))
+    if fingerprints - {fingerprint}:
+        if previous is None:
+            differences = "records without settings"
+        else:
+            differences = ", ".join("{}: {} != {}".format(key, previous.get(key), settings.get(key))
+                                    for key in sorted(set(previous) | set(settings)) if previous.get(key) != settings.get(key))
+        raise ValueError("{} has results of other settings ({}), choose another --folder_destination".format(target_dir, differences))
+    if previous is None:
+        with open(settings_file, 'w') as file:
+            json.dump(settings, file, indent=2, sort_keys=True)
+    return fingerprint
+
+
+def read_records(target_dir):
+    """The result rows of all runs and shards in `target_dir`, by file name. A line cut off by a crash is skipped."""
+    rows = {}
+    for records_file in sorted(glob.glob(join(target_dir, "_records*.jsonl"))):
+        with open(records_file) as records:
+            for line in records:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                rows[row["filename"]] = row
+    return rows
+
+
+def merge_results(target_dir):
+    """Merge the records of all shards in `target_dir` into `_results.csv` and the summary `_avg_results.txt`."""
+    rows = list(read_records(target_dir).values())
+    if len({row.get("settings") for row in rows}) > 1:
+        raise ValueError("The records in {} were written with different settings, see the 'settings' fingerprint of each record".format(target_dir))
+    df = pd.DataFrame(rows, columns=["filename", "pesq", "estoi", "si_sdr", "si_sir", "si_sar", "nfe"])
+    df = df.sort_values("filename")
+    df.to_csv(join(target_dir, "_results.csv"), index=False)
+
+    # Save average results
+    text_file = join(target_dir, "_avg_results.txt")
+    with open(text_file, 'w') as file:
+        file.write("PESQ: {} \n".format(print_mean_std(df["pesq"])))
+        file.write("ESTOI: {} \n".format(print_mean_std(df["estoi"])))
+        file.write("SI-SDR: {} \n".format(print_mean_std(df["si_sdr"])))
+        file.write("SI-SIR: {} \n".format(print_mean_std(df["si_sir"])))
+        file.write("SI-SAR: {} \n".format(print_mean_std(df["si_sar"])))
+        file.write("NFE: {} \n".format(print_mean_std(df["nfe"])))
+    return df
+
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("--atol", type=float, default=1e-5, help="Absolute tolerance for the ODE sampler")
     parser.add_argument("--rtol", type=float, default=1e-5, help="Relative tolerance for the ODE sampler")
-    parser.add_argument("--test_dir", type=str, required=True, help='Directory containing the test data')
-    parser.add_argument("--odesolver_type", type=str, choices=("white", "black"), default="white",
+    parser.add_argument("--test_dir", type=str, help='Directory containing the test data')
+    parser.add_argument("--odesolver_type", type=str, choices=("white", "black", "adaptive"), default="white",
                         help="Specify the sampler type")
     parser.add_argument("--odesolver", type=str,
-                        default="euler", help="Predictor class for the PC sampler.")
+                        default=None, help="Predictor class for the PC sampler. 'euler' by default, 'dopri5' for the adaptive sampler.")
+    parser.add_argument("--max_nfe", type=int, default=1000, help="Maximum number of function evaluations per utterance for the adaptive sampler")
     parser.add_argument("--reverse_starting_point", type=float, default=None, help="Starting point for the reverse SDE.")
     parser.add_argument("--reverse_end_point", type=float, default=None)
     
     
     parser.add_argument("--folder_destination", type=str, help="Name of destination folder.")    
-    parser.add_argument("--ckpt", type=str, help='Path to model checkpoint.')
+    parser.add_argument("--ckpt", type=str, help='Path to model checkpoint, or to an inference artifact written by `python -m flowmse.enhancer`.')
     parser.add_argument("--N", type=int, default=30, help="Number of reverse steps")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of utterances enhanced together. Utterances are grouped by padded frame count.")
+    parser.add_argument("--window_frames", type=int, default=None, help="Enhance each file in overlapping windows of this many frames (a multiple of 64), batch_size windows at a time. Keeps memory constant for long recordings.")
+    parser.add_argument("--window_overlap", type=int, default=64, help="Frames shared by neighbouring windows with --window_frames. 64 by default.")
     
-    parser.add_argument("--stepsize_type", type=str, default="uniform", choices=("gerkmann, uniform"))
+    parser.add_argument("--stepsize_type", type=str, default="uniform", choices=ScheduleRegistry.get_all_names(), help="Timestep schedule of the white-box sampler.")
+    parser.add_argument("--rho", type=float, default=7., help="Exponent of the 'karras' schedule. 7 by default.")
+    parser.add_argument("--schedule_file", type=str, default=None, help="JSON file of the 'json' schedule, see `preprocess.py schedule`.")
+    parser.add_argument("--cuda_graphs", type=int, default=0, help="Replay the white-box sampler from CUDA graphs, keeping up to this many (one per batch shape). 0 (off) by default.")
+    parser.add_argument("--metric_workers", type=int, default=4, help="Number of processes computing the metrics while the next batches are enhanced. 0 computes them in the enhancement loop. 4 by default.")
+    parser.add_argument("--shard_index", type=int, default=0, help="Enhance only the files of this shard, in 0, ..., num_shards - 1.")
+    parser.add_argument("--num_shards", type=int, default=1, help="Split the test set into this many shards, e.g. one per GPU or host writing to the same destination folder. 1 by default.")
+    parser.add_argument("--merge", action="store_true", help="Only merge the records of all shards in the destination folder into _results.csv and _avg_results.txt.")
+    parser.add_argument("--channels_last", action="store_true", help="Keep the backbone weights in channels-last memory format, which is faster with NCSNpp on the CPU.")
+    parser.add_argument("--autocast", type=str, choices=("float32", "bfloat16", "float16"), default=None, help="Precision of the backbone: 'float32', or mixed precision in 'bfloat16' or 'float16'. The setting of the model by default.")
     
 
     args = parser.parse_args()
-
-    clean_dir = join(args.test_dir, "test", "clean")
-    noisy_dir = join(args.test_dir, "test", "noisy")
+    if args.test_dir is None and not args.merge:
+        parser.error("--test_dir is required")
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error("--shard_index must be in 0, ..., num_shards - 1")
 
     checkpoint_file = args.ckpt
     
@@ -63,11 +185,20 @@ if __name__ == '__main__':
     #"/export/home/lay/PycharmProjects/ncsnpp/enhanced/{}/".format(args.destination_folder)
 
     ensure_dir(target_dir + "files/")
+    if args.merge:
+        df = merge_results(target_dir)
+        print("Merged the results of {} files into {}".format(len(df), target_dir))
+        raise SystemExit
+
+    clean_dir = join(args.test_dir, "test", "clean")
+    noisy_dir = join(args.test_dir, "test", "noisy")
 
     # Settings
     sr = 16000
     odesolver_type = args.odesolver_type
     odesolver = args.odesolver
+    if odesolver is None:
+        odesolver = "dopri5" if odesolver_type == "adaptive" else "euler"
     N = args.N
     
     stepsize_type = args.stepsize_type
@@ -78,10 +209,20 @@ if __name__ == '__main__':
 
 
     # Load score model
-    model = VFModel.load_from_checkpoint(
-        checkpoint_file, base_dir="",
-        batch_size=8, num_workers=4, kwargs=dict(gpu=False)
-    )
+    if checkpoint_file.endswith(".ckpt"):
+        from flowmse.model import VFModel
+        model = VFModel.load_from_checkpoint(
+            checkpoint_file, base_dir="",
+            batch_size=8, num_workers=4, kwargs=dict(gpu=False)
+        )
+        model.eval(no_ema=False)
+    else:
+        # exported backbone with the EMA weights, see flowmse/enhancer.py
+        model = load_enhancer(checkpoint_file)
+    if args.channels_last:
+        model.dnn.to(memory_format=torch.channels_last)
+    if args.autocast is not None:
+        model.autocast = None if args.autocast == "float32" else args.autocast
     
     if args.reverse_starting_point == None:
         reverse_starting_point = model.T_rev
@@ -98,103 +239,140 @@ if __name__ == '__main__':
         
     # print(reverse_starting_point)
     # print(reverse_end_point)
-    model.eval(no_ema=False)
     model.cuda()
 
+    if odesolver_type == "white":
+        sampler_kwargs = dict(T_rev=reverse_starting_point, t_eps=reverse_end_point, N=N, stepsize_type=stepsize_type,
+                              rho=args.rho, schedule_file=args.schedule_file,
+                              cuda_graphs=CUDAGraphCache(args.cuda_graphs) if args.cuda_graphs > 0 else None)
+    elif odesolver_type == "adaptive":
+        sampler_kwargs = dict(T_rev=reverse_starting_point, t_eps=reverse_end_point, rtol=rtol, atol=atol, max_nfe=args.max_nfe)
+    else:
+        sampler_kwargs = dict(rtol=1e-5, atol=1e-5, T_rev=reverse_starting_point, t_eps=0.03, N=30, method='RK45')
+
+    # The settings that determine the results, the records of a run and of all its shards must share them
+    settings = dict(checkpoint=checkpoint_file, odesolver_type=odesolver_type, odesolver=odesolver, autocast=model.autocast,
+                    window_frames=args.window_frames, window_overlap=args.window_overlap if args.window_frames is not None else None,
+                    **{key: value for key, value in sampler_kwargs.items() if key != "cuda_graphs"})
+    if odesolver_type == "white":
+        if stepsize_type != "karras":
+            del settings["rho"]
+        if stepsize_type != "json":
+            del settings["schedule_file"]
+    fingerprint = check_settings(target_dir, settings)
+
     noisy_files = sorted(glob.glob('{}/*.wav'.format(noisy_dir)))
+    all_filenames = [noisy_file.split('/')[-1] for noisy_file in noisy_files]
+    # Every file that has a record from an earlier run, of any shard, is done
+    done = read_records(target_dir)
+    noisy_files = [noisy_file for noisy_file in noisy_files[args.shard_index::args.num_shards] if noisy_file.split('/')[-1] not in done]
+    print("{} files to enhance in shard {} of {}, {} files of the test set are done".format(
+        len(noisy_files), args.shard_index, args.num_shards, len(done)))
     
 
 
 
 
-    data = {"filename": [], "pesq": [], "estoi": [], "si_sdr": [], "si_sir": [], "si_sar": []}
-    for cnt, noisy_file in tqdm(enumerate(noisy_files)):
-        filename = noisy_file.split('/')[-1]
-        
-        # Load wav
-        x, _ = load(join(clean_dir, filename))
-        y, _ = load(noisy_file)
+    lengths = [info(noisy_file).frames for noisy_file in noisy_files]
+    if args.window_frames is None:
+        batches = bucket_by_frames(lengths, model.data_module.hop_length, args.batch_size)
+    else:
+        # the windows of one file are batched instead
+        batches = [[i] for i in range(len(noisy_files))]
 
-        #pdb.set_trace()        
+    # The enhancement loop only hands its results on: the metrics are computed by a process pool, and the wav files
+    # and the records of the results are written by a thread, in order. At most `max_pending` files are waiting.
+    metric_pool = None
+    if args.metric_workers > 0:
+        # spawned, forking a process that uses CUDA is not safe
+        metric_pool = ProcessPoolExecutor(args.metric_workers, mp_context=multiprocessing.get_context("spawn"))
+    max_pending = 4 * max(args.metric_workers, 1) + args.batch_size
+    output_queue = queue.Queue(maxsize=max_pending)
+    errors = []
+    records_file = join(target_dir, "_records_{}of{}.jsonl".format(args.shard_index, args.num_shards))
+    writer = threading.Thread(target=write_outputs, args=(output_queue, records_file, errors, fingerprint), daemon=True)
+    writer.start()
 
-         
-        start = time.time()
-        T_orig = y.size(1) 
-        norm_factor = y.abs().max().item()
-        y = y / norm_factor
+    start_total = time.time()
+    enhancement_time = 0.
+    for batch in tqdm(batches):
+        batch_files = [noisy_files[i] for i in batch]
 
-        
-        Y = torch.unsqueeze(model._forward_transform(model._stft(y.cuda())), 0)
-        Y = pad_spec(Y)
-        
-        
-        if odesolver_type == "white":
-            sampler = get_white_box_solver(odesolver, model.ode, model, Y.cuda(), T_rev=reverse_starting_point, t_eps=reverse_end_point,N=N,stepsize_type=stepsize_type)
-        elif odesolver_type == "black":
-            sampler = get_black_box_solver(model.ode, model, Y.cuda(),  rtol=1e-5, atol=1e-5,  T_rev=reverse_starting_point, t_eps=0.03, N=30,  method='RK45', device='cuda')
-        
-        else:
-            print("{} is not a valid sampler type!".format(odesolver_type))
-        sample, nfe = sampler()
-        
-        
-        sample = sample.squeeze()
+        # Load wavs
+        ys = [load(noisy_file)[0] for noisy_file in batch_files]
 
-        
-        x_hat = model.to_audio(sample, T_orig)
-        
-        y = y * norm_factor
-        x_hat = x_hat * norm_factor
-        x_hat = x_hat.squeeze().cpu().numpy()
-        end = time.time()
-        
-        
-        # x_hat = model.enhance(y, sampler_type=sampler_type, predictor=predictor, 
-        #         corrector=corrector, corrector_steps=corrector_steps, N=N, snr=snr,
-        #         atol=atol, rtol=rtol, timestep_type=timestep_type, correct_stepsize=correct_stepsize)
+        start = time.time()
+        if args.window_frames is None:
+            x_hats, nfes = enhance_batch(model, ys, odesolver_type=odesolver_type, odesolver=odesolver, **sampler_kwargs)
+        else:
+            x_hat, nfe = enhance_long(
+                model, ys[0], window_frames=args.window_frames, overlap_frames=args.window_overlap, batch_size=args.batch_size,
+                odesolver_type=odesolver_type, odesolver=odesolver, **sampler_kwargs
+            )
+            x_hats, nfes = [x_hat], [nfe]
+        x_hats = [x_hat.squeeze().cpu().numpy() for x_hat in x_hats]
+        enhancement_time += time.time() - start
 
+        for noisy_file, y, x_hat, nfe in zip(batch_files, ys, x_hats, nfes):
+            filename = noisy_file.split('/')[-1]
+            y = y.squeeze().cpu().numpy()
 
-        # Convert to numpy
-        x = x.squeeze().cpu().numpy()
-        y = y.squeeze().cpu().numpy()
-        n = y - x
+            # Write enhanced wav file and the results, the metrics are completed by the pool
+            if metric_pool is None:
+                row = file_metrics(filename, join(clean_dir, filename), x_hat, y, nfe, sr)
+            else:
+                row = metric_pool.submit(file_metrics, filename, join(clean_dir, filename), x_hat, y, nfe, sr)
+            put_output(output_queue, (target_dir + "files/" + filename, x_hat, row), writer, errors)
 
-        # Write enhanced wav file
-        write(target_dir + "files/" + filename, x_hat, 16000)
+    put_output(output_queue, None, writer, errors)
+    writer.join()
+    if metric_pool is not None:
+        metric_pool.shutdown()
+    total_time = time.time() - start_total
+    if errors:
+        raise RuntimeError("Computing the metrics or writing the outputs failed for {} files, rerun to enhance them again".format(len(errors))) from errors[0]
 
-        # Append metrics to data frame
-        data["filename"].append(filename)
-        try:
-            p = pesq(sr, x, x_hat, 'wb')
-        except: 
-            p = float("nan")
-        data["pesq"].append(p)
-        data["estoi"].append(stoi(x, x_hat, sr, extended=True))
-        data["si_sdr"].append(energy_ratios(x_hat, x, n)[0])
-        data["si_sir"].append(energy_ratios(x_hat, x, n)[1])
-        data["si_sar"].append(energy_ratios(x_hat, x, n)[2])
-
-    # Save results as DataFrame
-    df = pd.DataFrame(data)
-    df.to_csv(join(target_dir, "_results.csv"), index=False)
+    if noisy_files:
+        throughput = len(noisy_files) / enhancement_time
+        print("Enhancement throughput: {:.2f} utterances/sec (batch size {})".format(throughput, args.batch_size))
+        print("Total time: {:.1f} s, of which enhancement {:.1f} s".format(total_time, enhancement_time))
 
-    # Save average results
-    text_file = join(target_dir, "_avg_results.txt")
-    with open(text_file, 'w') as file:
-        file.write("PESQ: {} \n".format(print_mean_std(data["pesq"])))
-        file.write("ESTOI: {} \n".format(print_mean_std(data["estoi"])))
-        file.write("SI-SDR: {} \n".format(print_mean_std(data["si_sdr"])))
-        file.write("SI-SIR: {} \n".format(print_mean_std(data["si_sir"])))
-        file.write("SI-SAR: {} \n".format(print_mean_std(data["si_sar"])))
+    # Merge the results once all shards are done, otherwise the last shard to finish does it (or --merge)
+    if set(all_filenames) <= set(read_records(target_dir)):
+        merge_results(target_dir)
+    else:
+        print("Shard {} of {} is done, the results are merged when all shards are".format(args.shard_index, args.num_shards))
 
     # Save settings
-    text_file = join(target_dir, "_settings.txt")
+    text_file = join(target_dir, "_settings.txt" if args.num_shards == 1 else "_settings_{}of{}.txt".format(args.shard_index, args.num_shards))
     with open(text_file, 'w') as file:
         file.write("checkpoint file: {}\n".format(checkpoint_file))
         file.write("odesolver_type: {}\n".format(odesolver_type))
         file.write("odesolver: {}\n".format(odesolver))
         
         file.write("N: {}\n".format(N))
+        if odesolver_type == "white":
+            file.write("stepsize_type: {}\n".format(stepsize_type))
+            if stepsize_type == "karras":
+                file.write("rho: {}\n".format(args.rho))
+            if stepsize_type == "json":
+                file.write("schedule file: {}\n".format(args.schedule_file))
+        file.write("batch size: {}\n".format(args.batch_size))
+        if model.autocast is not None:
+            file.write("autocast: {}\n".format(model.autocast))
+        if args.channels_last:
+            file.write("channels last: True\n")
+        if odesolver_type == "white" and args.cuda_graphs > 0:
+            file.write("CUDA graphs: {}\n".format(args.cuda_graphs))
+        if args.window_frames is not None:
+            file.write("window frames: {}\n".format(args.window_frames))
+            file.write("window overlap: {}\n".format(args.window_overlap))
+        if noisy_files:
+            file.write("throughput (utterances/sec): {:.2f}\n".format(throughput))
+            file.write("enhancement time (s): {:.1f}, total time (s): {:.1f}\n".format(enhancement_time, total_time))
+        if args.num_shards > 1:
+            file.write("shard: {} of {}\n".format(args.shard_index, args.num_shards))
+        file.write("metric workers: {}\n".format(args.metric_workers))
         
         file.write("Reverse starting point: {}\n".format(reverse_starting_point))
         file.write("Reverse end point: {}\n".format(reverse_end_point))
@@ -202,6 +380,8 @@ if __name__ == '__main__':
         file.write("data: {}\n".format(args.test_dir))
         
         
-        if odesolver_type == "black":
+        if odesolver_type in ("black", "adaptive"):
             file.write("atol: {}\n".format(atol))
             file.write("rtol: {}\n".format(rtol))
+        if odesolver_type == "adaptive":
+            file.write("max NFE: {}\n".format(args.max_nfe))
@@ -1,5 +1,18 @@
+import importlib
+
 from .shared import BackboneRegistry
-from .ncsnpp import NCSNpp
-from .dcunet import DCUNet
+
+# the architectures are imported on first use, see `Registry.register_lazy`
+BackboneRegistry.register_lazy("ncsnpp", "flowmse.backbones.ncsnpp")
+BackboneRegistry.register_lazy("dcunet", "flowmse.backbones.dcunet")
+
+_lazy_classes = {'NCSNpp': '.ncsnpp', 'DCUNet': '.dcunet'}
+
+
+def __getattr__(name):
+    if name in _lazy_classes:
+        return getattr(importlib.import_module(_lazy_classes[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 __all__ = ['BackboneRegistry', 'NCSNpp', 'DCUNet']
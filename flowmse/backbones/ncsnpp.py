@@ -40,6 +40,8 @@ class NCSNpp(nn.Module):
     @staticmethod
     def add_argparse_args(parser):
         # TODO: add additional arguments of constructor, if you wish to modify them.
+        parser.add_argument("--attention_type", type=str, choices=("einsum", "sdpa", "chunked"), default="einsum", help="Implementation of the attention blocks. 'sdpa' and 'chunked' avoid materializing the full attention matrix. 'einsum' by default.")
+        parser.add_argument("--attention_chunk_size", type=int, default=1024, help="Query/key tile size of the 'chunked' attention. 1024 by default.")
         return parser
 
     def __init__(self,
@@ -63,6 +65,8 @@ class NCSNpp(nn.Module):
         image_size = 256,
         embedding_type = 'fourier',
         dropout = .0,
+        attention_type = 'einsum',
+        attention_chunk_size = 1024,
         **unused_kwargs
     ):
         super().__init__()
@@ -118,7 +122,8 @@ class NCSNpp(nn.Module):
             nn.init.zeros_(modules[-1].bias)
 
         AttnBlock = functools.partial(layerspp.AttnBlockpp,
-            init_scale=init_scale, skip_rescale=skip_rescale)
+            init_scale=init_scale, skip_rescale=skip_rescale,
+            attention_type=attention_type, attention_chunk_size=attention_chunk_size)
 
         Upsample = functools.partial(layerspp.Upsample,
             with_conv=resamp_with_conv, fir=fir, fir_kernel=fir_kernel)
@@ -245,14 +250,30 @@ class NCSNpp(nn.Module):
         self.all_modules = nn.ModuleList(modules)
 
     def forward(self, x, time_cond):
+        # `x` may also be given as the four real channels already, see `ConditionedVectorField`
+        if x.is_complex():
+            # Convert real and imaginary parts of (x,y) into four channel dimensions
+            x = torch.cat((x[:,[0],:,:].real, x[:,[0],:,:].imag,
+                    x[:,[1],:,:].real, x[:,[1],:,:].imag), dim=1)
+
+        h = self.forward_real(x, time_cond)
+
+        # Convert back to complex number, in the input precision also when the layers ran under autocast.
+        # Does not copy if h is channels-last.
+        h = torch.permute(h.to(x.dtype), (0, 2, 3, 1)).contiguous()
+        h = torch.view_as_complex(h)[:,None, :, :]
+        return h
+
+    def forward_real(self, x, time_cond):
+        """
+        The network on real tensors: `x` holds the real and imaginary parts of the state and of y as four
+        channels, and the output the real and imaginary part of the result as two channels. Used where complex
+        tensors are not supported, e.g. for ONNX export.
+        """
         # timestep/noise_level embedding; only for continuous training
         modules = self.all_modules
         m_idx = 0
 
-        # Convert real and imaginary parts of (x,y) into four channel dimensions
-        x = torch.cat((x[:,[0],:,:].real, x[:,[0],:,:].imag,
-                x[:,[1],:,:].real, x[:,[1],:,:].imag), dim=1)
-
         if self.embedding_type == 'fourier':
             # Gaussian Fourier features embeddings.
             used_sigmas = time_cond
@@ -397,8 +418,4 @@ class NCSNpp(nn.Module):
         assert m_idx == len(modules), "Implementation error"
         h = h / used_sigmas[:, None, None, None]
 
-        # Convert back to complex number
-        h = self.output_layer(h)
-        h = torch.permute(h, (0, 2, 3, 1)).contiguous()
-        h = torch.view_as_complex(h)[:,None, :, :]
-        return h
+        return self.output_layer(h)
@@ -23,6 +23,8 @@ import torch
 import torch.nn.functional as F
 import numpy as np
 
+from flowmse.util.precision import full_precision
+
 conv1x1 = layers.ddpm_conv1x1
 conv3x3 = layers.ddpm_conv3x3
 NIN = layers.NIN
@@ -37,8 +39,10 @@ class GaussianFourierProjection(nn.Module):
     self.W = nn.Parameter(torch.randn(embedding_size) * scale, requires_grad=False)
 
   def forward(self, x):
-    x_proj = x[:, None] * self.W[None, :] * 2 * np.pi
-    return torch.cat([torch.sin(x_proj), torch.cos(x_proj)], dim=-1)
+    # always in float32: the phases reach several hundred radians, where half precision is off by whole periods
+    with full_precision(x.device):
+      x_proj = x.float()[:, None] * self.W.float()[None, :] * 2 * np.pi
+      return torch.cat([torch.sin(x_proj), torch.cos(x_proj)], dim=-1)
 
 
 class Combine(nn.Module):
@@ -59,10 +63,37 @@ class Combine(nn.Module):
       raise ValueError(f'Method {self.method} not recognized.')
 
 
+def chunked_attention(q, k, v, chunk_size=1024):
+  """Softmax attention of q, k, v of shape (B, L, C), computed in tiles of `chunk_size` queries and keys with an
+  online softmax, so that at most (B, chunk_size, chunk_size) scores are held at a time."""
+  scale = q.shape[-1] ** (-0.5)
+  out = []
+  for q_start in range(0, q.shape[1], chunk_size):
+    q_chunk = q[:, q_start:q_start + chunk_size] * scale
+    running_max = q_chunk.new_full((*q_chunk.shape[:2], 1), -float('inf'))
+    normalizer = q_chunk.new_zeros((*q_chunk.shape[:2], 1))
+    acc = torch.zeros_like(q_chunk)
+    for k_start in range(0, k.shape[1], chunk_size):
+      scores = torch.bmm(q_chunk, k[:, k_start:k_start + chunk_size].transpose(1, 2))
+      new_max = torch.maximum(running_max, scores.amax(dim=-1, keepdim=True))
+      p = torch.exp(scores - new_max)
+      correction = torch.exp(running_max - new_max)
+      normalizer = normalizer * correction + p.sum(dim=-1, keepdim=True)
+      acc = acc * correction + torch.bmm(p, v[:, k_start:k_start + chunk_size])
+      running_max = new_max
+    out.append(acc / normalizer)
+  return torch.cat(out, dim=1)
+
+
 class AttnBlockpp(nn.Module):
-  """Channel-wise self-attention block. Modified from DDPM."""
+  """Channel-wise self-attention block. Modified from DDPM.
 
-  def __init__(self, channels, skip_rescale=False, init_scale=0.):
+  `attention_type` selects how the attention over the H*W positions is computed, all with the same parameters:
+  'einsum' materializes the full (B, H, W, H*W) weights, 'sdpa' uses `F.scaled_dot_product_attention`
+  (PyTorch >= 2.0, otherwise 'chunked' is used) and 'chunked' uses `chunked_attention`.
+  """
+
+  def __init__(self, channels, skip_rescale=False, init_scale=0., attention_type='einsum', attention_chunk_size=1024):
     super().__init__()
     self.GroupNorm_0 = nn.GroupNorm(num_groups=min(channels // 4, 32), num_channels=channels,
                                   eps=1e-6)
@@ -71,6 +102,12 @@ class AttnBlockpp(nn.Module):
     self.NIN_2 = NIN(channels, channels)
     self.NIN_3 = NIN(channels, channels, init_scale=init_scale)
     self.skip_rescale = skip_rescale
+    if attention_type not in ('einsum', 'sdpa', 'chunked'):
+      raise ValueError(f'attention type {attention_type} unknown.')
+    if attention_type == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+      attention_type = 'chunked'
+    self.attention_type = attention_type
+    self.attention_chunk_size = attention_chunk_size
 
   def forward(self, x):
     B, C, H, W = x.shape
@@ -79,11 +116,19 @@ class AttnBlockpp(nn.Module):
     k = self.NIN_1(h)
     v = self.NIN_2(h)
 
-    w = torch.einsum('bchw,bcij->bhwij', q, k) * (int(C) ** (-0.5))
-    w = torch.reshape(w, (B, H, W, H * W))
-    w = F.softmax(w, dim=-1)
-    w = torch.reshape(w, (B, H, W, H, W))
-    h = torch.einsum('bhwij,bcij->bchw', w, v)
+    if self.attention_type == 'einsum':
+      w = torch.einsum('bchw,bcij->bhwij', q, k) * (int(C) ** (-0.5))
+      w = torch.reshape(w, (B, H, W, H * W))
+      w = F.softmax(w, dim=-1)
+      w = torch.reshape(w, (B, H, W, H, W))
+      h = torch.einsum('bhwij,bcij->bchw', w, v)
+    else:
+      q, k, v = (t.reshape(B, C, H * W).transpose(1, 2) for t in (q, k, v))
+      if self.attention_type == 'sdpa':
+        h = F.scaled_dot_product_attention(q, k, v)
+      else:
+        h = chunked_attention(q, k, v, self.attention_chunk_size)
+      h = h.transpose(1, 2).reshape(B, C, H, W)
     h = self.NIN_3(h)
     if not self.skip_rescale:
       return x + h
@@ -1,20 +1,34 @@
 import os
+import warnings
 
 import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.autograd import Function
-from torch.utils.cpp_extension import load
 
 
 module_path = os.path.dirname(__file__)
-fused = load(
-    "fused",
-    sources=[
-        os.path.join(module_path, "fused_bias_act.cpp"),
-        os.path.join(module_path, "fused_bias_act_kernel.cu"),
-    ],
-)
+fused = None
+_fused_failed = False
+
+
+def _load_fused():
+    """JIT-compile the CUDA op on first use. Returns None (once with a warning) if it cannot be built."""
+    global fused, _fused_failed
+    if fused is None and not _fused_failed:
+        try:
+            from torch.utils.cpp_extension import load
+            fused = load(
+                "fused",
+                sources=[
+                    os.path.join(module_path, "fused_bias_act.cpp"),
+                    os.path.join(module_path, "fused_bias_act_kernel.cu"),
+                ],
+            )
+        except Exception as e:
+            _fused_failed = True
+            warnings.warn(f"Could not build the fused_bias_act CUDA op, using the PyTorch implementation instead: {e}")
+    return fused
 
 
 class FusedLeakyReLUFunctionBackward(Function):
@@ -84,11 +98,11 @@ class FusedLeakyReLU(nn.Module):
 
 
 def fused_leaky_relu(input, bias, negative_slope=0.2, scale=2 ** 0.5):
-    if input.device.type == "cpu":
+    if input.device.type == "cpu" or _load_fused() is None:
         rest_dim = [1] * (input.ndim - bias.ndim - 1)
         return (
             F.leaky_relu(
-                input + bias.view(1, bias.shape[0], *rest_dim), negative_slope=0.2
+                input + bias.view(1, bias.shape[0], *rest_dim), negative_slope=negative_slope
             )
             * scale
         )
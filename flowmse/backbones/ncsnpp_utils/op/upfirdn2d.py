@@ -1,19 +1,33 @@
 import os
+import warnings
 
 import torch
 from torch.nn import functional as F
 from torch.autograd import Function
-from torch.utils.cpp_extension import load
 
 
 module_path = os.path.dirname(__file__)
-upfirdn2d_op = load(
-    "upfirdn2d",
-    sources=[
-        os.path.join(module_path, "upfirdn2d.cpp"),
-        os.path.join(module_path, "upfirdn2d_kernel.cu"),
-    ],
-)
+_upfirdn2d_op = None
+_upfirdn2d_op_failed = False
+
+
+def _load_upfirdn2d_op():
+    """JIT-compile the CUDA op on first use. Returns None (once with a warning) if it cannot be built."""
+    global _upfirdn2d_op, _upfirdn2d_op_failed
+    if _upfirdn2d_op is None and not _upfirdn2d_op_failed:
+        try:
+            from torch.utils.cpp_extension import load
+            _upfirdn2d_op = load(
+                "upfirdn2d",
+                sources=[
+                    os.path.join(module_path, "upfirdn2d.cpp"),
+                    os.path.join(module_path, "upfirdn2d_kernel.cu"),
+                ],
+            )
+        except Exception as e:
+            _upfirdn2d_op_failed = True
+            warnings.warn(f"Could not build the upfirdn2d CUDA op, using the PyTorch implementation instead: {e}")
+    return _upfirdn2d_op
 
 
 class UpFirDn2dBackward(Function):
@@ -28,7 +42,7 @@ class UpFirDn2dBackward(Function):
 
         grad_output = grad_output.reshape(-1, out_size[0], out_size[1], 1)
 
-        grad_input = upfirdn2d_op.upfirdn2d(
+        grad_input = _upfirdn2d_op.upfirdn2d(
             grad_output,
             grad_kernel,
             down_x,
@@ -65,7 +79,7 @@ class UpFirDn2dBackward(Function):
 
         gradgrad_input = gradgrad_input.reshape(-1, ctx.in_size[2], ctx.in_size[3], 1)
 
-        gradgrad_out = upfirdn2d_op.upfirdn2d(
+        gradgrad_out = _upfirdn2d_op.upfirdn2d(
             gradgrad_input,
             kernel,
             ctx.up_x,
@@ -115,7 +129,7 @@ class UpFirDn2d(Function):
 
         ctx.g_pad = (g_pad_x0, g_pad_x1, g_pad_y0, g_pad_y1)
 
-        out = upfirdn2d_op.upfirdn2d(
+        out = _upfirdn2d_op.upfirdn2d(
             input, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1
         )
         # out = out.view(major, out_h, out_w, minor)
@@ -142,8 +156,19 @@ class UpFirDn2d(Function):
         return grad_input, None, None, None, None
 
 
+def _use_native(input):
+    # the CUDA op can neither be traced (TorchScript, ONNX) nor compiled, so these use the PyTorch implementation
+    # (torch._dynamo is only loaded by torch.compile and does not exist before PyTorch 2.0). It also only handles
+    # float32 inputs, not the half precision activations under autocast.
+    compiling = hasattr(torch, "_dynamo") and torch._dynamo.is_compiling()
+    return (
+        input.device.type == "cpu" or input.dtype != torch.float32 or torch.jit.is_tracing() or compiling
+        or _load_upfirdn2d_op() is None
+    )
+
+
 def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
-    if input.device.type == "cpu":
+    if _use_native(input):
         out = upfirdn2d_native(
             input, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1]
         )
@@ -159,42 +184,32 @@ def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
 def upfirdn2d_native(
     input, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1
 ):
-    _, channel, in_h, in_w = input.shape
-    input = input.reshape(-1, in_h, in_w, 1)
-
-    _, in_h, in_w, minor = input.shape
+    batch, channel, in_h, in_w = input.shape
     kernel_h, kernel_w = kernel.shape
+    out = input.reshape(batch, channel, in_h, 1, in_w, 1)
 
-    out = input.view(-1, in_h, 1, in_w, 1, minor)
-    out = F.pad(out, [0, 0, 0, up_x - 1, 0, 0, 0, up_y - 1])
-    out = out.view(-1, in_h * up_y, in_w * up_x, minor)
+    # upsample by inserting zeros
+    out = F.pad(out, [0, up_x - 1, 0, 0, 0, up_y - 1])
+    out = out.view(batch, channel, in_h * up_y, in_w * up_x)
 
+    # pad, or crop for negative padding
     out = F.pad(
-        out, [0, 0, max(pad_x0, 0), max(pad_x1, 0), max(pad_y0, 0), max(pad_y1, 0)]
+        out, [max(pad_x0, 0), max(pad_x1, 0), max(pad_y0, 0), max(pad_y1, 0)]
     )
     out = out[
         :,
-        max(-pad_y0, 0) : out.shape[1] - max(-pad_y1, 0),
-        max(-pad_x0, 0) : out.shape[2] - max(-pad_x1, 0),
         :,
+        max(-pad_y0, 0) : out.shape[2] - max(-pad_y1, 0),
+        max(-pad_x0, 0) : out.shape[3] - max(-pad_x1, 0),
     ]
 
-    out = out.permute(0, 3, 1, 2)
-    out = out.reshape(
-        [-1, 1, in_h * up_y + pad_y0 + pad_y1, in_w * up_x + pad_x0 + pad_x1]
-    )
-    w = torch.flip(kernel, [0, 1]).view(1, 1, kernel_h, kernel_w)
-    out = F.conv2d(out, w)
-    out = out.reshape(
-        -1,
-        minor,
-        in_h * up_y + pad_y0 + pad_y1 - kernel_h + 1,
-        in_w * up_x + pad_x0 + pad_x1 - kernel_w + 1,
-    )
-    out = out.permute(0, 2, 3, 1)
-    out = out[:, ::down_y, ::down_x, :]
-
-    out_h = (in_h * up_y + pad_y0 + pad_y1 - kernel_h) // down_y + 1
-    out_w = (in_w * up_x + pad_x0 + pad_x1 - kernel_w) // down_x + 1
+    # FIR filter every channel (depthwise) and downsample in one strided convolution
+    w = torch.flip(kernel, [0, 1]).view(1, 1, kernel_h, kernel_w).to(out.dtype)
+    if torch.onnx.is_in_onnx_export():
+        # the exporter needs a weight of known shape, so fold the channels into the batch instead (slower)
+        out_h, out_w = out.shape[2], out.shape[3]
+        out = F.conv2d(out.reshape(batch * channel, 1, out_h, out_w), w, stride=(down_y, down_x))
+    else:
+        out = F.conv2d(out, w.expand(channel, 1, kernel_h, kernel_w), stride=(down_y, down_x), groups=channel)
 
-    return out.view(-1, channel, out_h, out_w)
+    return out.view(batch, channel, out.shape[2], out.shape[3])
@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 
 from flowmse.util.registry import Registry
+from flowmse.util.precision import full_precision
 
 
 BackboneRegistry = Registry("Backbone")
@@ -27,11 +28,13 @@ class GaussianFourierProjection(nn.Module):
         self.W = nn.Parameter(torch.randn(embed_dim) * scale, requires_grad=False)
 
     def forward(self, t):
-        t_proj = t[:, None] * self.W[None, :] * 2*np.pi
-        if self.complex_valued:
-            return torch.exp(1j * t_proj)
-        else:
-            return torch.cat([torch.sin(t_proj), torch.cos(t_proj)], dim=-1)
+        # always in (at least) float32, see `layerspp.GaussianFourierProjection`
+        with full_precision(t.device):
+            t_proj = t[:, None] * self.W.float()[None, :] * 2*np.pi
+            if self.complex_valued:
+                return torch.exp(1j * t_proj)
+            else:
+                return torch.cat([torch.sin(t_proj), torch.cos(t_proj)], dim=-1)
 
 
 class DiffusionStepEmbedding(nn.Module):
@@ -70,7 +73,7 @@ class ComplexLinear(nn.Module):
 
     def forward(self, x):
         if self.complex_valued:
-            return (self.re(x.real) - self.im(x.imag)) + 1j*(self.re(x.imag) + self.im(x.real))
+            return torch_complex_from_reim(self.re(x.real) - self.im(x.imag), self.re(x.imag) + self.im(x.real))
         else:
             return self.lin(x)
 
@@ -88,6 +91,9 @@ class FeatureMapDense(nn.Module):
 
 
 def torch_complex_from_reim(re, im):
+    if re.dtype in (torch.float16, torch.bfloat16):
+        # real layers return half precision under autocast, keep the complex activations in complex64
+        re, im = re.float(), im.float()
     return torch.view_as_complex(torch.stack([re, im], dim=-1))
 
 
@@ -1,66 +1,167 @@
 
+import json
 from os.path import join
 import torch
 import pytorch_lightning as pl
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, SequentialSampler
 from glob import glob
-from torchaudio import load
+from torchaudio import load, info
 import numpy as np
 import torch.nn.functional as F
 
-
-def get_window(window_type, window_length):
-    if window_type == 'sqrthann':
-        return torch.sqrt(torch.hann_window(window_length, periodic=True))
-    elif window_type == 'hann':
-        return torch.hann_window(window_length, periodic=True)
-    else:
-        raise NotImplementedError(f"Window type {window_type} not implemented!")
+from flowmse.util.transforms import get_window, spec_fwd, spec_back
 
 
 class Specs(Dataset):
     def __init__(self, data_dir, subset, dummy, shuffle_spec, num_frames,
             format='default', normalize="noisy", spec_transform=None,
-            stft_kwargs=None, **ignored_kwargs):
+            stft_kwargs=None, spec_config=None, return_waveforms=False, **ignored_kwargs):
 
         # Read file paths according to file naming format.
+        self.format = format
         if format == "default":
             self.clean_files = sorted(glob(join(data_dir, subset) + '/clean/*.wav'))
             self.noisy_files = sorted(glob(join(data_dir, subset) + '/noisy/*.wav'))
+        elif format == "stft_cache":
+            # precomputed spectrograms, see `python preprocess.py stft`
+            self.cache_dir = join(data_dir, subset)
+            with open(join(self.cache_dir, "index.json")) as f:
+                index = json.load(f)
+            if spec_config is not None and index["config"] != spec_config:
+                raise ValueError(f"STFT cache in {self.cache_dir} was built with {index['config']}, but {spec_config} is configured!")
+            self.clean_files = [entry["clean_file"] for entry in index["files"]]
+            self.noisy_files = [entry["noisy_file"] for entry in index["files"]]
+            self.offsets = [entry["offset"] for entry in index["files"]]
+            self.lengths = [entry["num_frames"] for entry in index["files"]]
+            self._cache = None
+        elif format == "packed":
+            # waveform shards, see `python preprocess.py pack`
+            self.packed_dir = join(data_dir, subset)
+            with open(join(self.packed_dir, "index.json")) as f:
+                index = json.load(f)
+            self.packed_dtype = index["config"]["dtype"]
+            self.num_shards = index["config"]["num_shards"]
+            self.clean_files = [entry["clean_file"] for entry in index["files"]]
+            self.noisy_files = [entry["noisy_file"] for entry in index["files"]]
+            self.shard_ids = [entry["shard"] for entry in index["files"]]
+            self.offsets = [entry["offset"] for entry in index["files"]]
+            self.lengths = [entry["num_samples"] for entry in index["files"]]
+            self._shards = None
         else:
             # Feel free to add your own directory format
             raise NotImplementedError(f"Directory format {format} unknown!")
 
         self.dummy = dummy
+        # num_frames=None returns full utterances instead of fixed-size crops
         self.num_frames = num_frames
         self.shuffle_spec = shuffle_spec
         self.normalize = normalize
         self.spec_transform = spec_transform
+        # return normalized waveforms and leave the STFT to the model, see `VFModel._to_spec_batch`
+        self.return_waveforms = return_waveforms
+        self._num_samples = None
+        self._item_num_samples = {}
 
         assert all(k in stft_kwargs.keys() for k in ["n_fft", "hop_length", "center", "window"]), "misconfigured STFT kwargs"
         self.stft_kwargs = stft_kwargs
         self.hop_length = self.stft_kwargs["hop_length"]
         assert self.stft_kwargs.get("center", None) == True, "'center' must be True for current implementation"
 
-    def __getitem__(self, i):
-        x, _ = load(self.clean_files[i])
-        y, _ = load(self.noisy_files[i])
+    def get_num_samples(self):
+        """Lengths (in samples) of all utterances, read from the file headers once and cached."""
+        if self.format == "packed":
+            return self.lengths[:len(self)]
+        if self._num_samples is None:
+            self._num_samples = [info(f).num_frames for f in self.clean_files[:len(self)]]
+        return self._num_samples
 
-        # formula applies for center=True
-        target_len = (self.num_frames - 1) * self.hop_length
-        current_len = x.size(-1)
+    def _get_num_samples(self, i):
+        if self._num_samples is not None:
+            return self._num_samples[i]
+        # read per item (and remembered per worker), so that no worker has to stat the whole dataset up front
+        if i not in self._item_num_samples:
+            self._item_num_samples[i] = info(self.clean_files[i]).num_frames
+        return self._item_num_samples[i]
+
+    def get_num_frames(self):
+        """Number of STFT frames of all full utterances. The formula applies for center=True."""
+        if self.format == "stft_cache":
+            return self.lengths[:len(self)]
+        return [n // self.hop_length + 1 for n in self.get_num_samples()]
+
+    def _get_cached_item(self, i):
+        if self._cache is None:
+            # opened lazily, so that every DataLoader worker maps the files itself
+            self._cache = tuple(
+                np.load(join(self.cache_dir, f"{name}.npy"), mmap_mode="r") for name in ("clean", "noisy"))
+        clean, noisy = self._cache
+        offset, current_len = self.offsets[i], self.lengths[i]
+        target_len = current_len if self.num_frames is None else self.num_frames
         pad = max(target_len - current_len, 0)
         if pad == 0:
-            # extract random part of the audio file
+            # the crop is a slice of the memory-mapped (frames, freqs) arrays, only it is copied
             if self.shuffle_spec:
                 start = int(np.random.uniform(0, current_len-target_len))
             else:
                 start = int((current_len-target_len)/2)
-            x = x[..., start:start+target_len]
-            y = y[..., start:start+target_len]
+            X = torch.from_numpy(np.array(clean[offset+start:offset+start+target_len]))
+            Y = torch.from_numpy(np.array(noisy[offset+start:offset+start+target_len]))
+        else:
+            # pad spectrogram if the number of frames is smaller than num_frames
+            X = torch.from_numpy(np.array(clean[offset:offset+current_len]))
+            Y = torch.from_numpy(np.array(noisy[offset:offset+current_len]))
+            X = F.pad(X, (0, 0, pad//2, pad//2+(pad%2)), mode='constant')
+            Y = F.pad(Y, (0, 0, pad//2, pad//2+(pad%2)), mode='constant')
+        return X.T[None], Y.T[None]
+
+    def _read_packed(self, i, start, length):
+        if self._shards is None:
+            # opened lazily, so that every DataLoader worker maps the files itself
+            self._shards = [
+                np.load(join(self.packed_dir, f"shard_{k:03d}.npy"), mmap_mode="r") for k in range(self.num_shards)]
+        offset = self.offsets[i] + start
+        # (samples, 2) with clean and noisy interleaved, so that the crop is a single contiguous read
+        pair = np.array(self._shards[self.shard_ids[i]][offset:offset+length], dtype=np.float32)
+        if self.packed_dtype == "int16":
+            pair = pair / 32768
+        pair = torch.from_numpy(pair).T
+        return pair[[0]], pair[[1]]
+
+    def _crop_window(self, current_len):
+        """Start and length (in samples) of the part of an utterance with `current_len` samples to be used."""
+        if self.num_frames is None:
+            return 0, current_len
+        # formula applies for center=True
+        target_len = (self.num_frames - 1) * self.hop_length
+        if current_len < target_len:
+            return 0, current_len
+        # extract random part of the audio file
+        if self.shuffle_spec:
+            start = int(np.random.uniform(0, current_len-target_len))
+        else:
+            start = int((current_len-target_len)/2)
+        return start, target_len
+
+    def __getitem__(self, i):
+        if self.format == "stft_cache":
+            return self._get_cached_item(i)
+
+        if self.format == "packed":
+            # only the samples of the crop are read from the shard
+            start, length = self._crop_window(self.lengths[i])
+            x, y = self._read_packed(i, start, length)
         else:
+            # choose the crop from the header first and decode only that window of both files
+            start, length = self._crop_window(self._get_num_samples(i))
+            x, _ = load(self.clean_files[i], frame_offset=start, num_frames=length)
+            y, _ = load(self.noisy_files[i], frame_offset=start, num_frames=length)
+
+        if self.num_frames is not None:
             # pad audio if the length T is smaller than num_frames
+            target_len = (self.num_frames - 1) * self.hop_length
+            pad = max(target_len - x.size(-1), 0)
             x = F.pad(x, (pad//2, pad//2+(pad%2)), mode='constant')
             y = F.pad(y, (pad//2, pad//2+(pad%2)), mode='constant')
 
@@ -74,9 +175,12 @@ class Specs(Dataset):
             normfac = 1.0
         x = x / normfac
         y = y / normfac
+        if self.return_waveforms:
+            return x, y
         X = torch.stft(x, **self.stft_kwargs)
         Y = torch.stft(y, **self.stft_kwargs)
-        X, Y = self.spec_transform(X), self.spec_transform(Y)    
+        # the STFTs are not used otherwise, so they are transformed in place
+        X, Y = self.spec_transform(X, out=X), self.spec_transform(Y, out=Y)
         return X, Y
 
     def __len__(self):
@@ -87,11 +191,66 @@ class Specs(Dataset):
             return len(self.clean_files)
 
 
+class LengthBucketSampler(BatchSampler):
+    """
+    Batch sampler that groups utterances of similar length, to minimize zero padding of full utterances.
+
+    The indices yielded by `sampler` are sorted by their number of STFT frames and cut into batches.
+    The signature follows `BatchSampler`, so that Lightning can re-instantiate it around a
+    `DistributedSampler`; the dataset is looked up from the wrapped sampler and must provide `get_num_frames()`.
+    """
+
+    def __init__(self, sampler, batch_size, drop_last=False):
+        super().__init__(sampler, batch_size, drop_last)
+        dataset = getattr(sampler, "data_source", None)
+        if dataset is None:
+            dataset = sampler.dataset
+        self.lengths = dataset.get_num_frames()
+
+    def get_batches(self):
+        indices = sorted(self.sampler, key=lambda i: self.lengths[i])
+        batches = [indices[i:i+self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+    def __iter__(self):
+        return iter(self.get_batches())
+
+    def padding_overhead(self, multiple=64):
+        """Fraction of zero-padded frames when every batch is padded to its longest utterance (see `pad_spec`)."""
+        num_frames, num_padded_frames = 0, 0
+        for batch in self.get_batches():
+            lengths = [self.lengths[i] for i in batch]
+            num_frames += sum(lengths)
+            num_padded_frames += len(batch) * int(np.ceil(max(lengths) / multiple) * multiple)
+        return 1 - num_frames / num_padded_frames
+
+
+def pad_collate(batch, multiple=64):
+    """
+    Collate full utterances of different lengths into zero-padded batches.
+
+    The frame axis is padded to the longest utterance, rounded up to `multiple` (see `pad_spec`).
+
+    Returns:
+        X, Y: complex spectrograms of shape (B, 1, F, T).
+        mask: float tensor of shape (B, 1, 1, T), 1 for valid and 0 for padded frames.
+        lengths: number of valid frames per utterance.
+    """
+    lengths = torch.tensor([X.size(-1) for X, _ in batch])
+    num_frames = int(np.ceil(lengths.max().item() / multiple) * multiple)
+    X = torch.stack([F.pad(X, (0, num_frames - X.size(-1))) for X, _ in batch])
+    Y = torch.stack([F.pad(Y, (0, num_frames - Y.size(-1))) for _, Y in batch])
+    mask = (torch.arange(num_frames)[None, :] < lengths[:, None]).float()[:, None, None, :]
+    return X, Y, mask, lengths
+
+
 class SpecsDataModule(pl.LightningDataModule):
     @staticmethod
     def add_argparse_args(parser):
         parser.add_argument("--base_dir", type=str, required=True, help="The base directory of the dataset. Should contain `train`, `valid` and `test` subdirectories, each of which contain `clean` and `noisy` subdirectories.")
-        parser.add_argument("--format", type=str, choices=("default", "dns"), default="default", help="Read file paths according to file naming format.")
+        parser.add_argument("--format", type=str, choices=("default", "dns", "stft_cache", "packed"), default="default", help="Read file paths according to file naming format. 'stft_cache' reads spectrograms precomputed by `preprocess.py stft` and 'packed' reads waveform shards written by `preprocess.py pack`, with base_dir being the output directory of the respective command.")
         parser.add_argument("--batch_size", type=int, default=8, help="The batch size. 8 by default.")
         parser.add_argument("--n_fft", type=int, default=510, help="Number of FFT bins. 510 by default.")   # to assure 256 freq bins
         parser.add_argument("--hop_length", type=int, default=128, help="Window hop length. 128 by default.")
@@ -103,13 +262,15 @@ class SpecsDataModule(pl.LightningDataModule):
         parser.add_argument("--spec_abs_exponent", type=float, default=0.5, help="Exponent e for the transformation abs(z)**e * exp(1j*angle(z)). 0.5 by default.")
         parser.add_argument("--normalize", type=str, choices=("clean", "noisy", "not"), default="noisy", help="Normalize the input waveforms by the clean signal, the noisy signal, or not at all.")
         parser.add_argument("--transform_type", type=str, choices=("exponent", "log", "none"), default="exponent", help="Spectogram transformation for input representation.")
+        parser.add_argument("--full_utterance_eval", action="store_true", help="Validate and test on full utterances batched by length, instead of fixed-size num_frames crops.")
+        parser.add_argument("--gpu_stft", action="store_true", help="Load waveform crops and compute the STFT and spectrogram transformation batched on the model's device.")
         return parser
 
     def __init__(
         self, base_dir, format='default', batch_size=8,
         n_fft=510, hop_length=128, num_frames=256, window='hann',
         num_workers=4, dummy=False, spec_factor=0.15, spec_abs_exponent=0.5,
-        gpu=True, normalize='noisy', transform_type="exponent", **kwargs
+        gpu=True, normalize='noisy', transform_type="exponent", full_utterance_eval=False, gpu_stft=False, **kwargs
     ):
         super().__init__()
         self.base_dir = base_dir
@@ -118,6 +279,7 @@ class SpecsDataModule(pl.LightningDataModule):
         self.n_fft = n_fft
         self.hop_length = hop_length
         self.num_frames = num_frames
+        self.window_type = window
         self.window = get_window(window, self.n_fft)
         self.windows = {}
         self.num_workers = num_workers
@@ -127,52 +289,49 @@ class SpecsDataModule(pl.LightningDataModule):
         self.gpu = gpu
         self.normalize = normalize
         self.transform_type = transform_type
+        self.full_utterance_eval = full_utterance_eval
+        self.gpu_stft = gpu_stft
+        if gpu_stft and format == "stft_cache":
+            raise ValueError("--gpu_stft needs waveforms and cannot be used with --format stft_cache!")
         self.kwargs = kwargs
 
     def setup(self, stage=None):
         specs_kwargs = dict(
-            stft_kwargs=self.stft_kwargs, num_frames=self.num_frames,
-            spec_transform=self.spec_fwd, **self.kwargs
+            stft_kwargs=self.stft_kwargs, spec_transform=self.spec_fwd,
+            spec_config=self.spec_config, **self.kwargs
         )
+        eval_num_frames = None if self.full_utterance_eval else self.num_frames
+        # full utterances are padded as spectrograms by `pad_collate`, so only crops are returned as waveforms
+        eval_waveforms = self.gpu_stft and not self.full_utterance_eval
         if stage == 'fit' or stage is None:
             self.train_set = Specs(data_dir=self.base_dir, subset='train',
                 dummy=self.dummy, shuffle_spec=True, format=self.format, 
-                normalize=self.normalize, **specs_kwargs)
+                normalize=self.normalize, num_frames=self.num_frames,
+                return_waveforms=self.gpu_stft, **specs_kwargs)
             self.valid_set = Specs(data_dir=self.base_dir, subset='valid',
                 dummy=self.dummy, shuffle_spec=False, format=self.format,
-                normalize=self.normalize, **specs_kwargs)
+                normalize=self.normalize, num_frames=eval_num_frames,
+                return_waveforms=eval_waveforms, **specs_kwargs)
         if stage == 'test' or stage is None:
             self.test_set = Specs(data_dir=self.base_dir, subset='test',
                 dummy=self.dummy, shuffle_spec=False, format=self.format,
-                normalize=self.normalize, **specs_kwargs)
-
-    def spec_fwd(self, spec):
-        if self.transform_type == "exponent":
-            if self.spec_abs_exponent != 1:
-                # only do this calculation if spec_exponent != 1, otherwise it's quite a bit of wasted computation
-                # and introduced numerical error
-                e = self.spec_abs_exponent
-                spec = spec.abs()**e * torch.exp(1j * spec.angle())
-            spec = spec * self.spec_factor
-        elif self.transform_type == "log":
-            spec = torch.log(1 + spec.abs()) * torch.exp(1j * spec.angle())
-            spec = spec * self.spec_factor
-        elif self.transform_type == "none":
-            spec = spec
-        return spec
-
-    def spec_back(self, spec):
-        if self.transform_type == "exponent":
-            spec = spec / self.spec_factor
-            if self.spec_abs_exponent != 1:
-                e = self.spec_abs_exponent
-                spec = spec.abs()**(1/e) * torch.exp(1j * spec.angle())
-        elif self.transform_type == "log":
-            spec = spec / self.spec_factor
-            spec = (torch.exp(spec.abs()) - 1) * torch.exp(1j * spec.angle())
-        elif self.transform_type == "none":
-            spec = spec
-        return spec
+                normalize=self.normalize, num_frames=eval_num_frames,
+                return_waveforms=eval_waveforms, **specs_kwargs)
+
+    def spec_fwd(self, spec, out=None):
+        return spec_fwd(spec, self.transform_type, self.spec_abs_exponent, self.spec_factor, out=out)
+
+    def spec_back(self, spec, out=None):
+        return spec_back(spec, self.transform_type, self.spec_abs_exponent, self.spec_factor, out=out)
+
+    @property
+    def spec_config(self):
+        """Settings that determine the transformed spectrograms, stored alongside precomputed ones."""
+        return dict(
+            n_fft=self.n_fft, hop_length=self.hop_length, window=self.window_type,
+            spec_factor=self.spec_factor, spec_abs_exponent=self.spec_abs_exponent,
+            transform_type=self.transform_type, normalize=self.normalize
+        )
 
     @property
     def stft_kwargs(self):
@@ -210,14 +369,20 @@ class SpecsDataModule(pl.LightningDataModule):
             num_workers=self.num_workers, pin_memory=self.gpu, shuffle=True
         )
 
-    def val_dataloader(self):
+    def _eval_dataloader(self, dataset):
+        if self.full_utterance_eval:
+            batch_sampler = LengthBucketSampler(SequentialSampler(dataset), batch_size=self.batch_size)
+            return DataLoader(
+                dataset, batch_sampler=batch_sampler, collate_fn=pad_collate,
+                num_workers=self.num_workers, pin_memory=self.gpu
+            )
         return DataLoader(
-            self.valid_set, batch_size=self.batch_size,
+            dataset, batch_size=self.batch_size,
             num_workers=self.num_workers, pin_memory=self.gpu, shuffle=False
         )
 
+    def val_dataloader(self):
+        return self._eval_dataloader(self.valid_set)
+
     def test_dataloader(self):
-        return DataLoader(
-            self.test_set, batch_size=self.batch_size,
-            num_workers=self.num_workers, pin_memory=self.gpu, shuffle=False
-        )
+        return self._eval_dataloader(self.test_set)
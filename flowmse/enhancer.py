@@ -0,0 +1,181 @@
+"""
+Inference-only export of trained models.
+
+    python -m flowmse.enhancer path/to/model.ckpt path/to/model.safetensors [--dtype float16]
+
+`export_enhancer` writes the EMA weights of the backbone of a `VFModel` checkpoint together with its
+hyperparameters (backbone, ODE, STFT and spectrogram transformation) as metadata, and `load_enhancer` rebuilds
+only the backbone, the ODE and the STFT from such a file. Neither the LightningModule, the data module, the EMA
+shadow copy nor the optimizer state are created, and PyTorch Lightning is not imported.
+
+Files ending in '.safetensors' are written with the `safetensors` package (optional), any other name as a plain
+`torch.save` dict of tensors. Both are memory-mapped when loaded (safetensors always, torch.save files with
+PyTorch >= 2.1), so the weights are only read when they are used and workers on one machine share the pages.
+"""
+import json
+from argparse import ArgumentParser
+
+import torch
+
+from flowmse.backbones import BackboneRegistry
+from flowmse.odes import ODERegistry
+from flowmse.sampling.conditioning import ConditionedVectorField
+from flowmse.util.precision import autocast
+from flowmse.util.transforms import SpecTransform
+
+
+FORMAT_VERSION = 1
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+class Enhancer(torch.nn.Module):
+    """
+    The parts of a `VFModel` needed for enhancement: the backbone, the ODE and the spectrogram transform.
+
+    It has the attributes and methods of `VFModel` that the samplers, `flowmse.util.inference` and
+    `flowmse.util.streaming` use, so it can be passed to them in place of the model. `data_module` is a
+    `SpecTransform`. With `autocast` set to 'bfloat16' or 'float16' the backbone runs in mixed precision, see
+    `flowmse.util.precision`.
+    """
+
+    def __init__(self, backbone, ode, t_eps=0.03, T_rev=1.0, autocast=None, **kwargs):
+        super().__init__()
+        self.dnn = BackboneRegistry.get_by_name(backbone)(**kwargs)
+        self.ode = ODERegistry.get_by_name(ode)(**kwargs)
+        self.autocast = autocast
+        self.t_eps = t_eps
+        self.T_rev = T_rev
+        self.ode.T_rev = T_rev
+        self.data_module = SpecTransform(**kwargs)
+
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
+    def forward(self, x, t, y):
+        dnn_input = torch.cat([x, y], dim=1)
+        with autocast(dnn_input.device, self.autocast):
+            return -self.dnn(dnn_input, t)
+
+    def conditioned(self, y):
+        """`forward` for many calls with this `y`, see `flowmse.sampling.ConditionedVectorField`."""
+        return ConditionedVectorField(self, y)
+
+    def to_audio(self, spec, length=None):
+        return self._istft(self._backward_transform(spec), length)
+
+    def _forward_transform(self, spec):
+        return self.data_module.spec_fwd(spec)
+
+    def _backward_transform(self, spec):
+        return self.data_module.spec_back(spec)
+
+    def _stft(self, sig):
+        return self.data_module.stft(sig)
+
+    def _istft(self, spec, length=None):
+        return self.data_module.istft(spec, length)
+
+
+def _json_hyperparameters(hparams):
+    """The hyperparameters that can be stored as JSON, e.g. without `data_module_cls`."""
+    config = {}
+    for key, value in hparams.items():
+        try:
+            json.dumps(value)
+        except TypeError:
+            continue
+        config[key] = value
+    return config
+
+
+def export_enhancer(checkpoint_file, output_file, dtype="float32"):
+    """
+    Write the inference artifact of a `VFModel` checkpoint.
+
+    Args:
+        checkpoint_file: The Lightning checkpoint.
+        output_file: The artifact. A '.safetensors' file if the name ends with it, otherwise a `torch.save` file.
+        dtype: 'float32', 'float16' or 'bfloat16'. The floating point weights are stored in this type.
+
+    Returns:
+        The metadata written along with the weights.
+    """
+    # the checkpoint refers to the data module class, so reading it needs PyTorch Lightning anyway
+    from flowmse.model import VFModel
+
+    checkpoint = torch.load(checkpoint_file, map_location="cpu")
+    model = VFModel(**{**checkpoint["hyper_parameters"], "base_dir": ""})
+    model.on_load_checkpoint(checkpoint)
+    model.load_state_dict(checkpoint["state_dict"])
+    # copies the EMA weights into the parameters
+    model.eval(no_ema=False)
+
+    state_dict = {
+        name: (tensor.to(DTYPES[dtype]) if tensor.is_floating_point() else tensor).contiguous()
+        for name, tensor in model.dnn.state_dict().items()
+    }
+    config = _json_hyperparameters(checkpoint["hyper_parameters"])
+    # store the resolved STFT settings, including defaults that the checkpoint leaves implicit
+    config.update(model.data_module.spec_config)
+    metadata = dict(format_version=FORMAT_VERSION, dtype=dtype, config=config)
+
+    if output_file.endswith(".safetensors"):
+        from safetensors.torch import save_file
+        save_file(state_dict, output_file, metadata={"flowmse": json.dumps(metadata)})
+    else:
+        torch.save({"flowmse": metadata, "state_dict": state_dict}, output_file)
+    return metadata
+
+
+def _read(file):
+    if file.endswith(".safetensors"):
+        from safetensors import safe_open
+        from safetensors.torch import load_file
+        with safe_open(file, framework="pt") as f:
+            metadata = json.loads(f.metadata()["flowmse"])
+        return metadata, load_file(file)
+    try:
+        artifact = torch.load(file, map_location="cpu", mmap=True, weights_only=True)
+    except TypeError:
+        # PyTorch < 2.1 cannot memory-map
+        artifact = torch.load(file, map_location="cpu")
+    return artifact["flowmse"], artifact["state_dict"]
+
+
+def load_enhancer(file, device="cpu", dtype=torch.float32):
+    """
+    Load an artifact written by `export_enhancer` as an `Enhancer` in eval mode.
+
+    Args:
+        file: The artifact.
+        device: Device of the enhancer.
+        dtype: Type of the floating point weights, float32 by default as the samplers work in complex64. Pass
+            None to keep the stored type, e.g. for use with autocast.
+    """
+    metadata, state_dict = _read(file)
+    if metadata["format_version"] > FORMAT_VERSION:
+        raise ValueError(f"{file} has format version {metadata['format_version']}, this version of flowmse reads up to {FORMAT_VERSION}")
+    enhancer = Enhancer(**metadata["config"])
+    try:
+        # use the loaded (memory-mapped) tensors instead of copying them into the freshly initialized ones
+        enhancer.dnn.load_state_dict(state_dict, assign=True)
+    except TypeError:
+        # PyTorch < 2.1, copies and keeps the type of the parameters
+        enhancer.dnn.load_state_dict(state_dict)
+        if dtype is None:
+            dtype = DTYPES[metadata["dtype"]]
+    if dtype is not None:
+        enhancer.to(dtype)
+    return enhancer.to(device).eval()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Export the EMA backbone weights and configuration of a VFModel checkpoint for inference.")
+    parser.add_argument("ckpt", type=str, help="The Lightning checkpoint.")
+    parser.add_argument("output", type=str, help="The artifact to write. Written with safetensors if it ends with '.safetensors'.")
+    parser.add_argument("--dtype", type=str, choices=tuple(DTYPES), default="float32", help="Type of the stored weights. 'float32' by default.")
+    args = parser.parse_args()
+
+    metadata = export_enhancer(args.ckpt, args.output, args.dtype)
+    print(json.dumps(metadata, indent=2))
@@ -9,10 +9,10 @@ import torch.nn.functional as F
 from flowmse import sampling
 from flowmse.odes import ODERegistry
 from flowmse.backbones import BackboneRegistry
-from flowmse.util.inference import evaluate_model
+from flowmse.util.inference import evaluate_model, ValidationEvaluator
 from flowmse.util.other import pad_spec
+from flowmse.util.precision import AUTOCAST_DTYPES, autocast
 import numpy as np
-import matplotlib.pyplot as plt
 from flowmse.odes import OTFLOW
 import random
 
@@ -30,11 +30,15 @@ class VFModel(pl.LightningModule):
         parser.add_argument("--loss_abs_exponent", type=float, default= 0.5,  help="magnitude transformation in the loss term")
         parser.add_argument("--enhancement", action="store_true", default=False)
         parser.add_argument("--N_enh", type=int, default=10)
+        parser.add_argument("--autocast", type=str, choices=tuple(AUTOCAST_DTYPES), default=None, help="Run the backbone under autocast in this precision, in training and sampling. Off by default. For float16 training use the Trainer's --precision 16 instead, which also scales the loss.")
+        parser.add_argument("--eval_batch_size", type=int, default=8, help="Number of evaluation files enhanced together (padded to the longest) during validation. 8 by default.")
+        parser.add_argument("--eval_workers", type=int, default=4, help="Number of processes per rank computing the evaluation metrics during validation. 0 computes them in the training process. 4 by default.")
         return parser
 
     def __init__(
         self, backbone, ode, lr=1e-4, ema_decay=0.999, t_eps=0.03, T_rev = 1.0,  loss_abs_exponent=0.5, 
-        num_eval_files=10, loss_type='mse', data_module_cls=None, N_enh=10, enhancement=False, **kwargs
+        num_eval_files=10, loss_type='mse', data_module_cls=None, N_enh=10, enhancement=False, autocast=None,
+        eval_batch_size=8, eval_workers=4, **kwargs
     ):
         """
         Create a new ScoreModel.
@@ -46,6 +50,9 @@ class VFModel(pl.LightningModule):
             ema_decay: The decay constant of the parameter EMA (0.999 by default).
             t_eps: The minimum time to practically run for to avoid issues very close to zero (1e-5 by default).
             loss_type: The type of loss to use (wrt. noise z/std). Options are 'mse' (default), 'mae'
+            autocast: None (default), 'bfloat16' or 'float16', see `flowmse.util.precision`.
+            eval_batch_size, eval_workers: Batch size and number of metric processes of the evaluation during
+                validation, see `flowmse.util.inference.ValidationEvaluator`.
         """
         super().__init__()
         # Initialize Backbone DNN
@@ -54,6 +61,7 @@ class VFModel(pl.LightningModule):
         
         
         ode_cls = ODERegistry.get_by_name(ode)
+        self.autocast = autocast
         self.enhancement = enhancement
         self.N_enh = N_enh
         self.ode = ode_cls(**kwargs)
@@ -67,6 +75,9 @@ class VFModel(pl.LightningModule):
         self.ode.T_rev = T_rev
         self.loss_type = loss_type
         self.num_eval_files = num_eval_files
+        self.eval_batch_size = eval_batch_size
+        self.eval_workers = eval_workers
+        self._evaluator = None
         self.loss_abs_exponent = loss_abs_exponent
         self.save_hyperparameters(ignore=['no_wandb'])
         self.data_module = data_module_cls(**kwargs, gpu=kwargs.get('gpus', 0) > 0)
@@ -120,20 +131,25 @@ class VFModel(pl.LightningModule):
         return loss
     
     
-    def _loss(self, vectorfield, condVF):    
+    def _loss(self, vectorfield, condVF, mask=None):    
         if self.loss_type == 'mse':
             err = vectorfield-condVF
             losses = torch.square(err.abs())
         elif self.loss_type == 'mae':
             err = vectorfield-condVF
             losses = err.abs()
+        if mask is not None:
+            # ignore the zero-padded frames of full-utterance batches
+            losses = losses * mask
         # taken from reduce_op function: sum over channels and position and mean over batch dim
         # presumably only important for absolute loss number, not for gradients
         loss = torch.mean(0.5*torch.sum(losses.reshape(losses.shape[0], -1), dim=-1))
         return loss
 
     def _step(self, batch, batch_idx):
-        x0, y = batch
+        x0, y = batch[:2]
+        # full-utterance batches (see `pad_collate`) additionally carry a padding mask and the lengths
+        mask = batch[2] if len(batch) > 2 else None
         rdm = (1-torch.rand(x0.shape[0], device=x0.device)) * (self.T_rev - self.t_eps) + self.t_eps
         t = torch.min(rdm, torch.tensor(self.T_rev))
         mean, std = self.ode.marginal_prob(x0, t, y)
@@ -144,7 +160,7 @@ class VFModel(pl.LightningModule):
         der_mean = self.ode.der_mean(x0,t,y)
         condVF = der_std * z + der_mean
         vectorfield = self(xt, t, y)
-        loss = self._loss(vectorfield, condVF)
+        loss = self._loss(vectorfield, condVF, mask)
         return loss
     
     def _step_enh(self, batch, batch_idx, N_enh):
@@ -176,7 +192,18 @@ class VFModel(pl.LightningModule):
         loss = loss1 + loss2
         return loss
 
+    def _to_spec_batch(self, batch):
+        """Transform waveform batches (see `--gpu_stft`) into spectrograms, batched on the model's device."""
+        x, y = batch[:2]
+        if torch.is_complex(x):
+            return batch
+        X, Y = self._stft(x.squeeze(1)), self._stft(y.squeeze(1))
+        X = self.data_module.spec_fwd(X, out=X).unsqueeze(1)
+        Y = self.data_module.spec_fwd(Y, out=Y).unsqueeze(1)
+        return (X, Y, *batch[2:])
+
     def training_step(self, batch, batch_idx):
+        batch = self._to_spec_batch(batch)
         if self.enhancement:
             loss = self._step_enh(batch, batch_idx, self.N_enh)
             
@@ -186,26 +213,59 @@ class VFModel(pl.LightningModule):
         return loss
 
     def validation_step(self, batch, batch_idx):
+        batch = self._to_spec_batch(batch)
         loss = self._step(batch, batch_idx)
         self.log('valid_loss', loss, on_step=False, on_epoch=True)
+        if len(batch) > 2:
+            mask = batch[2]
+            self.log('valid_padding_overhead', 1 - mask.mean(), on_step=False, on_epoch=True)
 
-        # Evaluate speech enhancement performance
+        # Evaluate speech enhancement performance, the metrics are collected in `validation_epoch_end`
         if batch_idx == 0 and self.num_eval_files != 0:
-            pesq, si_sdr, estoi = evaluate_model(self, self.num_eval_files)
-            self.log('pesq', pesq, on_step=False, on_epoch=True)
-            self.log('si_sdr', si_sdr, on_step=False, on_epoch=True)
-            self.log('estoi', estoi, on_step=False, on_epoch=True)
+            self._validation_evaluator().start(self)
 
         return loss
 
+    def validation_epoch_end(self, outputs):
+        if self.num_eval_files == 0 or self._evaluator is None:
+            return
+        sums = torch.tensor(self._evaluator.finish(), dtype=torch.float64, device=self.device)
+        if self.trainer is not None and self.trainer.world_size > 1:
+            # every rank evaluated its share of the files
+            sums = self.all_gather(sums).sum(dim=0)
+        pesq, si_sdr, estoi = (sums[:3] / sums[3]).tolist()
+        self.log('pesq', pesq, on_step=False, on_epoch=True)
+        self.log('si_sdr', si_sdr, on_step=False, on_epoch=True)
+        self.log('estoi', estoi, on_step=False, on_epoch=True)
+
+    def _validation_evaluator(self):
+        """The evaluation files of this rank, loaded on first use."""
+        if self._evaluator is None:
+            world_size = self.trainer.world_size if self.trainer is not None else 1
+            valid_set = self.data_module.valid_set
+            self._evaluator = ValidationEvaluator(
+                valid_set.clean_files, valid_set.noisy_files, self.num_eval_files, batch_size=self.eval_batch_size,
+                num_workers=self.eval_workers, rank=self.global_rank, world_size=world_size
+            )
+        return self._evaluator
+
+    def on_fit_end(self):
+        if self._evaluator is not None:
+            self._evaluator.close()
+
     def forward(self, x, t, y):
         # Concatenate y as an extra channel
         dnn_input = torch.cat([x, y], dim=1)
         
         # the minus is most likely unimportant here - taken from Song's repo
-        score = -self.dnn(dnn_input, t)
+        with autocast(dnn_input.device, self.autocast):
+            score = -self.dnn(dnn_input, t)
         return score
 
+    def conditioned(self, y):
+        """`forward` for many calls with this `y`, see `flowmse.sampling.ConditionedVectorField`."""
+        return sampling.ConditionedVectorField(self, y)
+
     def to(self, *args, **kwargs):
         """Override PyTorch .to() to also transfer the EMA of the model weights"""
         self.ema.to(*args, **kwargs)
@@ -222,7 +282,10 @@ class VFModel(pl.LightningModule):
         return self.data_module.test_dataloader()
 
     def setup(self, stage=None):
-        return self.data_module.setup(stage=stage)
+        self.data_module.setup(stage=stage)
+        if stage in ('fit', None) and self.num_eval_files != 0:
+            # load the evaluation files once, instead of in every validation
+            self._validation_evaluator()
 
     def to_audio(self, spec, length=None):
         return self._istft(self._backward_transform(spec), length)
@@ -6,7 +6,6 @@ Taken and adapted from https://github.com/yang-song/score_sde_pytorch/blob/1618d
 import abc
 import warnings
 import math
-import scipy.special as sc
 import numpy as np
 from flowmse.util.tensors import batch_broadcast
 import torch
@@ -15,6 +14,14 @@ from flowmse.util.registry import Registry
 
 
 ODERegistry = Registry("ODE")
+
+
+def _expi(x):
+    # scipy.special is only needed by BBED, so it is imported on first use
+    import scipy.special
+    return scipy.special.expi(x)
+
+
 class ODE(abc.ABC):
     """ODE abstract class. Functions are designed for a mini-batch of inputs."""
 
@@ -517,7 +524,7 @@ class BBED(ODE):
         self.k = k
         self.logk = np.log(self.k)
         self.theta = theta
-        self.Eilog = sc.expi(-2*self.logk)
+        self.Eilog = _expi(-2*self.logk)
         self.T_rev = T
 
 
@@ -535,7 +542,7 @@ class BBED(ODE):
 
     def _std(self, t):
         t_np = t.cpu().detach().numpy()
-        Eis = sc.expi(2*(t_np-1)*self.logk) - self.Eilog
+        Eis = _expi(2*(t_np-1)*self.logk) - self.Eilog
         h = 2*self.k**2*self.logk
         var = (self.k**(2*t_np)-1+t_np) + h*(1-t_np)*Eis
         var = torch.tensor(var).to(device=t.device)*(1-t)*self.theta
@@ -558,12 +565,12 @@ class BBED(ODE):
     def der_std(self,t):
         
         # t_np = t.cpu().detach().numpy()
-        # Eis = sc.expi(2*(t_np-1)*self.logk) - self.Eilog
+        # Eis = _expi(2*(t_np-1)*self.logk) - self.Eilog
         # h = 2*self.k**2*self.logk
         # var = (self.k**(2*t_np)-1+t_np) + h*(1-t_np)*Eis
         # var = torch.tensor(var).to(device=t.device)*(1-t)*self.theta
         t_np = t.cpu().detach().numpy()
-        Eis = sc.expi(2*(t_np-1)*self.logk) - self.Eilog
+        Eis = _expi(2*(t_np-1)*self.logk) - self.Eilog
         Eis = torch.tensor(Eis).to(t.device)
         h = 2*self.k**2*self.logk
         pre_var = (self.k**(2*t)-1+t) + h*(1-t)*Eis
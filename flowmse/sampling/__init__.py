@@ -1,16 +1,18 @@
 # Adapted from https://github.com/yang-song/score_sde_pytorch/blob/1618ddea340f3e4a2ed7852a0694a809775cf8d0/sampling.py
 """Various sampling methods."""
-from scipy import integrate
 import torch
 
 from .odesolvers import ODEsolver, ODEsolverRegistry
+from .schedules import Schedule, ScheduleRegistry
+from .cuda_graphs import CUDAGraphCache
+from .conditioning import ConditionedVectorField
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 
 __all__ = [
-    'ODEsolverRegistry', 'ODEsolver', 'get_sampler'
+    'ODEsolverRegistry', 'ODEsolver', 'ScheduleRegistry', 'Schedule', 'CUDAGraphCache', 'ConditionedVectorField',
+    'get_sampler', 'get_adaptive_solver'
 ]
 
 
@@ -26,12 +28,39 @@ def from_flattened_numpy(x, shape):
 
 def get_white_box_solver(
     odesolver_name,  ode, VF_fn, Y, Y_prior=None,
-    T_rev=1.0, t_eps=0.03, N=30, stepsize_type="uniform", **kwargs
+    T_rev=1.0, t_eps=0.03, N=30, stepsize_type="uniform", cuda_graphs=None, **kwargs
 ):
-   
+    """
+    Sampler that integrates the ODE with `N` steps of the solver `odesolver_name` on the timesteps of the schedule
+    `stepsize_type` (see `flowmse.sampling.schedules`, which receives `kwargs`).
+
+    With a `CUDAGraphCache` as `cuda_graphs`, the steps are replayed from a CUDA graph per input shape, see there.
+    Models with a `conditioned` method prepare the conditioning on Y once per run (see `ConditionedVectorField`).
+
+    Returns:
+        A sampling function that returns samples and the number of function evaluations per sample.
+    """
     odesolver_cls = ODEsolverRegistry.get_by_name(odesolver_name)
-    
-    odesolver = odesolver_cls(ode, VF_fn)
+    schedule = ScheduleRegistry.get_by_name(stepsize_type)(ode, **kwargs)
+
+    def integrate(xt, Y, timesteps):
+        # built here so that the conditioning is part of a captured CUDA graph, and is redone for its new inputs
+        vf = VF_fn.conditioned(Y) if hasattr(VF_fn, "conditioned") else VF_fn
+        odesolver = odesolver_cls(ode, vf)
+        for i in range(len(timesteps)):
+            t = timesteps[i]
+            if i != len(timesteps) - 1:
+                stepsize = t - timesteps[i+1]
+            else:
+                stepsize = timesteps[-1]
+                if odesolver_name in ['midpoint', 'heun']:
+                    stepsize = timesteps[-1]
+                    if odesolver_name == "heun":
+                        stepsize = timesteps[-1]/2
+            vec_t = t.expand(Y.shape[0])
+            
+            xt = odesolver.update_fn(xt, vec_t, Y, stepsize)
+        return xt
 
     def ode_solver(Y_prior=Y_prior):
         """The PC sampler function."""
@@ -41,39 +70,45 @@ def get_white_box_solver(
                 Y_prior = Y
             
             xt, _ = ode.prior_sampling(Y_prior.shape, Y_prior)
-            if odesolver_name=="euler":
-                if stepsize_type=="uniform":
-                    timesteps = torch.linspace(T_rev, T_rev/N, N, device=Y.device) 
-                elif stepsize_type=="gerkmann":
-                    timesteps = torch.linspace(T_rev, t_eps, N, device=Y.device)
-                else:
-                    raise("stepsize 다시 설정, stepsize type는 uniform혹은 gerkmann")
-                # timesteps = torch.linspace(T_rev, t_eps, N, device=Y.device) 
-            else:
-                if stepsize_type=="uniform":
-                    timesteps = torch.linspace(T_rev, T_rev/N, N, device=Y.device)
-                elif stepsize_type=="gerkmann":
-                    timesteps = torch.linspace(T_rev, t_eps, N, device=Y.device)
+            timesteps = schedule.timesteps(T_rev, t_eps, N, Y.device)
             xt = xt.to(Y_prior.device)
-            for i in range(len(timesteps)):
-                t = timesteps[i]
-                if i != len(timesteps) - 1:
-                    stepsize = t - timesteps[i+1]
-                else:
-                    stepsize = timesteps[-1]
-                    if odesolver_name in ['midpoint', 'heun']:
-                        stepsize = timesteps[-1]
-                        if odesolver_name == "heun":
-                            stepsize = timesteps[-1]/2
-                vec_t = torch.ones(Y.shape[0], device=Y.device) * t
-                
-                xt = odesolver.update_fn(xt, vec_t, Y, stepsize)
-            x_result = xt
-            ns = len(timesteps)
+            if cuda_graphs is not None and odesolver_cls.capturable:
+                # the graph depends on the solver, the number of steps and the model, the timesteps are an input
+                x_result = cuda_graphs.run((odesolver_name, len(timesteps), id(VF_fn)), integrate, xt, Y, timesteps)
+            else:
+                x_result = integrate(xt, Y, timesteps)
+            # function evaluations per sample, comparable with those of the adaptive samplers
+            ns = odesolver_cls.num_evaluations(len(timesteps))
             return x_result, ns
     
     return ode_solver
 
+def get_adaptive_solver(
+    odesolver_name, ode, VF_fn, Y, Y_prior=None,
+    T_rev=1.0, t_eps=0.03, rtol=1e-5, atol=1e-5, max_nfe=1000, **kwargs
+):
+    """Sampler that integrates the ODE on the device with an adaptive solver (e.g. 'dopri5') and per-sample
+    error control.
+
+    Returns:
+        A sampling function that returns samples and the number of function evaluations per sample.
+    """
+    odesolver_cls = ODEsolverRegistry.get_by_name(odesolver_name)
+    if not odesolver_cls.adaptive:
+        adaptive_names = [name for name in ODEsolverRegistry.get_all_names() if ODEsolverRegistry.get_by_name(name).adaptive]
+        raise ValueError(f"'{odesolver_name}' is not an adaptive ODE solver, choose one of {', '.join(adaptive_names)}")
+    odesolver = odesolver_cls(ode, VF_fn, rtol=rtol, atol=atol, max_nfe=max_nfe)
+
+    def ode_solver(Y_prior=Y_prior):
+        with torch.no_grad():
+            if Y_prior == None:
+                Y_prior = Y
+            xt, _ = ode.prior_sampling(Y_prior.shape, Y_prior)
+            xt = xt.to(Y_prior.device)
+            return odesolver.solve(xt, Y, T_rev, t_eps)
+
+    return ode_solver
+
 def get_black_box_solver(
     ode, VF_fn, y,  rtol=1e-5, atol=1e-5,  T_rev=1.0, t_eps=0.03, N=30,  method='RK45', device='cuda', **kwargs):
     """Probability flow ODE sampler with the black-box ODE solver.
@@ -115,6 +150,7 @@ def get_black_box_solver(
                 return to_flattened_numpy(drift)
 
             # Black-box ODE solver for the probability flow ODE
+            from scipy import integrate
             solution = integrate.solve_ivp(
                 ode_func, (T_rev, t_eps), to_flattened_numpy(x),
                 rtol=rtol, atol=atol, method=method, **kwargs
@@ -0,0 +1,83 @@
+import warnings
+from collections import OrderedDict
+
+import torch
+
+
+class CUDAGraphCache:
+    """
+    Replays the sampling loop of the white-box sampler from CUDA graphs, one per shape bucket.
+
+    Pass an instance as `cuda_graphs` to `get_white_box_solver` (and through it to `enhance_batch` etc.) and reuse it
+    for all batches. The first batch of every new key (solver, number of steps, input shapes, model) runs eagerly
+    as warm-up and is then captured, with the inputs copied into static buffers; later batches of that key only
+    copy their inputs and replay the graph, which removes the launch overhead of the many small kernels of a step.
+    At most `max_graphs` graphs are kept, the least recently used one is dropped first.
+
+    The loop runs eagerly, with the same results, when the inputs are not on a GPU (so the same code runs on the
+    CPU), when capturing fails, and when the solver cannot be captured (see `ODEsolver.capturable`, e.g. solvers
+    that read values on the host).
+
+    The graphs refer to the model parameters by address: use one cache per model, and do not move the model to
+    another device while the cache is in use.
+    """
+
+    def __init__(self, max_graphs=8, warmup_iters=1):
+        self.max_graphs = max_graphs
+        self.warmup_iters = warmup_iters
+        self.graphs = OrderedDict()
+        self.pool = None
+
+    def __len__(self):
+        return len(self.graphs)
+
+    def clear(self):
+        self.graphs.clear()
+
+    def run(self, key, fn, *inputs):
+        """Return `fn(*inputs)`, replayed from the graph of `key` if there is one. `fn` must only use `inputs` and
+        tensors that stay alive (e.g. model parameters), and `inputs` must all be tensors on one device."""
+        if not inputs[0].is_cuda:
+            return fn(*inputs)
+        key = (key, tuple((tuple(x.shape), x.dtype, x.device) for x in inputs))
+        if key in self.graphs:
+            self.graphs.move_to_end(key)
+            entry = self.graphs[key]
+            if entry is None:
+                return fn(*inputs)
+            graph, static_inputs, static_output = entry
+            for static, x in zip(static_inputs, inputs):
+                static.copy_(x)
+            graph.replay()
+            # the output buffer is overwritten by the next replay
+            return static_output.clone()
+
+        # warm up on a side stream as required before capturing, which also gives the result of this call
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_iters):
+                output = fn(*inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+        self._add(key, self._capture(fn, inputs))
+        return output
+
+    def _capture(self, fn, inputs):
+        if self.pool is None:
+            # all graphs share one memory pool, since they are never replayed concurrently
+            self.pool = torch.cuda.graph_pool_handle()
+        static_inputs = [x.clone() for x in inputs]
+        graph = torch.cuda.CUDAGraph()
+        try:
+            with torch.cuda.graph(graph, pool=self.pool):
+                static_output = fn(*static_inputs)
+        except RuntimeError as e:
+            warnings.warn(f"Capturing a CUDA graph failed, sampling this shape without one: {e}")
+            torch.cuda.synchronize()
+            return None
+        return graph, static_inputs, static_output
+
+    def _add(self, key, entry):
+        self.graphs[key] = entry
+        while len(self.graphs) > self.max_graphs:
+            self.graphs.popitem(last=False)
@@ -0,0 +1,190 @@
+"""
+The white-box sampler for a fixed number of steps and a fixed input shape as one graph.
+
+    python -m flowmse.sampling.export model.safetensors sampler.pt --format torchscript --N 5 --num_frames 256
+    python -m flowmse.sampling.export model.ckpt sampler.onnx --format onnx --N 5 --num_frames 256
+
+`FixedStepSampler` unrolls the N steps of the 'euler', 'midpoint' or 'heun' solver with the timesteps of the schedule
+as constants, and works on real tensors of shape (B, 2, F, T) that hold the real and imaginary part of the
+spectrograms. It can be traced into TorchScript (`trace_sampler`), compiled with `torch.compile` (`compile_sampler`,
+with CUDA graphs on the GPU) or exported to ONNX (`export_onnx`). Every export is checked against the eager
+sampler of `get_white_box_solver` with `check_parity`.
+"""
+from argparse import ArgumentParser
+
+import torch
+
+from .schedules import ScheduleRegistry
+from . import get_white_box_solver
+
+
+SOLVERS = ("euler", "midpoint", "heun")
+
+
+def to_real(X):
+    """(B, 1, F, T) complex -> (B, 2, F, T) real and imaginary part."""
+    return torch.view_as_real(X[:, 0]).permute(0, 3, 1, 2).contiguous()
+
+
+def to_complex(X):
+    """(B, 2, F, T) real and imaginary part -> (B, 1, F, T) complex."""
+    return torch.view_as_complex(X.permute(0, 2, 3, 1).contiguous())[:, None]
+
+
+class FixedStepSampler(torch.nn.Module):
+    """
+    The sampler of `get_white_box_solver` for `N` steps of `odesolver` as a module.
+
+    The prior sample is an input, so the module is deterministic: `forward(x, y)` takes the prior sample x_T and the
+    transformed noisy spectrogram y, both as (B, 2, F, T) real tensors (see `to_real`), and returns the final
+    state in the same form. The steps are the same as those of the eager sampler, including the halved last step of
+    'heun'.
+
+    Args:
+        model: A `VFModel` in eval mode or an `Enhancer`.
+        N: Number of steps.
+        odesolver: 'euler', 'midpoint' or 'heun'.
+        stepsize_type, schedule_kwargs: The timestep schedule, see `flowmse.sampling.schedules`.
+        T_rev, t_eps: Start and end time, those of the model by default.
+    """
+
+    def __init__(self, model, N, odesolver="euler", stepsize_type="uniform", T_rev=None, t_eps=None, **schedule_kwargs):
+        super().__init__()
+        if odesolver not in SOLVERS:
+            raise ValueError(f"Only the {', '.join(SOLVERS)} solvers can be exported, got '{odesolver}'")
+        self.dnn = model.dnn
+        self.odesolver = odesolver
+        self.num_freqs = model.data_module.n_fft // 2 + 1
+        # backbones without `forward_real` are called with complex tensors, which ONNX does not support
+        self.real_backbone = hasattr(self.dnn, "forward_real")
+        T_rev = model.T_rev if T_rev is None else T_rev
+        t_eps = model.t_eps if t_eps is None else t_eps
+        timesteps = ScheduleRegistry.get_by_name(stepsize_type)(model.ode, **schedule_kwargs).timesteps(T_rev, t_eps, N, "cpu")
+
+        # computed in float32 like the eager sampler, and stored as Python numbers to become constants of the graph
+        self.steps = []
+        for i in range(len(timesteps)):
+            t = timesteps[i]
+            if i != len(timesteps) - 1:
+                stepsize = t - timesteps[i+1]
+            else:
+                stepsize = timesteps[-1] / 2 if odesolver == "heun" else timesteps[-1]
+            dt = -stepsize
+            t_next = t + dt if odesolver == "heun" else t + dt/2
+            self.steps.append((t.item(), dt.item(), (dt/2).item(), t_next.item()))
+
+    def _vector_field(self, x, t, y):
+        vec_t = torch.ones(x.shape[0], device=x.device) * t
+        if self.real_backbone:
+            return -self.dnn.forward_real(torch.cat([x, y], dim=1), vec_t)
+        return -to_real(self.dnn(torch.cat([to_complex(x), to_complex(y)], dim=1), vec_t))
+
+    def forward(self, x, y):
+        for t, dt, half_dt, t_next in self.steps:
+            if self.odesolver == "euler":
+                x = x + self._vector_field(x, t, y) * dt
+            elif self.odesolver == "midpoint":
+                x = x + dt * self._vector_field(x + half_dt * self._vector_field(x, t, y), t_next, y)
+            else:
+                current_vectorfield = self._vector_field(x, t, y)
+                x_next = x + dt * current_vectorfield
+                x = x + half_dt * (current_vectorfield + self._vector_field(x_next, t_next, y))
+        return x
+
+
+def _example_inputs(sampler, batch_size, num_frames, device):
+    x = torch.randn(batch_size, 2, sampler.num_freqs, num_frames, device=device)
+    return x, torch.randn_like(x)
+
+
+def trace_sampler(sampler, batch_size, num_frames, device="cpu"):
+    """Trace `sampler` into TorchScript for inputs of `batch_size` x `num_frames` frames."""
+    with torch.no_grad():
+        return torch.jit.trace(sampler, _example_inputs(sampler, batch_size, num_frames, device), check_trace=False)
+
+
+def compile_sampler(sampler, mode=None):
+    """
+    `torch.compile` the sampler (PyTorch >= 2.0). The default mode is 'reduce-overhead' on the GPU, which replays
+    the whole sampler as CUDA graphs, and 'default' on the CPU. Compilation happens on the first call for each
+    input shape.
+    """
+    if mode is None:
+        mode = "reduce-overhead" if next(sampler.parameters()).is_cuda else "default"
+    return torch.compile(sampler, mode=mode, fullgraph=True)
+
+
+def export_onnx(sampler, file, batch_size, num_frames, opset_version=17):
+    """Export `sampler` to ONNX, with inputs 'x' (prior sample) and 'y' and output 'x0' of fixed shape."""
+    if not sampler.real_backbone:
+        raise ValueError("ONNX export requires a backbone with `forward_real`, since ONNX has no complex tensors")
+    device = next(sampler.parameters()).device
+    with torch.no_grad():
+        torch.onnx.export(
+            sampler, _example_inputs(sampler, batch_size, num_frames, device), file, input_names=["x", "y"],
+            output_names=["x0"], opset_version=opset_version
+        )
+
+
+def check_parity(run_graph, model, Y, N, odesolver="euler", stepsize_type="uniform", seed=0, **sampler_kwargs):
+    """
+    Compare an exported sampler with the eager sampler of `get_white_box_solver` on the same prior sample.
+
+    Args:
+        run_graph: A function from the prior sample and y in real form (see `to_real`) to the final state, e.g. a
+            traced or compiled `FixedStepSampler`. It may return a numpy array.
+        Y: A batch of transformed noisy spectrograms (B, 1, F, T), complex.
+
+    Returns:
+        The maximum absolute difference and the maximum absolute value of the eager result.
+    """
+    sampler_kwargs = dict(T_rev=model.T_rev, t_eps=model.t_eps, **sampler_kwargs)
+    with torch.no_grad():
+        torch.manual_seed(seed)
+        eager, _ = get_white_box_solver(odesolver, model.ode, model, Y, N=N, stepsize_type=stepsize_type, **sampler_kwargs)()
+        # the eager sampler draws its prior sample first, so the same seed gives the same one
+        torch.manual_seed(seed)
+        x, _ = model.ode.prior_sampling(Y.shape, Y)
+        exported = to_complex(torch.as_tensor(run_graph(to_real(x), to_real(Y))).to(Y.device))
+    return (exported - eager).abs().max().item(), eager.abs().max().item()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Export the white-box sampler for a fixed number of steps and input shape.")
+    parser.add_argument("model", type=str, help="A VFModel checkpoint (.ckpt) or an artifact of `python -m flowmse.enhancer`.")
+    parser.add_argument("output", type=str, help="The TorchScript (.pt) or ONNX (.onnx) file to write.")
+    parser.add_argument("--format", type=str, choices=("torchscript", "onnx"), default="torchscript", help="'torchscript' by default.")
+    parser.add_argument("--odesolver", type=str, choices=SOLVERS, default="euler", help="'euler' by default.")
+    parser.add_argument("--N", type=int, default=5, help="Number of steps. 5 by default.")
+    parser.add_argument("--stepsize_type", type=str, default="uniform", choices=ScheduleRegistry.get_all_names(), help="Timestep schedule. 'uniform' by default.")
+    parser.add_argument("--rho", type=float, default=7., help="Exponent of the 'karras' schedule. 7 by default.")
+    parser.add_argument("--schedule_file", type=str, default=None, help="JSON file of the 'json' schedule.")
+    parser.add_argument("--batch_size", type=int, default=1, help="Batch size of the graph. 1 by default.")
+    parser.add_argument("--num_frames", type=int, default=256, help="Number of STFT frames of the graph, a multiple of 64. 256 by default.")
+    parser.add_argument("--device", type=str, default="cpu", help="'cpu' by default.")
+    args = parser.parse_args()
+
+    if args.model.endswith(".ckpt"):
+        from flowmse.model import VFModel
+        model = VFModel.load_from_checkpoint(args.model, base_dir="", map_location="cpu")
+        model.eval(no_ema=False)
+        model.to(args.device)
+    else:
+        from flowmse.enhancer import load_enhancer
+        model = load_enhancer(args.model, args.device)
+
+    schedule_kwargs = dict(rho=args.rho, schedule_file=args.schedule_file)
+    sampler = FixedStepSampler(model, args.N, args.odesolver, args.stepsize_type, **schedule_kwargs).eval()
+    if args.format == "torchscript":
+        graph = trace_sampler(sampler, args.batch_size, args.num_frames, args.device)
+        graph.save(args.output)
+        run_graph = torch.jit.load(args.output, map_location=args.device)
+    else:
+        import onnxruntime
+        export_onnx(sampler, args.output, args.batch_size, args.num_frames)
+        session = onnxruntime.InferenceSession(args.output, providers=["CPUExecutionProvider"])
+        run_graph = lambda x, y: session.run(["x0"], {"x": x.cpu().numpy(), "y": y.cpu().numpy()})[0]
+
+    Y = to_complex(_example_inputs(sampler, args.batch_size, args.num_frames, args.device)[1])
+    error, scale = check_parity(run_graph, model, Y, args.N, args.odesolver, args.stepsize_type, **schedule_kwargs)
+    print(f"Wrote {args.output}. Max. abs. difference to the eager sampler: {error:.3g} (max. abs. value {scale:.3g})")
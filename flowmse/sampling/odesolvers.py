@@ -10,7 +10,12 @@ ODEsolverRegistry = Registry("ODEsolver")
 
 
 class ODEsolver(abc.ABC):
-    
+    # whether `update_fn` only launches work on the device, i.e. can be captured into a CUDA graph
+    capturable = True
+    # whether the solver has an adaptive `solve(x, y, T_rev, t_eps)`, see `get_adaptive_solver`
+    adaptive = False
+    # calls of `VF_fn` per `update_fn`
+    nfe_per_step = 1
 
     def __init__(self, ode, VF_fn):
         super().__init__()
@@ -33,6 +38,10 @@ class ODEsolver(abc.ABC):
         """
         pass
 
+    @classmethod
+    def num_evaluations(cls, num_steps):
+        """Number of calls of `VF_fn` for a trajectory of `num_steps` calls of `update_fn`."""
+        return num_steps * cls.nfe_per_step
 
 @ODEsolverRegistry.register('euler')
 class EulerODEsolver(ODEsolver):
@@ -49,6 +58,8 @@ class EulerODEsolver(ODEsolver):
 
 @ODEsolverRegistry.register('midpoint')
 class MidpointODEsolver(ODEsolver):
+    nfe_per_step = 2
+
     def __init__(self, ode, VF_fn):
         super().__init__(ode, VF_fn)
 
@@ -61,6 +72,8 @@ class MidpointODEsolver(ODEsolver):
     
 @ODEsolverRegistry.register('heun')
 class HeunODEsolver(ODEsolver):
+    nfe_per_step = 2
+
     def __init__(self, ode, VF_fn):
         super().__init__(ode, VF_fn)
 
@@ -72,3 +85,244 @@ class HeunODEsolver(ODEsolver):
         
         return x
     
+
+@ODEsolverRegistry.register('dopri5')
+class DormandPrinceODEsolver(ODEsolver):
+    """
+    Dormand-Prince 5(4) Runge-Kutta solver, running on the device of the state.
+
+    `update_fn` takes a single fixed step (7 function evaluations) and can be used like the other solvers,
+    while `solve` integrates adaptively with a separate step size and error control for every sample of a batch,
+    reusing the last evaluation of a step as the first of the next (6 per step).
+    """
+    adaptive = True
+    nfe_per_step = 7
+
+    # Butcher tableau, see Dormand & Prince (1980)
+    A = [
+        [],
+        [1/5],
+        [3/40, 9/40],
+        [44/45, -56/15, 32/9],
+        [19372/6561, -25360/2187, 64448/6561, -212/729],
+        [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+        [35/384, 0., 500/1113, 125/192, -2187/6784, 11/84],
+    ]
+    C = [0., 1/5, 3/10, 4/5, 8/9, 1., 1.]
+    # difference between the 5th and the embedded 4th order weights
+    E = [71/57600, 0., -71/16695, 71/1920, -17253/339200, 22/525, -1/40]
+
+    def __init__(self, ode, VF_fn, rtol=1e-5, atol=1e-5, max_nfe=1000, safety=0.9):
+        super().__init__(ode, VF_fn)
+        self.rtol = rtol
+        self.atol = atol
+        self.max_nfe = max_nfe
+        self.safety = safety
+
+    def _step(self, x, t, y, dt, k1):
+        """One step of size `dt` (per sample) from `x` at time `t`. Returns the new state, its error estimate and
+        the vector field at the new state, which is the first stage of the next step (FSAL)."""
+        dt = dt[:, None, None, None]
+        ks = [k1]
+        for i in range(1, 7):
+            x_stage = x + dt * sum(a * k for a, k in zip(self.A[i], ks) if a != 0)
+            ks.append(self.VF_fn(x_stage, t + self.C[i] * dt[:, 0, 0, 0], y))
+        x_next = x_stage  # the last stage is evaluated at the 5th order solution
+        err = dt * sum(e * k for e, k in zip(self.E, ks) if e != 0)
+        return x_next, err, ks[-1]
+
+    def update_fn(self, x, t, y, stepsize, *args):
+        dt = -stepsize * torch.ones_like(t)
+        x, _, _ = self._step(x, t, y, dt, self.VF_fn(x, t, y))
+        return x
+
+    def _error_norm(self, err, x, x_next):
+        scale = self.atol + self.rtol * torch.maximum(x.abs(), x_next.abs())
+        return torch.sqrt(torch.mean((err.abs() / scale).reshape(err.shape[0], -1)**2, dim=-1))
+
+    def solve(self, x, y, T_rev, t_eps):
+        """
+        Integrate from `T_rev` down to `t_eps` with adaptive step sizes.
+
+        Samples that reached `t_eps` are dropped from the batch of the following network calls. A sample that could not
+        take another step within its budget of `max_nfe` function evaluations takes its last step straight to
+        `t_eps`, so the budget is never exceeded (as long as it allows at least one step).
+
+        Returns:
+            The final state and the number of function evaluations per sample.
+        """
+        x = x.clone()
+        B = x.shape[0]
+        t = torch.full((B,), T_rev, device=x.device)
+        nfe = torch.ones(B, dtype=torch.long, device=x.device)
+        k1 = self.VF_fn(x, t, y)
+
+        # initial step size, as in Hairer et al., Solving ODEs I, without the second derivative estimate
+        scale = self.atol + self.rtol * x.abs()
+        d0 = torch.sqrt(torch.mean((x.abs() / scale).reshape(B, -1)**2, dim=-1))
+        d1 = torch.sqrt(torch.mean((k1.abs() / scale).reshape(B, -1)**2, dim=-1))
+        h = torch.where((d0 > 1e-5) & (d1 > 1e-5), 0.01 * d0 / d1, torch.full_like(d0, 1e-6))
+        h = torch.minimum(h, t - t_eps)
+
+        active = torch.arange(B, device=x.device)
+        while len(active) > 0:
+            x_a, t_a, k1_a = x[active], t[active], k1[active]
+            remaining = t_a - t_eps
+            # take the last step if there is no budget left for another one after it
+            last = nfe[active] + 12 > self.max_nfe
+            h_a = torch.where(last, remaining, torch.minimum(h[active], remaining))
+
+            x_next, err, k7 = self._step(x_a, t_a, y[active], -h_a, k1_a)
+            nfe[active] += 6
+            err_norm = self._error_norm(err, x_a, x_next)
+            accept = (err_norm <= 1) | last
+
+            factor = torch.clamp(self.safety * err_norm.clamp(min=1e-10)**(-1/5), 0.2, 10.)
+            h[active] = h_a * torch.where(accept, factor, torch.clamp(factor, max=1.))
+
+            accepted = active[accept]
+            x[accepted] = x_next[accept]
+            k1[accepted] = k7[accept]
+            t[accepted] = torch.where(h_a >= remaining, torch.full_like(t_a, t_eps), t_a - h_a)[accept]
+            active = active[t[active] > t_eps]
+        return x, nfe
+
+
+class MultistepODEsolver(ODEsolver):
+    """
+    Base class of linear multistep solvers, which reuse the vector field of the previous steps so that every
+    step costs a single function evaluation. The first steps, until enough history is available, are taken
+    as defined by the subclass. The history belongs to one trajectory: `get_white_box_solver` builds a new
+    solver for every run.
+    """
+    order = 2
+
+    def __init__(self, ode, VF_fn):
+        super().__init__(ode, VF_fn)
+        self.history = []
+
+    def _push(self, t, value):
+        self.history.insert(0, (t, value))
+        del self.history[self.order:]
+
+
+class AdamsBashforthODEsolver(MultistepODEsolver):
+    """
+    Adams-Bashforth solver of order `order` for arbitrary step sizes: the vector fields at the previous times
+    are interpolated by a polynomial, which is integrated over the next step.
+
+    The first `order - 1` steps, before enough history is available, are explicit Runge-Kutta steps of order
+    `order - 1` (Euler, Ralston's second and third order methods), so that the global order is `order`. They cost
+    `order - 2` extra function evaluations each, see `num_evaluations`.
+    """
+    # the weights are computed from the times on the host
+    capturable = False
+    # explicit Runge-Kutta methods of the starting steps by order, as (A, C, B) of their Butcher tableau. None of
+    # their stages is at the end of the step, which is t = 0 for the last step of the sampler.
+    STARTERS = {
+        1: ([], [0.], [1.]),
+        2: ([[2/3]], [0., 2/3], [1/4, 3/4]),
+        3: ([[1/2], [0., 3/4]], [0., 1/2, 3/4], [2/9, 1/3, 4/9]),
+    }
+
+    @classmethod
+    def num_evaluations(cls, num_steps):
+        return num_steps + min(num_steps, cls.order - 1) * (cls.order - 2)
+
+    @staticmethod
+    def _weights(times, t_next):
+        # integrals of the Lagrange basis polynomials over [times[0], t_next], relative to times[0]
+        t_next = t_next - times[0]
+        times = [tau - times[0] for tau in times]
+        weights = []
+        for j, tau_j in enumerate(times):
+            basis = np.poly1d([1.])
+            for m, tau_m in enumerate(times):
+                if m != j:
+                    basis = basis * np.poly1d([1., -tau_m]) / (tau_j - tau_m)
+            weights.append(basis.integ()(t_next))
+        return weights
+
+    def update_fn(self, x, t, y, stepsize, *args):
+        t_now = float(t[0])
+        self._push(t_now, self.VF_fn(x, t, y))
+        if len(self.history) < self.order:
+            return self._starting_step(x, t, y, stepsize)
+        times = [tau for tau, _ in self.history]
+        weights = self._weights(times, t_now - float(stepsize))
+        return x + sum(w * vectorfield for w, (_, vectorfield) in zip(weights, self.history))
+
+    def _starting_step(self, x, t, y, stepsize):
+        # the first stage is the vector field just pushed to the history
+        A, C, B = self.STARTERS[self.order - 1]
+        dt = -stepsize
+        ks = [self.history[0][1]]
+        for a, c in zip(A, C[1:]):
+            ks.append(self.VF_fn(x + dt * sum(a_j * k for a_j, k in zip(a, ks)), t + c * dt, y))
+        return x + dt * sum(b * k for b, k in zip(B, ks))
+
+
+@ODEsolverRegistry.register('ab2')
+class AdamsBashforth2ODEsolver(AdamsBashforthODEsolver):
+    order = 2
+
+
+@ODEsolverRegistry.register('ab3')
+class AdamsBashforth3ODEsolver(AdamsBashforthODEsolver):
+    order = 3
+
+
+@ODEsolverRegistry.register('ab4')
+class AdamsBashforth4ODEsolver(AdamsBashforthODEsolver):
+    order = 4
+
+
+@ODEsolverRegistry.register('dpmpp2m')
+class DPMSolverPlusPlus2MODEsolver(MultistepODEsolver):
+    """
+    Second order multistep solver in the style of DPM-Solver++(2M) (Lu et al., 2022).
+
+    For ODEs whose marginal has the mean `a_t x0 + (1-a_t) y` (all interpolants in `flowmse/odes.py`
+    except 'stochasticinterpolant'), `u = x - y` follows `u_t = a_t (x0 - y) + sigma_t z` like a diffusion
+    model. The vector field is turned into a prediction of `x0 - y`, and the linear part of the ODE is
+    integrated exactly in `lambda = log(a_t / sigma_t)`, with the prediction extrapolated linearly from the
+    previous step. Requires `sigma_t > 0` at all evaluated times.
+    """
+    order = 2
+    # the checks of the ODE coefficients read values on the host
+    capturable = False
+
+    def _coefficients(self, t, x):
+        one = torch.ones((t.shape[0], 1, 1, 1), device=x.device)
+        a = self.ode._mean(one, t, 0 * one)
+        if not torch.allclose(a + self.ode._mean(0 * one, t, one), one):
+            raise NotImplementedError(f"{self.__class__.__name__} requires an ODE with mean a_t x0 + (1-a_t) y")
+        sigma = self.ode._std(t).to(one)[:, None, None, None]
+        return a, sigma
+
+    def update_fn(self, x, t, y, stepsize, *args):
+        vectorfield = self.VF_fn(x, t, y)
+        a_t, sigma_t = self._coefficients(t, x)
+        a_s, sigma_s = self._coefficients(t - stepsize, x)
+        if torch.any(sigma_t <= 0):
+            raise ValueError(f"{self.__class__.__name__} requires sigma_t > 0, got {sigma_t.min().item()} at t={t.min().item()}")
+
+        # solve u = a d + sigma z, v = da d + dsigma z for the prediction d of x0 - y
+        one = torch.ones_like(a_t)
+        da = self.ode.der_mean(one, t, 0 * one)
+        dsigma = self.ode.der_std(t)
+        u = x - y
+        d = (dsigma * u - sigma_t * vectorfield) / (dsigma * a_t - sigma_t * da)
+
+        # exp(-h) with h = lambda_s - lambda_t, written as a ratio so that a_t = 0 and sigma_s = 0 are handled
+        ratio = (a_t * sigma_s) / (sigma_t * a_s)
+        h = -torch.log(ratio)
+        D = d
+        if self.history:
+            h_prev, d_prev = self.history[0]
+            r = h_prev / h
+            # fall back to first order when the previous or the current step is infinite in lambda
+            valid = torch.isfinite(r) & (r > 0)
+            D = d + torch.where(valid, 1 / (2 * r.clamp(min=1e-12)), torch.zeros_like(r)) * (d - d_prev)
+        self._push(h, d)
+        return sigma_s / sigma_t * u - a_s * (ratio - 1) * D + y
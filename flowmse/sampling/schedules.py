@@ -0,0 +1,223 @@
+import abc
+import json
+import math
+
+import numpy as np
+import torch
+
+from flowmse.util.registry import Registry
+
+
+ScheduleRegistry = Registry("Schedule")
+
+
+class Schedule(abc.ABC):
+    """
+    Timestep schedule of the white-box samplers: `timesteps` returns the N times at which the vector field is
+    evaluated, from `T_rev` downwards. The sampler takes its last step from the last of them to 0.
+    """
+
+    def __init__(self, ode, **ignored_kwargs):
+        super().__init__()
+        self.ode = ode
+
+    @abc.abstractmethod
+    def timesteps(self, T_rev, t_eps, N, device):
+        pass
+
+
+def _monotone_grid(fn, T_rev, t_eps, num_grid=10001):
+    """
+    A dense grid of times from t_eps upwards and the values of `fn` of t on it, on which `fn` is finite and strictly
+    monotone, or None if there is none. The grid ends early where `fn` stops being finite or monotone just below
+    T_rev, as long as it covers 99% of [t_eps, T_rev]: e.g. the std of BBED is NaN at t=1, and its log-SNR turns
+    where the clamped mean takes over.
+    """
+    t = torch.linspace(t_eps, T_rev, num_grid, dtype=torch.float64)
+    f = fn(t).double().numpy()
+    t = t.numpy()
+    direction = np.sign(f[1] - f[0])
+    if not np.all(np.isfinite(f[:2])) or direction == 0:
+        return None
+    valid = np.isfinite(f[1:]) & (np.sign(np.diff(f)) == direction)
+    end = num_grid if valid.all() else np.argmin(valid) + 1
+    if t[end-1] < T_rev - 0.01 * (T_rev - t_eps):
+        return None
+    return t[:end], f[:end]
+
+
+def _invert(values, t, f):
+    """Times at which the strictly monotone function with values `f` on the grid `t` takes `values`."""
+    if f[-1] < f[0]:
+        t, f = t[::-1], f[::-1]
+    return np.interp(values, f, t)
+
+
+def _grid_or_raise(name, ode, fn_of_ode, T_rev, t_eps):
+    """The `_monotone_grid` of `fn_of_ode(ode)`, or a ValueError that names the ODEs the schedule `name` supports."""
+    grid = _monotone_grid(fn_of_ode(ode), T_rev, t_eps)
+    if grid is not None:
+        return grid
+    # imported here, the ODEs are only needed for the error message
+    import argparse
+    import warnings
+    from flowmse.odes import ODERegistry
+    ode_name, supported = type(ode).__name__, []
+    for registered in ODERegistry.get_all_names():
+        ode_cls = ODERegistry.get_by_name(registered)
+        if type(ode) is ode_cls:
+            ode_name = registered
+        defaults = vars(ode_cls.add_argparse_args(argparse.ArgumentParser()).parse_args([]))
+        with warnings.catch_warnings(), np.errstate(all="ignore"):
+            warnings.simplefilter("ignore")
+            if _monotone_grid(fn_of_ode(ode_cls(**defaults)), T_rev, t_eps) is not None:
+                supported.append(registered)
+    raise ValueError(
+        f"The '{name}' schedule is not defined for the '{ode_name}' ODE on [{t_eps}, {T_rev}], it supports the "
+        f"ODEs {', '.join(supported)}"
+    )
+
+
+def _log_snr(ode, t, min_mean=1e-3):
+    # the mean coefficient of x0 vanishes at t=1 for some ODEs, so it is clamped to keep log(a_t/sigma_t) finite
+    one = torch.ones((t.shape[0], 1, 1, 1), dtype=t.dtype)
+    a = ode._mean(one, t, 0 * one)[:, 0, 0, 0].clamp(min=min_mean)
+    return torch.log(a) - torch.log(ode._std(t).to(a))
+
+
+@ScheduleRegistry.register('uniform')
+class UniformSchedule(Schedule):
+    """N uniform steps from T_rev to T_rev/N."""
+
+    def timesteps(self, T_rev, t_eps, N, device):
+        return torch.linspace(T_rev, T_rev/N, N, device=device)
+
+
+@ScheduleRegistry.register('gerkmann')
+class GerkmannSchedule(Schedule):
+    """N uniformly spaced times from T_rev to t_eps."""
+
+    def timesteps(self, T_rev, t_eps, N, device):
+        return torch.linspace(T_rev, t_eps, N, device=device)
+
+
+@ScheduleRegistry.register('karras')
+class KarrasSchedule(Schedule):
+    """
+    EDM schedule (Karras et al., 2022): the noise levels sigma_t are spaced uniformly in sigma^(1/rho), which
+    concentrates the steps at low noise levels. Requires sigma_t to be monotone on [t_eps, T_rev], see
+    `_monotone_grid`.
+    """
+
+    def __init__(self, ode, rho=7., **ignored_kwargs):
+        super().__init__(ode)
+        self.rho = rho
+
+    def timesteps(self, T_rev, t_eps, N, device):
+        grid, std = _grid_or_raise("karras", self.ode, lambda ode: ode._std, T_rev, t_eps)
+        sigma_max, sigma_min = std[-1], std[0]
+        ramp = np.linspace(0, 1, N)
+        sigmas = (sigma_max**(1/self.rho) + ramp * (sigma_min**(1/self.rho) - sigma_max**(1/self.rho)))**self.rho
+        t = _invert(sigmas, grid, std)
+        t[0], t[-1] = T_rev, t_eps
+        return torch.tensor(t, dtype=torch.float32, device=device)
+
+
+@ScheduleRegistry.register('cosine')
+class CosineSchedule(Schedule):
+    """Times from T_rev to t_eps spaced like a half cosine, i.e. denser at both ends."""
+
+    def timesteps(self, T_rev, t_eps, N, device):
+        ramp = torch.linspace(0, 1, N, dtype=torch.float64)
+        t = t_eps + (T_rev - t_eps) * (1 + torch.cos(math.pi * ramp)) / 2
+        return t.to(dtype=torch.float32, device=device)
+
+
+@ScheduleRegistry.register('logsnr')
+class LogSNRSchedule(Schedule):
+    """
+    Times spaced uniformly in log(a_t / sigma_t), where a_t is the weight of x0 in the mean of the ODE (half the
+    log-SNR). Requires it to be monotone on [t_eps, T_rev], see `_monotone_grid`.
+    """
+
+    def timesteps(self, T_rev, t_eps, N, device):
+        grid, log_snr = _grid_or_raise("logsnr", self.ode, lambda ode: (lambda t: _log_snr(ode, t)), T_rev, t_eps)
+        lambdas = np.linspace(log_snr[-1], log_snr[0], N)
+        t = _invert(lambdas, grid, log_snr)
+        t[0], t[-1] = T_rev, t_eps
+        return torch.tensor(t, dtype=torch.float32, device=device)
+
+
+@ScheduleRegistry.register('json')
+class JSONSchedule(Schedule):
+    """
+    Data-driven schedule loaded from `schedule_file`, e.g. as written by `preprocess.py schedule`.
+
+    The file holds explicit timesteps per number of steps (`{"timesteps": {"5": [...]}}`) and/or a step density on a
+    grid of times (`{"t": [...], "density": [...]}`). For an N without explicit timesteps, the times are placed
+    so that each step covers the same integral of the density.
+    """
+
+    def __init__(self, ode, schedule_file=None, **ignored_kwargs):
+        super().__init__(ode)
+        if schedule_file is None:
+            raise ValueError("The 'json' schedule requires a schedule_file")
+        with open(schedule_file) as f:
+            self.schedule = json.load(f)
+
+    def timesteps(self, T_rev, t_eps, N, device):
+        if str(N) in self.schedule.get("timesteps", {}):
+            return torch.tensor(self.schedule["timesteps"][str(N)], dtype=torch.float32, device=device)
+        if "density" not in self.schedule:
+            raise ValueError(f"The schedule file has neither timesteps for N={N} nor a step density")
+        t = np.asarray(self.schedule["t"], dtype=np.float64)
+        density = np.asarray(self.schedule["density"], dtype=np.float64)
+        order = np.argsort(t)
+        t, density = t[order], density[order]
+        # cumulative density from t_eps upwards, clipped to the requested interval
+        grid = np.linspace(t_eps, T_rev, 10001)
+        cumulative = np.concatenate([[0], np.cumsum((np.interp(grid[1:], t, density) + np.interp(grid[:-1], t, density)) / 2 * np.diff(grid))])
+        targets = np.linspace(cumulative[-1], 0, N)
+        timesteps = np.interp(targets, cumulative, grid)
+        timesteps[0], timesteps[-1] = T_rev, t_eps
+        return torch.tensor(timesteps, dtype=torch.float32, device=device)
+
+
+def fit_step_density(ode, VF_fn, Y, T_rev, t_eps, num_steps=200, floor=1e-2):
+    """
+    Estimate where a few-step sampler makes the largest local errors.
+
+    Integrates a fine reference trajectory with `num_steps` Euler steps from `T_rev` to `t_eps` and measures the
+    change of the vector field along it. The local error of a step of size h is about h^2 |dv/dt| / 2, so
+    steps taken with a density proportional to sqrt(|dv/dt|) give every step the same local error.
+
+    Args:
+        ode: The ODE of the model.
+        VF_fn: The vector field, typically the model.
+        Y: A batch of (transformed, padded) noisy calibration spectrograms.
+        floor: Lower bound of the density relative to its mean, so that no region is skipped entirely.
+
+    Returns:
+        The grid of times and the step density on it, as lists.
+    """
+    with torch.no_grad():
+        xt, _ = ode.prior_sampling(Y.shape, Y)
+        timesteps = torch.linspace(T_rev, t_eps, num_steps + 1, device=Y.device)
+        vectorfields = []
+        for i in range(num_steps + 1):
+            vec_t = torch.ones(Y.shape[0], device=Y.device) * timesteps[i]
+            vectorfield = VF_fn(xt, vec_t, Y)
+            vectorfields.append(vectorfield)
+            if i < num_steps:
+                xt = xt + (timesteps[i+1] - timesteps[i]) * vectorfield
+
+    t = ((timesteps[1:] + timesteps[:-1]) / 2).cpu().numpy()
+    dt = (timesteps[:-1] - timesteps[1:]).cpu().numpy()
+    change = np.array([
+        # RMS of dv/dt over the elements, averaged over the batch
+        torch.sqrt(torch.mean((v_next - v).abs().reshape(Y.shape[0], -1)**2, dim=-1)).mean().item()
+        for v, v_next in zip(vectorfields[:-1], vectorfields[1:])
+    ]) / dt
+    density = np.sqrt(change)
+    density = np.maximum(density, floor * density.mean())
+    return t.tolist(), density.tolist()
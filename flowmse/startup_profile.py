@@ -0,0 +1,137 @@
+"""
+Break down the cold-start time of flowmse into module imports and the loading of a checkpoint.
+
+    python -m flowmse.startup_profile [--modules flowmse.sampling ...] [--ckpt path/to/model.ckpt]
+    python -m flowmse.startup_profile --modules --enhancer path/to/model.safetensors
+
+Every module is imported in a fresh interpreter with `python -X importtime`, so the times do not depend on what
+was imported before. The checkpoint stages are timed in this process, after the imports.
+"""
+import re
+import resource
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+
+
+DEFAULT_MODULES = [
+    "torch", "flowmse.odes", "flowmse.sampling", "flowmse.backbones", "flowmse.util.inference",
+    "flowmse.data_module", "flowmse.model",
+]
+
+
+def import_profile(module):
+    """
+    Import `module` in a fresh interpreter.
+
+    Returns:
+        The total import time in seconds and the import time (excluding subpackages imported from outside the
+        package) per top-level package, e.g. {'torch': 1.2, 'scipy': 0.4, ...}.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    total = 0.
+    self_times = defaultdict(float)
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)", line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        self_times[name.split('.')[0]] += int(self_us) / 1e6
+        if len(indent) == 1:
+            # a module imported directly by the statement, the others are nested in it
+            total += int(cumulative_us) / 1e6
+    return total, dict(self_times)
+
+
+def _print_stages(title, stages):
+    print(title)
+    for name, seconds in stages:
+        print(f"  {name:<26} {seconds:7.3f} s")
+    print(f"  {'total':<26} {sum(s for _, s in stages):7.3f} s")
+    # ru_maxrss is in kilobytes on Linux
+    print(f"  {'peak resident memory':<26} {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:7.0f} MB")
+
+
+def checkpoint_profile(ckpt, device="cpu"):
+    """Time the stages of loading a `VFModel` checkpoint and of its first forward pass. Returns (stage, seconds) pairs."""
+    stages = []
+
+    def stage(name, start):
+        stages.append((name, time.time() - start))
+        return time.time()
+
+    start = time.time()
+    import torch
+    from flowmse.model import VFModel
+    start = stage("import flowmse.model", start)
+
+    checkpoint = torch.load(ckpt, map_location="cpu")
+    start = stage("torch.load", start)
+
+    model = VFModel(**{**checkpoint["hyper_parameters"], "base_dir": ""})
+    start = stage("build VFModel", start)
+
+    model.on_load_checkpoint(checkpoint)
+    model.load_state_dict(checkpoint["state_dict"])
+    start = stage("load state dict + EMA", start)
+
+    model.to(device)
+    model.eval(no_ema=False)
+    start = stage(f"to({device}) + eval", start)
+
+    _first_forward(model, device)
+    stage("first forward pass", start)
+    return stages
+
+
+def enhancer_profile(file, device="cpu"):
+    """Time the stages of loading an artifact of `flowmse.enhancer` and of its first forward pass."""
+    stages = []
+    start = time.time()
+    from flowmse.enhancer import load_enhancer
+    stages.append(("import flowmse.enhancer", time.time() - start))
+
+    start = time.time()
+    model = load_enhancer(file, device)
+    stages.append(("load_enhancer", time.time() - start))
+
+    start = time.time()
+    _first_forward(model, device)
+    stages.append(("first forward pass", time.time() - start))
+    return stages
+
+
+def _first_forward(model, device):
+    import torch
+    with torch.no_grad():
+        Y = torch.zeros(1, 1, model.data_module.n_fft // 2 + 1, 64, dtype=torch.complex64, device=device)
+        t = torch.full((1,), model.T_rev, device=device)
+        model(Y, t, Y)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modules", type=str, nargs="*", default=DEFAULT_MODULES, help="Modules whose import is profiled.")
+    parser.add_argument("--top", type=int, default=6, help="Number of packages listed per module. 6 by default.")
+    parser.add_argument("--ckpt", type=str, default=None, help="Also profile loading this checkpoint.")
+    parser.add_argument("--enhancer", type=str, default=None, help="Also profile loading this artifact of `flowmse.enhancer`. Profile it without --ckpt to get its resident memory.")
+    parser.add_argument("--device", type=str, default="cpu", help="Device for the checkpoint profile. 'cpu' by default.")
+    args = parser.parse_args()
+
+    if args.modules:
+        print("Import time (fresh interpreter per module)")
+    for module in args.modules:
+        total, self_times = import_profile(module)
+        top = sorted(self_times.items(), key=lambda item: -item[1])[:args.top]
+        print(f"  {module:<26} {total:7.3f} s   " + ", ".join(f"{name} {seconds:.3f}" for name, seconds in top))
+
+    if args.enhancer is not None:
+        _print_stages(f"Enhancer load ({args.enhancer})", enhancer_profile(args.enhancer, args.device))
+    if args.ckpt is not None:
+        _print_stages(f"Checkpoint load ({args.ckpt})", checkpoint_profile(args.ckpt, args.device))
@@ -1,11 +1,12 @@
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from math import ceil
+
 import torch
-from torchaudio import load
 import torch.nn.functional as F
-from pesq import pesq
-from pystoi import stoi
 
-from .other import si_sdr, pad_spec
-from ..sampling import get_white_box_solver
+from .other import energy_ratios, si_sdr, pad_spec
+from ..sampling import get_white_box_solver, get_black_box_solver, get_adaptive_solver
 # Settings
 sr = 16000
 snr = 0.5
@@ -13,65 +14,278 @@ snr = 0.5
 
 N=5
 
-def evaluate_model(model, num_eval_files, inference_N=30):
-    T_rev = model.T_rev
-    model.ode.T_rev = T_rev
-    t_eps = model.t_eps
-    clean_files = model.data_module.valid_set.clean_files
-    noisy_files = model.data_module.valid_set.noisy_files
-    
-    # Select test files uniformly accros validation files
-    total_num_files = len(clean_files)
-    indices = torch.linspace(0, total_num_files-1, num_eval_files, dtype=torch.int)
-    clean_files = list(clean_files[i] for i in indices)
-    noisy_files = list(noisy_files[i] for i in indices)
 
+def padded_num_frames(num_samples, hop_length, multiple=64):
+    """Number of STFT frames (center=True) of a signal after `pad_spec`."""
+    num_frames = num_samples // hop_length + 1
+    return int(ceil(num_frames / multiple) * multiple)
+
+
+def bucket_by_frames(lengths, hop_length, batch_size):
+    """
+    Group utterance indices into batches whose members pad to the same number of STFT frames.
+
+    Args:
+        lengths: Number of samples of each utterance.
+        hop_length: STFT hop length.
+        batch_size: Maximum number of utterances per batch.
+
+    Returns:
+        A list of lists of indices into `lengths`.
+    """
+    buckets = {}
+    for idx, length in enumerate(lengths):
+        buckets.setdefault(padded_num_frames(length, hop_length), []).append(idx)
+    batches = []
+    for num_frames in sorted(buckets):
+        indices = buckets[num_frames]
+        for start in range(0, len(indices), batch_size):
+            batches.append(indices[start:start+batch_size])
+    return batches
+
+
+def _sample(model, Y, odesolver_type, odesolver, **sampler_kwargs):
+    """Run the sampler of the given type on the batch `Y`. Returns the samples and a list of NFE per item."""
+    if odesolver_type == "white":
+        sampler = get_white_box_solver(odesolver, model.ode, model, Y, **sampler_kwargs)
+    elif odesolver_type == "black":
+        sampler = get_black_box_solver(model.ode, model, Y, device=model.device, **sampler_kwargs)
+    elif odesolver_type == "adaptive":
+        sampler = get_adaptive_solver(odesolver, model.ode, model, Y, **sampler_kwargs)
+    else:
+        raise ValueError(f"{odesolver_type} is not a valid sampler type!")
+    sample, nfe = sampler()
+    nfe = nfe.tolist() if torch.is_tensor(nfe) else [nfe] * Y.size(0)
+    return sample, nfe
+
+
+def enhance_batch(model, ys, odesolver_type="white", odesolver="euler", pad=False, **sampler_kwargs):
+    """
+    Enhance several noisy utterances with a single batched sampler run.
+
+    All utterances must pad to the same number of frames (see `bucket_by_frames`), so that every
+    solver step is one `VFModel.forward` call for the whole batch.
+
+    Args:
+        model: A `VFModel` in eval mode.
+        ys: A list of noisy waveforms of shape (1, T_orig).
+        odesolver_type: 'white', 'black' or 'adaptive'.
+        odesolver: The name of the white-box or adaptive ODE solver.
+        pad: Zero-pad the spectrograms to the longest utterance instead of requiring the same number of frames.
+            The network sees the padding, so the results differ slightly from enhancing the utterances alone.
+        sampler_kwargs: Passed on to `get_white_box_solver` / `get_black_box_solver` / `get_adaptive_solver`.
+
+    Returns:
+        A list of enhanced waveforms of shape (1, T_orig), in the order of `ys`, and a list of the number of
+        function evaluations of the sampler for each utterance.
+    """
+    Y, lengths, norm_factors = prepare_batch(model, ys, pad)
+    sample, nfe = _sample(model, Y, odesolver_type, odesolver, **sampler_kwargs)
+    return batch_to_audio(model, sample, lengths, norm_factors), nfe
+
+
+def prepare_batch(model, ys, pad=False):
+    """
+    The sampler input of `enhance_batch`: the transformed noisy spectrograms of `ys` as one batch Y on the device of
+    the model, the lengths of the utterances and their normalization factors. Pass the latter two and the result of
+    sampling from Y to `batch_to_audio`. Y can be reused for several sampler runs.
+    """
+    device = model.device
+    lengths = [y.size(-1) for y in ys]
+    norm_factors = [y.abs().max() for y in ys]
+
+    Ys = []
+    for y, norm_factor in zip(ys, norm_factors):
+        Y = torch.unsqueeze(model._forward_transform(model._stft((y / norm_factor).to(device))), 0)
+        Ys.append(pad_spec(Y))
+    num_frames = {Y.size(3) for Y in Ys}
+    if pad:
+        Ys = [F.pad(Y, (0, max(num_frames) - Y.size(3))) for Y in Ys]
+    elif len(num_frames) != 1:
+        raise ValueError(f"Utterances of one batch must pad to the same number of frames, got {sorted(num_frames)}")
+    return torch.cat(Ys, dim=0), lengths, norm_factors
+
+
+def batch_to_audio(model, sample, lengths, norm_factors):
+    """The enhanced waveforms (1, T_orig) of a batch sampled from the output of `prepare_batch`."""
+    device = sample.device
+    # the iSTFT prefix does not depend on the requested length, so trim each item afterwards
+    x_hat = model.to_audio(sample.squeeze(1), max(lengths))
+    x_hats = [
+        x_hat[[i], :length] * norm_factor.to(device)
+        for i, (length, norm_factor) in enumerate(zip(lengths, norm_factors))
+    ]
+    return x_hats
+
+def window_starts(num_frames, window_frames, overlap_frames):
+    """Start frames of overlapping windows of `window_frames` frames covering `num_frames` frames."""
+    hop = window_frames - overlap_frames
+    num_windows = max(1, ceil((num_frames - overlap_frames) / hop))
+    return [k * hop for k in range(num_windows)]
+
+
+def crossfade_weights(window_frames, overlap_frames, first, last):
+    """Per-frame weights of one window: linear ramps over the overlaps with the previous and the next window."""
+    weights = torch.ones(window_frames)
+    if overlap_frames > 0:
+        ramp = torch.arange(1, overlap_frames + 1) / (overlap_frames + 1)
+        if not first:
+            weights[:overlap_frames] = ramp
+        if not last:
+            weights[-overlap_frames:] = ramp.flip(0)
+    return weights
+
+
+def enhance_long(model, y, window_frames=256, overlap_frames=64, batch_size=4, odesolver_type="white", odesolver="euler", **sampler_kwargs):
+    """
+    Enhance a recording of any length in overlapping windows of `window_frames` STFT frames.
+
+    The windows are enhanced in batches of `batch_size`, and the enhanced spectrograms are cross-faded over the
+    `overlap_frames` shared by neighbouring windows. The memory used by the network is therefore set by
+    `window_frames` and `batch_size` instead of the duration; only the spectrogram of the whole recording is kept.
+
+    Args:
+        model: A `VFModel` in eval mode.
+        y: The noisy waveform of shape (1, T_orig).
+        window_frames: Frames per window, a multiple of 64.
+        overlap_frames: Frames shared by neighbouring windows.
+        sampler_kwargs: As for `enhance_batch`.
+
+    Returns:
+        The enhanced waveform of shape (1, T_orig) and the mean number of function evaluations per window.
+    """
+    if window_frames % 64 != 0:
+        raise ValueError(f"window_frames must be a multiple of 64, got {window_frames}")
+    if not 0 <= overlap_frames < window_frames:
+        raise ValueError("Need 0 <= overlap_frames < window_frames")
+    device = model.device
+    length = y.size(-1)
+    norm_factor = y.abs().max()
+
+    Y = model._forward_transform(model._stft((y / norm_factor).to(device)))
+    num_frames = Y.size(-1)
+    starts = window_starts(num_frames, window_frames, overlap_frames)
+    # zero-pad the end so that the last window is complete
+    Y = F.pad(Y, (0, starts[-1] + window_frames - num_frames))
+
+    X = torch.zeros_like(Y)
+    weight_sum = torch.zeros(Y.size(-1), device=device)
+    nfes = []
+    for batch_start in range(0, len(starts), batch_size):
+        batch = starts[batch_start:batch_start+batch_size]
+        Y_batch = torch.stack([Y[:, :, start:start+window_frames] for start in batch])
+        sample, nfe = _sample(model, Y_batch, odesolver_type, odesolver, **sampler_kwargs)
+        nfes += nfe
+        sample = model._backward_transform(sample.squeeze(1))
+        for i, start in enumerate(batch):
+            weights = crossfade_weights(window_frames, overlap_frames, start == 0, start == starts[-1]).to(device)
+            X[:, :, start:start+window_frames] += sample[i] * weights
+            weight_sum[start:start+window_frames] += weights
+
+    X = X[:, :, :num_frames] / weight_sum[:num_frames]
+    x_hat = model._istft(X, length) * norm_factor.to(device)
+    return x_hat, sum(nfes) / len(nfes)
+
+
+def eval_indices(num_files, num_eval_files):
+    """Indices of `num_eval_files` files spread uniformly over `num_files` files."""
+    return torch.linspace(0, num_files-1, num_eval_files, dtype=torch.int).tolist()
+
+
+def utterance_metrics(x, x_hat):
+    """PESQ, SI-SDR and ESTOI of one enhanced utterance (numpy arrays)."""
+    # the metrics are only needed for evaluation, keep them out of the import of this module
+    from pesq import pesq
+    from pystoi import stoi
+    return pesq(sr, x, x_hat, 'wb'), si_sdr(x, x_hat), stoi(x, x_hat, sr, extended=True)
+
+
+def file_metrics(filename, clean_file, x_hat, y, nfe, sr=16000):
+    """The metrics of one enhanced test file as a row of the results of `evaluate.py`. Picklable, so it can run in
+    metric processes."""
+    from torchaudio import load
+    x, _ = load(clean_file)
+    return signal_metrics(filename, x.squeeze().numpy(), x_hat, y, nfe, sr)
+
+
+def signal_metrics(filename, x, x_hat, y, nfe, sr=16000):
+    """`file_metrics` with the clean signal `x` instead of its file."""
+    from pesq import pesq
+    from pystoi import stoi
+    n = y - x
     try:
-        if model.inference_N:
-            inference_N = model.inference_N
+        p = pesq(sr, x, x_hat, 'wb')
     except:
-        inference_N = N
-    _pesq = 0
-    _si_sdr = 0
-    _estoi = 0
-    # iterate over files
-    for (clean_file, noisy_file) in zip(clean_files, noisy_files):
-        # Load wavs
-        x, _ = load(clean_file)
-        y, _ = load(noisy_file) 
-        T_orig = x.size(1)   
-
-        # Normalize per utterance
-        norm_factor = y.abs().max()
-        y = y / norm_factor
-
-        # Prepare DNN input
-        Y = torch.unsqueeze(model._forward_transform(model._stft(y.cuda())), 0)
-        Y = pad_spec(Y)
-
-        y = y * norm_factor
-
-
-        # Reverse sampling
-        sampler = get_white_box_solver("euler", model.ode, model, Y.cuda(), T_rev=T_rev, t_eps=t_eps, N=inference_N)
-        
-            
-        sample, _ = sampler()
-
-        sample = sample.squeeze()
-
-   
-        x_hat = model.to_audio(sample.squeeze(), T_orig)
-        x_hat = x_hat * norm_factor
-
-        x_hat = x_hat.squeeze().cpu().numpy()
-        x = x.squeeze().cpu().numpy()
-        y = y.squeeze().cpu().numpy()
-
-        _si_sdr += si_sdr(x, x_hat)
-       
-        _pesq += pesq(sr, x, x_hat, 'wb') 
-        _estoi += stoi(x, x_hat, sr, extended=True)
-        
-    return _pesq/num_eval_files, _si_sdr/num_eval_files, _estoi/num_eval_files
+        p = float("nan")
+    si_sdr, si_sir, si_sar = energy_ratios(x_hat, x, n)
+    return {"filename": filename, "pesq": p, "estoi": stoi(x, x_hat, sr, extended=True), "si_sdr": si_sdr, "si_sir": si_sir, "si_sar": si_sar, "nfe": nfe}
+
+
+class ValidationEvaluator:
+    """
+    PESQ, SI-SDR and ESTOI of enhanced validation files during training, see `VFModel.validation_step`.
+
+    The `num_eval_files` files, spread uniformly over the validation set, are loaded once and kept in memory; in a
+    DDP run every rank only loads and enhances its share (`rank`::`world_size`) of them. `start` enhances the
+    files in padded batches of `batch_size`, sorted by length so that little is padded, and hands the metrics to a
+    pool of `num_workers` processes, which compute them while validation goes on. `finish` waits for them and
+    returns their sums on this rank, to be summed over the ranks. With `num_workers=0` the metrics are computed
+    in `start`.
+    """
+
+    def __init__(self, clean_files, noisy_files, num_eval_files, batch_size=8, num_workers=4, rank=0, world_size=1):
+        from torchaudio import load
+
+        indices = eval_indices(len(clean_files), num_eval_files)[rank::world_size]
+        self.xs = [load(clean_files[i])[0].squeeze().numpy() for i in indices]
+        self.ys = [load(noisy_files[i])[0] for i in indices]
+        order = sorted(range(len(self.ys)), key=lambda i: self.ys[i].size(-1))
+        self.batches = [order[start:start+batch_size] for start in range(0, len(order), batch_size)]
+        self.num_workers = num_workers
+        self.pool = None
+        self.pending = []
+
+    def start(self, model, inference_N=None, odesolver="euler"):
+        """
+        Enhance the files with `inference_N` steps of `odesolver` and start computing their metrics. By default
+        `inference_N` is `model.inference_N` if the model has it, and `N` otherwise.
+        """
+        if inference_N is None:
+            inference_N = getattr(model, "inference_N", None) or N
+        if self.num_workers > 0 and self.pool is None:
+            # spawned workers, forking a process that uses CUDA and data loader threads is not safe
+            self.pool = ProcessPoolExecutor(self.num_workers, mp_context=multiprocessing.get_context("spawn"))
+        model.ode.T_rev = model.T_rev
+        self.pending = []
+        for batch in self.batches:
+            x_hats, _ = enhance_batch(
+                model, [self.ys[i] for i in batch], odesolver=odesolver, pad=True, T_rev=model.T_rev,
+                t_eps=model.t_eps, N=inference_N
+            )
+            for i, x_hat in zip(batch, x_hats):
+                x_hat = x_hat.squeeze().cpu().numpy()
+                if self.pool is None:
+                    self.pending.append(utterance_metrics(self.xs[i], x_hat))
+                else:
+                    self.pending.append(self.pool.submit(utterance_metrics, self.xs[i], x_hat))
+
+    def finish(self):
+        """The sums of PESQ, SI-SDR and ESTOI over the files of this rank and the number of files."""
+        metrics = [m.result() if isinstance(m, Future) else m for m in self.pending]
+        self.pending = []
+        sums = [sum(values) for values in zip(*metrics)] or [0., 0., 0.]
+        return (*sums, len(metrics))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
 
+def evaluate_model(model, num_eval_files, inference_N=None):
+    """Mean PESQ, SI-SDR and ESTOI of `num_eval_files` validation files, computed in this process."""
+    valid_set = model.data_module.valid_set
+    evaluator = ValidationEvaluator(valid_set.clean_files, valid_set.noisy_files, num_eval_files, num_workers=0)
+    evaluator.start(model, inference_N)
+    pesq, si_sdr, estoi, count = evaluator.finish()
+    return pesq/count, si_sdr/count, estoi/count
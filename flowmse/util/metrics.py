@@ -0,0 +1,90 @@
+"""
+SI-SDR, SI-SIR, SI-SAR and SNR for batches of signals, in torch.
+
+These are the metrics of `flowmse.util.other` (`si_sdr_components`, `energy_ratios`, `si_sdr`, `snr_dB`) for
+zero-padded batches of shape (B, T) with the length of each signal, computed on the device that holds the signals.
+Samples beyond the length of a signal are ignored, whatever their value. The results are (B,) tensors in the dtype
+of the inputs; pass float64 signals for the precision of the numpy versions.
+
+The gain over the numpy versions is on the device that holds the enhanced audio, typically a GPU, where they save
+the copy to the host and the loop over the files. On the CPU the numpy versions are as fast or faster, since these
+functions are bound by allocating their (B, k, T) temporaries. `python benchmark.py metrics` checks that the results
+equal those of the numpy versions and measures both.
+
+The signals of a batch are stacked into one (B, k, T) tensor, whose Gram matrix gives all inner products with one
+batched matrix multiplication. The residuals whose energy is needed are formed explicitly instead of being derived
+from the inner products, which would lose precision for good estimates in float32.
+"""
+import torch
+
+
+def _stack(lengths, *signals):
+    """The signals stacked to (B, k, T), with the samples beyond `lengths` set to zero."""
+    X = torch.stack(signals, 1)
+    if lengths is not None:
+        lengths = torch.as_tensor(lengths, device=X.device)
+        X.masked_fill_((torch.arange(X.shape[-1], device=X.device) >= lengths[:, None])[:, None], 0)
+    return X
+
+
+def _gram(X):
+    return X @ X.transpose(1, 2)
+
+
+def _energy(x):
+    return torch.linalg.vector_norm(x, dim=-1).square()
+
+
+def batch_si_sdr_components(s_hat, s, n, lengths=None):
+    """`si_sdr_components` of each signal in the batch. Returns s_target, e_noise and e_art, each (B, T)."""
+    X = _stack(lengths, s_hat, s, n)
+    G = _gram(X)
+    s_target = (G[:, 0, 1] / G[:, 1, 1])[:, None] * X[:, 1]
+    e_noise = (G[:, 0, 2] / G[:, 2, 2])[:, None] * X[:, 2]
+    e_art = X[:, 0] - s_target - e_noise
+    return s_target, e_noise, e_art
+
+
+def batch_energy_ratios(s_hat, s, n, lengths=None):
+    """
+    `energy_ratios` of each signal in the batch, all from one decomposition into the SI-SDR components.
+
+    Args:
+        s_hat: Estimated signals (B, T).
+        s: Reference signals (B, T).
+        n: Noise signals (B, T), e.g. noisy minus reference.
+        lengths: Length of each signal (B,), all T if None.
+
+    Returns:
+        SI-SDR, SI-SIR and SI-SAR in dB, each (B,).
+    """
+    X = _stack(lengths, s_hat, s, n)
+    G = _gram(X)
+    alpha_s = G[:, 0, 1] / G[:, 1, 1]
+    alpha_n = G[:, 0, 2] / G[:, 2, 2]
+    target = alpha_s.square() * G[:, 1, 1]
+    noise = alpha_n.square() * G[:, 2, 2]
+    # e_noise + e_art = s_hat - s_target, and e_art
+    residual = torch.addcmul(X[:, 0], alpha_s[:, None], X[:, 1], value=-1)
+    distortion = _energy(residual)
+    artifacts = _energy(residual.addcmul_(alpha_n[:, None], X[:, 2], value=-1))
+    si_sdr = 10 * torch.log10(target / distortion)
+    si_sir = 10 * torch.log10(target / noise)
+    si_sar = 10 * torch.log10(target / artifacts)
+    return si_sdr, si_sir, si_sar
+
+
+def batch_si_sdr(s, s_hat, lengths=None):
+    """`si_sdr` of each signal in the batch (B,), with the reference first like `si_sdr`."""
+    X = _stack(lengths, s_hat, s)
+    G = _gram(X)
+    alpha = G[:, 0, 1] / G[:, 1, 1]
+    error = torch.addcmul(X[:, 0], alpha[:, None], X[:, 1], value=-1)
+    return 10 * torch.log10(alpha.square() * G[:, 1, 1] / _energy(error))
+
+
+def batch_snr_dB(s, n, lengths=None):
+    """`snr_dB` of each signal in the batch (B,). The powers are averaged over the length of each signal, so the
+    ratio is that of the energies."""
+    energies = _energy(_stack(lengths, s, n))
+    return 10 * torch.log10(energies[:, 0] / energies[:, 1])
@@ -2,13 +2,9 @@ import os
 
 import numpy as np
 
-import scipy.stats
-from scipy.signal import butter, sosfilt
 
 import torch
 
-from pesq import pesq
-from pystoi import stoi
 
 
 def si_sdr_components(s_hat, s, n):
@@ -39,6 +35,7 @@ def energy_ratios(s_hat, s, n):
     return si_sdr, si_sir, si_sar
 
 def mean_conf_int(data, confidence=0.95):
+    import scipy.stats
     a = 1.0 * np.array(data)
     n = len(a)
     m, se = np.mean(a), scipy.stats.sem(a)
@@ -63,6 +60,7 @@ class Method():
         return mean_conf_int(np.array(self.metrics[metric]))
 
 def hp_filter(signal, cut_off=80, order=10, sr=16000):
+    from scipy.signal import butter, sosfilt
     factor = cut_off /sr * 2
     sos = butter(order, factor, 'hp', output='sos')
     filtered = sosfilt(sos, signal)
@@ -97,6 +95,8 @@ def ensure_dir(file_path):
 
 
 def print_metrics(x, y, x_hat_list, labels, sr=16000):
+    from pesq import pesq
+    from pystoi import stoi
     _si_sdr_mix = si_sdr(x, y)
     _pesq_mix = pesq(sr, x, y, 'wb')
     _estoi_mix = stoi(x, y, sr, extended=True)
@@ -0,0 +1,31 @@
+"""
+Mixed precision (bfloat16/float16) for the backbones.
+
+`VFModel` and `Enhancer` run their backbone under `autocast` when their `autocast` attribute is 'bfloat16' or
+'float16'. Only the network is autocast: its complex output is returned as complex64, so the ODE, the samplers, the
+loss, the STFT/iSTFT and the spectrogram transformations stay in full precision. The time embeddings of the
+backbones are computed in float32 in any case.
+"""
+import contextlib
+
+import torch
+
+
+AUTOCAST_DTYPES = {"bfloat16": torch.bfloat16, "float16": torch.float16}
+
+
+def autocast(device, dtype=None):
+    """
+    `torch.autocast` on the type of `device` in `dtype` ('bfloat16' or 'float16'), or a context that does nothing if
+    `dtype` is None.
+    """
+    if dtype is None:
+        return contextlib.nullcontext()
+    if dtype not in AUTOCAST_DTYPES:
+        raise ValueError(f"Cannot autocast to '{dtype}', choose one of {', '.join(AUTOCAST_DTYPES)}")
+    return torch.autocast(torch.device(device).type, dtype=AUTOCAST_DTYPES[dtype])
+
+
+def full_precision(device):
+    """Turn autocast off on the type of `device`, for computations that need float32."""
+    return torch.autocast(torch.device(device).type, enabled=False)
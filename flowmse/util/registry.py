@@ -1,3 +1,4 @@
+import importlib
 import warnings
 from typing import Callable
 
@@ -13,6 +14,7 @@ class Registry:
         """
         self.managed_thing = managed_thing
         self._registry = {}
+        self._lazy = {}
 
     def register(self, name: str) -> Callable:
         def inner_wrapper(wrapped_class) -> Callable:
@@ -22,8 +24,17 @@ class Registry:
             return wrapped_class
         return inner_wrapper
 
+    def register_lazy(self, name: str, module: str):
+        """
+        Announce that the module `module` registers a thing with name `name`. The module is only imported by the
+        first `get_by_name(name)`, so that unused things do not slow down the import of the registry's package.
+        """
+        self._lazy[name] = module
+
     def get_by_name(self, name: str):
         """Get a managed thing by name."""
+        if name not in self._registry and name in self._lazy:
+            importlib.import_module(self._lazy[name])
         if name in self._registry:
             return self._registry[name]
         else:
@@ -31,4 +42,4 @@ class Registry:
 
     def get_all_names(self):
         """Get the list of things' names registered to this registry."""
-        return list(self._registry.keys())
+        return list(self._registry.keys()) + [name for name in self._lazy if name not in self._registry]
@@ -0,0 +1,147 @@
+import torch
+
+from ..sampling import get_white_box_solver
+
+
+class StreamingEnhancer:
+    """
+    Chunk-wise enhancement of a live signal with a `VFModel`.
+
+    Incoming samples are turned into STFT frames as soon as a full window is available and kept in a ring buffer
+    of `context_frames` frames. Whenever `hop_frames + lookahead_frames` frames have arrived since the last
+    run, the sampler enhances the whole context window, and the `hop_frames` frames before the lookahead are
+    synthesized by overlap-add. The remaining frames of the window are look-back context only.
+
+    The knobs trade latency and compute for quality:
+        hop_frames: Frames emitted per model run. Larger values mean fewer runs (lower real-time factor) but a
+            higher latency.
+        lookahead_frames: Frames after the emitted ones that the model sees. They improve the newest frames at
+            the cost of latency.
+        context_frames: Size of the enhanced window, a multiple of 64. More look-back frames give more context
+            at a higher cost per run.
+        N: Number of sampler steps per run.
+
+    Every run enhances a window of the same shape, so passing `cuda_graphs=CUDAGraphCache()` (see
+    `flowmse.sampling`) replays each run from a single CUDA graph on the GPU.
+
+    Since the utterance is not known in advance, the signal is normalized by its running peak.
+
+    Example:
+        enhancer = StreamingEnhancer(model)
+        for chunk in chunks:
+            out = enhancer.process(chunk)
+        out = enhancer.flush()
+    """
+
+    def __init__(
+        self, model, context_frames=64, hop_frames=16, lookahead_frames=0, odesolver="euler", N=5,
+        stepsize_type="gerkmann", **sampler_kwargs
+    ):
+        if context_frames % 64 != 0:
+            raise ValueError(f"context_frames must be a multiple of 64, got {context_frames}")
+        if hop_frames < 1 or hop_frames + lookahead_frames > context_frames:
+            raise ValueError("Need 1 <= hop_frames and hop_frames + lookahead_frames <= context_frames")
+        self.model = model
+        self.context_frames = context_frames
+        self.hop_frames = hop_frames
+        self.lookahead_frames = lookahead_frames
+        self.sampler_kwargs = dict(
+            odesolver_name=odesolver, T_rev=model.T_rev, t_eps=model.t_eps, N=N, stepsize_type=stepsize_type,
+            **sampler_kwargs
+        )
+
+        data_module = model.data_module
+        self.n_fft = data_module.n_fft
+        self.hop_length = data_module.hop_length
+        self.window = data_module.window.to(model.device)
+        self.reset()
+
+    @property
+    def latency(self):
+        """Worst-case algorithmic latency in samples, i.e. without the computation time."""
+        # the first sample of a run's first frame waits for the last frame of the run (and its lookahead) to be complete
+        return (self.hop_frames + self.lookahead_frames - 1) * self.hop_length + self.n_fft - 1
+
+    def reset(self):
+        """Start a new stream."""
+        device = self.model.device
+        # n_fft // 2 leading zeros align the frames with the STFT used in training (center=True)
+        self.samples = torch.zeros(self.n_fft // 2, device=device)
+        self.frames = torch.zeros(self.n_fft // 2 + 1, self.context_frames, dtype=torch.complex64, device=device)
+        self.write_pos = 0
+        self.num_frames = 0
+        self.num_emitted = 0
+        self.ola = torch.zeros(self.n_fft, device=device)
+        self.envelope = torch.zeros(self.n_fft, device=device)
+        self.to_skip = self.n_fft // 2
+        self.num_in = 0
+        self.num_out = 0
+        self.norm_factor = 0.
+
+    def process(self, chunk):
+        """
+        Feed a chunk of samples (1D tensor) and return the enhanced samples that are ready, possibly none.
+        Over the whole stream, output sample i corresponds to input sample i.
+        """
+        with torch.no_grad():
+            chunk = chunk.reshape(-1).to(self.model.device)
+            self.num_in += chunk.numel()
+            if chunk.numel() > 0:
+                self.norm_factor = max(self.norm_factor, chunk.abs().max().item())
+            self.samples = torch.cat([self.samples, chunk])
+            num_new = (self.samples.numel() - self.n_fft) // self.hop_length + 1 if self.samples.numel() >= self.n_fft else 0
+            if num_new <= 0:
+                return self._take_output([])
+            new_frames = torch.stft(
+                self.samples[:(num_new - 1) * self.hop_length + self.n_fft], n_fft=self.n_fft, hop_length=self.hop_length,
+                window=self.window, center=False, return_complex=True
+            )
+            self.samples = self.samples[num_new * self.hop_length:]
+
+            out = []
+            for k in range(num_new):
+                self._push(new_frames[:, k])
+                if self.num_frames - self.num_emitted == self.hop_frames + self.lookahead_frames:
+                    out.append(self._run())
+            return self._take_output(out)
+
+    def flush(self):
+        """Feed silence until all samples of the stream have been emitted and return them. Resets the enhancer."""
+        pending = self.num_in - self.num_out
+        out = self.process(torch.zeros(self.latency + self.hop_frames * self.hop_length))[:pending]
+        self.reset()
+        return out
+
+    def _push(self, frame):
+        self.frames[:, self.write_pos] = frame
+        self.write_pos = (self.write_pos + 1) % self.context_frames
+        self.num_frames += 1
+
+    def _run(self):
+        # the ring buffer in chronological order
+        Y = torch.cat([self.frames[:, self.write_pos:], self.frames[:, :self.write_pos]], dim=1)
+        norm_factor = self.norm_factor if self.norm_factor > 0 else 1.
+        Y = self.model._forward_transform(Y[None, None] / norm_factor)
+        sampler = get_white_box_solver(ode=self.model.ode, VF_fn=self.model, Y=Y, **self.sampler_kwargs)
+        sample, _ = sampler()
+        X = self.model._backward_transform(sample[0, 0]) * norm_factor
+
+        end = self.context_frames - self.lookahead_frames
+        frames = torch.fft.irfft(X[:, end - self.hop_frames:end], n=self.n_fft, dim=0) * self.window[:, None]
+        out = []
+        for k in range(self.hop_frames):
+            self.ola += frames[:, k]
+            self.envelope += self.window**2
+            out.append(self.ola[:self.hop_length] / self.envelope[:self.hop_length].clamp(min=1e-11))
+            self.ola = torch.cat([self.ola[self.hop_length:], self.ola.new_zeros(self.hop_length)])
+            self.envelope = torch.cat([self.envelope[self.hop_length:], self.envelope.new_zeros(self.hop_length)])
+        self.num_emitted += self.hop_frames
+        return torch.cat(out)
+
+    def _take_output(self, out):
+        out = torch.cat(out) if out else torch.zeros(0, device=self.model.device)
+        skip = min(self.to_skip, out.numel())
+        self.to_skip -= skip
+        out = out[skip:]
+        self.num_out += out.numel()
+        return out
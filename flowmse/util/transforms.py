@@ -0,0 +1,125 @@
+from typing import Optional
+
+import torch
+
+
+def get_window(window_type, window_length):
+    if window_type == 'sqrthann':
+        return torch.sqrt(torch.hann_window(window_length, periodic=True))
+    elif window_type == 'hann':
+        return torch.hann_window(window_length, periodic=True)
+    else:
+        raise NotImplementedError(f"Window type {window_type} not implemented!")
+
+
+def _scale_spec(spec: torch.Tensor, scale: torch.Tensor, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+    if out is None:
+        return spec * scale
+    return torch.mul(spec, scale, out=out)
+
+
+def spec_fwd(spec: torch.Tensor, transform_type: str = "exponent", spec_abs_exponent: float = 0.5,
+        spec_factor: float = 0.15, out: Optional[torch.Tensor] = None, eps: float = 1e-30) -> torch.Tensor:
+    """
+    Transform a complex STFT into the network's input representation.
+
+    Computes e.g. `abs(spec)**e * exp(1j*angle(spec)) * spec_factor` as `spec * (abs(spec)**(e-1) * spec_factor)`,
+    i.e. by scaling with a real-valued magnitude factor, which needs one real temporary instead of several complex
+    ones. `out` may be `spec` itself for in-place use. Magnitudes are floored at `eps` so that negative powers
+    stay finite where spec == 0. The function can be compiled with `torch.jit.script`.
+    """
+    if transform_type == "none":
+        if out is None:
+            return spec
+        return out.copy_(spec)
+    mag = spec.abs()
+    if transform_type == "exponent":
+        if spec_abs_exponent != 1:
+            # only do this calculation if spec_exponent != 1, otherwise it's quite a bit of wasted computation
+            # and introduced numerical error
+            mag = mag.clamp_(min=eps).pow_(spec_abs_exponent - 1).mul_(spec_factor)
+        else:
+            mag = mag.fill_(spec_factor)
+    elif transform_type == "log":
+        mag = mag.clamp_(min=eps)
+        mag = torch.log1p(mag).div_(mag).mul_(spec_factor)
+    else:
+        raise ValueError(f"Spectrogram transformation {transform_type} unknown!")
+    return _scale_spec(spec, mag, out)
+
+
+def spec_back(spec: torch.Tensor, transform_type: str = "exponent", spec_abs_exponent: float = 0.5,
+        spec_factor: float = 0.15, out: Optional[torch.Tensor] = None, eps: float = 1e-30) -> torch.Tensor:
+    """Inverse of `spec_fwd`, computed by magnitude scaling as well."""
+    if transform_type == "none":
+        if out is None:
+            return spec
+        return out.copy_(spec)
+    mag = spec.abs().div_(spec_factor)
+    if transform_type == "exponent":
+        if spec_abs_exponent != 1:
+            mag = mag.clamp_(min=eps).pow_(1 / spec_abs_exponent - 1).div_(spec_factor)
+        else:
+            mag = mag.fill_(1 / spec_factor)
+    elif transform_type == "log":
+        mag = mag.clamp_(min=eps)
+        mag = torch.expm1(mag).div_(mag).div_(spec_factor)
+    else:
+        raise ValueError(f"Spectrogram transformation {transform_type} unknown!")
+    return _scale_spec(spec, mag, out)
+
+
+class SpecTransform:
+    """
+    The STFT and spectrogram transformation of a `SpecsDataModule`, without the datasets.
+
+    Provides the attributes and methods of the data module that inference uses (`n_fft`, `hop_length`, `window`,
+    `stft`, `istft`, `spec_fwd`, `spec_back`), so that an exported enhancer does not need PyTorch Lightning.
+    """
+
+    def __init__(
+        self, n_fft=510, hop_length=128, window='hann', spec_factor=0.15, spec_abs_exponent=0.5,
+        transform_type="exponent", normalize='noisy', **ignored_kwargs
+    ):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.window_type = window
+        self.window = get_window(window, self.n_fft)
+        self.windows = {}
+        self.spec_factor = spec_factor
+        self.spec_abs_exponent = spec_abs_exponent
+        self.transform_type = transform_type
+        self.normalize = normalize
+
+    @property
+    def spec_config(self):
+        return dict(
+            n_fft=self.n_fft, hop_length=self.hop_length, window=self.window_type,
+            spec_factor=self.spec_factor, spec_abs_exponent=self.spec_abs_exponent,
+            transform_type=self.transform_type, normalize=self.normalize
+        )
+
+    def spec_fwd(self, spec, out=None):
+        return spec_fwd(spec, self.transform_type, self.spec_abs_exponent, self.spec_factor, out=out)
+
+    def spec_back(self, spec, out=None):
+        return spec_back(spec, self.transform_type, self.spec_abs_exponent, self.spec_factor, out=out)
+
+    def _get_window(self, x):
+        window = self.windows.get(x.device, None)
+        if window is None:
+            window = self.window.to(x.device)
+            self.windows[x.device] = window
+        return window
+
+    def stft(self, sig):
+        return torch.stft(
+            sig, n_fft=self.n_fft, hop_length=self.hop_length, window=self._get_window(sig), center=True,
+            return_complex=True
+        )
+
+    def istft(self, spec, length=None):
+        return torch.istft(
+            spec, n_fft=self.n_fft, hop_length=self.hop_length, window=self._get_window(spec), center=True,
+            length=length
+        )
@@ -0,0 +1,188 @@
+import json
+import os
+from glob import glob
+from argparse import ArgumentParser
+from os.path import join
+
+import numpy as np
+import torch
+from soundfile import read
+from torchaudio import load, info
+from tqdm import tqdm
+
+from flowmse.data_module import SpecsDataModule
+from flowmse.model import VFModel
+from flowmse.sampling.schedules import fit_step_density
+from flowmse.util.inference import bucket_by_frames
+from flowmse.util.other import pad_spec
+
+
+def normalize_pair(x, y, normalize):
+    # normalize w.r.t to the noisy or the clean signal or not at all, as in `Specs`
+    if normalize == "noisy":
+        normfac = y.abs().max()
+    elif normalize == "clean":
+        normfac = x.abs().max()
+    elif normalize == "not":
+        normfac = 1.0
+    return x / normfac, y / normfac
+
+
+def build_stft_cache(data_module, subset, cache_dir):
+    """
+    Precompute the transformed spectrograms of one split of the dataset.
+
+    Writes `clean.npy` and `noisy.npy` (complex64, shape (total_frames, n_fft//2+1), utterances concatenated
+    along the frame axis) and an `index.json` holding the offset and number of frames of each utterance
+    together with the spectrogram settings. Normalization is done per full utterance, not per crop.
+    """
+    clean_files = sorted(glob(join(data_module.base_dir, subset) + '/clean/*.wav'))
+    noisy_files = sorted(glob(join(data_module.base_dir, subset) + '/noisy/*.wav'))
+    assert len(clean_files) == len(noisy_files), f"Number of clean and noisy files in {subset} differs"
+
+    out_dir = join(cache_dir, subset)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # formula applies for center=True
+    lengths = [info(f).num_frames // data_module.hop_length + 1 for f in clean_files]
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).tolist()
+    shape = (int(sum(lengths)), data_module.n_fft // 2 + 1)
+    clean = np.lib.format.open_memmap(join(out_dir, "clean.npy"), mode="w+", dtype=np.complex64, shape=shape)
+    noisy = np.lib.format.open_memmap(join(out_dir, "noisy.npy"), mode="w+", dtype=np.complex64, shape=shape)
+
+    for clean_file, noisy_file, offset, length in tqdm(zip(clean_files, noisy_files, offsets, lengths), total=len(clean_files)):
+        x, _ = load(clean_file)
+        y, _ = load(noisy_file)
+        x, y = normalize_pair(x, y, data_module.normalize)
+        X, Y = data_module.stft(x), data_module.stft(y)
+        X, Y = data_module.spec_fwd(X, out=X), data_module.spec_fwd(Y, out=Y)
+        assert X.size(-1) == length, f"Unexpected number of frames for {clean_file}"
+        clean[offset:offset+length] = X[0].T.numpy()
+        noisy[offset:offset+length] = Y[0].T.numpy()
+    clean.flush()
+    noisy.flush()
+
+    index = dict(
+        config=data_module.spec_config,
+        files=[
+            dict(clean_file=c, noisy_file=n, offset=o, num_frames=l)
+            for c, n, o, l in zip(clean_files, noisy_files, offsets, lengths)
+        ]
+    )
+    with open(join(out_dir, "index.json"), "w") as f:
+        json.dump(index, f)
+
+
+def pack_waveforms(base_dir, subset, out_dir, dtype="int16", shard_size_mb=1024):
+    """
+    Pack the clean/noisy wav files of one split into a few large shards.
+
+    Each shard `shard_XXX.npy` holds an array of shape (total_samples, 2) with the clean and the noisy
+    signal of every utterance pair interleaved, so that a crop of both is one contiguous read. `index.json`
+    stores the shard, offset and number of samples of each pair.
+    """
+    clean_files = sorted(glob(join(base_dir, subset) + '/clean/*.wav'))
+    noisy_files = sorted(glob(join(base_dir, subset) + '/noisy/*.wav'))
+    assert len(clean_files) == len(noisy_files), f"Number of clean and noisy files in {subset} differs"
+
+    out_dir = join(out_dir, subset)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # assign utterances to shards of at most shard_size_mb (or a single utterance)
+    lengths = [min(info(c).num_frames, info(n).num_frames) for c, n in zip(clean_files, noisy_files)]
+    max_shard_samples = shard_size_mb * 2**20 // (2 * np.dtype(dtype).itemsize)
+    shard_ids, offsets, shard_lengths = [], [], [0]
+    for length in lengths:
+        if shard_lengths[-1] > 0 and shard_lengths[-1] + length > max_shard_samples:
+            shard_lengths.append(0)
+        shard_ids.append(len(shard_lengths) - 1)
+        offsets.append(shard_lengths[-1])
+        shard_lengths[-1] += length
+
+    shards = [
+        np.lib.format.open_memmap(join(out_dir, f"shard_{k:03d}.npy"), mode="w+", dtype=dtype, shape=(n, 2))
+        for k, n in enumerate(shard_lengths)
+    ]
+    for clean_file, noisy_file, shard, offset, length in tqdm(zip(clean_files, noisy_files, shard_ids, offsets, lengths), total=len(clean_files)):
+        x, _ = read(clean_file, dtype=dtype)
+        y, _ = read(noisy_file, dtype=dtype)
+        shards[shard][offset:offset+length, 0] = x[:length]
+        shards[shard][offset:offset+length, 1] = y[:length]
+    for shard in shards:
+        shard.flush()
+
+    index = dict(
+        config=dict(dtype=dtype, num_shards=len(shards)),
+        files=[
+            dict(clean_file=c, noisy_file=n, shard=k, offset=o, num_samples=l)
+            for c, n, k, o, l in zip(clean_files, noisy_files, shard_ids, offsets, lengths)
+        ]
+    )
+    with open(join(out_dir, "index.json"), "w") as f:
+        json.dump(index, f)
+
+
+def fit_schedule(model, noisy_files, out_file, num_steps=200, batch_size=8):
+    """
+    Fit a data-driven timestep schedule of `model` on the calibration files `noisy_files` and write it to
+    `out_file` for the 'json' schedule (see `flowmse.sampling.schedules.fit_step_density`).
+    """
+    lengths = [info(f).num_frames for f in noisy_files]
+    density = 0.
+    for batch in tqdm(bucket_by_frames(lengths, model.data_module.hop_length, batch_size)):
+        Ys = []
+        for i in batch:
+            y, _ = load(noisy_files[i])
+            y = y / y.abs().max()
+            Ys.append(pad_spec(torch.unsqueeze(model._forward_transform(model._stft(y.to(model.device))), 0)))
+        t, batch_density = fit_step_density(model.ode, model, torch.cat(Ys), model.T_rev, model.t_eps, num_steps=num_steps)
+        density = density + np.asarray(batch_density) * len(batch)
+
+    schedule = dict(ode=model.hparams.ode, T_rev=model.T_rev, t_eps=model.t_eps, t=t, density=(density / len(noisy_files)).tolist())
+    with open(out_file, "w") as f:
+        json.dump(schedule, f)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stft_parser = subparsers.add_parser("stft", help="Precompute transformed spectrograms for `--format stft_cache`.")
+    SpecsDataModule.add_argparse_args(stft_parser)
+    stft_parser.add_argument("--cache_dir", type=str, required=True, help="Output directory, to be passed as base_dir when training.")
+    stft_parser.add_argument("--subsets", type=str, nargs="+", default=["train", "valid", "test"], help="Splits to preprocess.")
+
+    pack_parser = subparsers.add_parser("pack", help="Pack wav files into waveform shards for `--format packed`.")
+    pack_parser.add_argument("--base_dir", type=str, required=True, help="The base directory of the dataset, as for training.")
+    pack_parser.add_argument("--out_dir", type=str, required=True, help="Output directory, to be passed as base_dir when training.")
+    pack_parser.add_argument("--dtype", type=str, choices=("int16", "float32"), default="int16", help="Sample format of the shards. 'int16' by default.")
+    pack_parser.add_argument("--shard_size_mb", type=int, default=1024, help="Maximum size of one shard in MB. 1024 by default.")
+    pack_parser.add_argument("--subsets", type=str, nargs="+", default=["train", "valid", "test"], help="Splits to pack.")
+
+    schedule_parser = subparsers.add_parser("schedule", help="Fit a timestep schedule on calibration data for `--stepsize_type json`.")
+    schedule_parser.add_argument("--ckpt", type=str, required=True, help="Path to model checkpoint.")
+    schedule_parser.add_argument("--base_dir", type=str, required=True, help="The base directory of the dataset.")
+    schedule_parser.add_argument("--subset", type=str, default="valid", help="Split used for calibration. 'valid' by default.")
+    schedule_parser.add_argument("--num_files", type=int, default=50, help="Number of calibration files spread over the split. 50 by default.")
+    schedule_parser.add_argument("--num_steps", type=int, default=200, help="Number of Euler steps of the reference trajectory. 200 by default.")
+    schedule_parser.add_argument("--batch_size", type=int, default=8)
+    schedule_parser.add_argument("--out_file", type=str, required=True, help="Output JSON file.")
+
+    args = parser.parse_args()
+
+    if args.command == "stft":
+        data_module = SpecsDataModule(**{k: v for k, v in vars(args).items() if k not in ("command", "cache_dir", "subsets")})
+        for subset in args.subsets:
+            build_stft_cache(data_module, subset, args.cache_dir)
+    elif args.command == "pack":
+        for subset in args.subsets:
+            pack_waveforms(args.base_dir, subset, args.out_dir, dtype=args.dtype, shard_size_mb=args.shard_size_mb)
+    elif args.command == "schedule":
+        model = VFModel.load_from_checkpoint(args.ckpt, base_dir="", batch_size=8, num_workers=4, kwargs=dict(gpu=False))
+        model.eval(no_ema=False)
+        if torch.cuda.is_available():
+            model.cuda()
+        noisy_files = sorted(glob(join(args.base_dir, args.subset) + '/noisy/*.wav'))
+        indices = np.linspace(0, len(noisy_files) - 1, min(args.num_files, len(noisy_files))).round().astype(int)
+        torch.manual_seed(0)
+        fit_schedule(model, [noisy_files[i] for i in indices], args.out_file, num_steps=args.num_steps, batch_size=args.batch_size)
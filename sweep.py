@@ -0,0 +1,142 @@
+"""
+Evaluate a grid of sampler configurations on a test set in one process.
+
+    python sweep.py --test_dir <dir> --ckpt <model> --odesolver euler heun --N 2 5 10 --stepsize_type uniform karras
+
+The model and the test set are loaded once, and the transformed noisy spectrograms and normalization factors of
+the batches of `evaluate.py` are computed once and reused by every configuration (every combination of the given
+solvers, N, schedules and start/end points). The metrics of one configuration are computed by a process pool while
+the next configuration is sampled, or right after it is sampled with `--metric_workers 0`. The result is one table
+with the mean metrics, NFE and sampling time of every configuration.
+"""
+import glob
+import itertools
+import multiprocessing
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join
+
+import pandas as pd
+import torch
+from soundfile import info
+from torchaudio import load
+from tqdm import tqdm
+
+from flowmse.enhancer import load_enhancer
+from flowmse.sampling import ScheduleRegistry, get_white_box_solver
+from flowmse.util.inference import bucket_by_frames, prepare_batch, batch_to_audio, eval_indices, signal_metrics
+
+
+METRICS = ["pesq", "estoi", "si_sdr", "si_sir", "si_sar"]
+
+
+def load_model(file, device):
+    """A `VFModel` checkpoint in eval mode with the EMA weights, or an artifact of `flowmse.enhancer`."""
+    if file.endswith(".ckpt"):
+        from flowmse.model import VFModel
+        model = VFModel.load_from_checkpoint(file, base_dir="", batch_size=8, num_workers=4, kwargs=dict(gpu=False), map_location=device)
+        model.eval(no_ema=False)
+        return model.to(device)
+    return load_enhancer(file, device)
+
+
+def sweep_configurations(args, model):
+    """All combinations of the sampler settings given on the command line, as dicts."""
+    T_revs = args.reverse_starting_point or [model.T_rev]
+    t_epss = args.reverse_end_point or [model.t_eps]
+    return [
+        dict(odesolver=odesolver, N=N, stepsize_type=stepsize_type, T_rev=T_rev, t_eps=t_eps)
+        for odesolver, N, stepsize_type, T_rev, t_eps in itertools.product(args.odesolver, args.N, args.stepsize_type, T_revs, t_epss)
+    ]
+
+
+def run_configuration(model, batches, configuration, seed=0, **schedule_kwargs):
+    """
+    Sample every prepared batch with one configuration. Returns the enhanced signals (numpy) and NFE per file, in
+    the order of the batches, and the sampling time in seconds.
+    """
+    model.ode.T_rev = configuration["T_rev"]
+    torch.manual_seed(seed)
+    x_hats, nfes = [], []
+    start = time.time()
+    for Y, lengths, norm_factors in batches:
+        sample, nfe = get_white_box_solver(
+            configuration["odesolver"], model.ode, model, Y, N=configuration["N"], stepsize_type=configuration["stepsize_type"],
+            T_rev=configuration["T_rev"], t_eps=configuration["t_eps"], **schedule_kwargs
+        )()
+        x_hats += [x_hat.squeeze().cpu().numpy() for x_hat in batch_to_audio(model, sample, lengths, norm_factors)]
+        nfes += [nfe] * len(lengths)
+    return x_hats, nfes, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Evaluate a grid of sampler configurations, loading the model and test set once.")
+    parser.add_argument("--test_dir", type=str, required=True, help="Directory containing the test data.")
+    parser.add_argument("--ckpt", type=str, required=True, help="Path to model checkpoint, or to an inference artifact written by `python -m flowmse.enhancer`.")
+    parser.add_argument("--odesolver", type=str, nargs="+", default=["euler"], help="White-box ODE solvers.")
+    parser.add_argument("--N", type=int, nargs="+", default=[5], help="Numbers of reverse steps.")
+    parser.add_argument("--stepsize_type", type=str, nargs="+", default=["uniform"], choices=ScheduleRegistry.get_all_names(), help="Timestep schedules.")
+    parser.add_argument("--rho", type=float, default=7., help="Exponent of the 'karras' schedule. 7 by default.")
+    parser.add_argument("--schedule_file", type=str, default=None, help="JSON file of the 'json' schedule.")
+    parser.add_argument("--reverse_starting_point", type=float, nargs="+", default=None, help="Starting points of the reverse process. That of the model by default.")
+    parser.add_argument("--reverse_end_point", type=float, nargs="+", default=None, help="End points of the reverse process. That of the model by default.")
+    parser.add_argument("--num_files", type=int, default=None, help="Evaluate on this many files spread over the test set instead of all.")
+    parser.add_argument("--batch_size", type=int, default=8, help="Number of utterances enhanced together. Utterances are grouped by padded frame count.")
+    parser.add_argument("--metric_workers", type=int, default=4, help="Number of processes computing the metrics while the next configuration is sampled. 0 computes them after sampling each configuration. 4 by default.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the prior samples, the same for every configuration.")
+    parser.add_argument("--output", type=str, default="sweep.csv", help="CSV file of the results table. 'sweep.csv' by default.")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = load_model(args.ckpt, args.device)
+    configurations = sweep_configurations(args, model)
+
+    # Load the test set and prepare the sampler inputs once
+    noisy_files = sorted(glob.glob(join(args.test_dir, "test", "noisy", "*.wav")))
+    if args.num_files is not None:
+        noisy_files = [noisy_files[i] for i in eval_indices(len(noisy_files), args.num_files)]
+    filenames = [noisy_file.split('/')[-1] for noisy_file in noisy_files]
+    ys = [load(noisy_file)[0] for noisy_file in noisy_files]
+    xs = [load(join(args.test_dir, "test", "clean", filename))[0].squeeze().numpy() for filename in filenames]
+    lengths = [info(noisy_file).frames for noisy_file in noisy_files]
+    order = []
+    batches = []
+    with torch.no_grad():
+        for batch in bucket_by_frames(lengths, model.data_module.hop_length, args.batch_size):
+            order += batch
+            batches.append(prepare_batch(model, [ys[i] for i in batch]))
+
+    metric_pool = None
+    if args.metric_workers > 0:
+        metric_pool = ProcessPoolExecutor(args.metric_workers, mp_context=multiprocessing.get_context("spawn"))
+    schedule_kwargs = dict(rho=args.rho, schedule_file=args.schedule_file)
+    runs = []
+    for configuration in tqdm(configurations):
+        with torch.no_grad():
+            x_hats, nfes, sampling_time = run_configuration(model, batches, configuration, args.seed, **schedule_kwargs)
+        metric_args = [(filenames[i], xs[i], x_hat, ys[i].squeeze().numpy(), nfe) for i, x_hat, nfe in zip(order, x_hats, nfes)]
+        if metric_pool is None:
+            rows = [signal_metrics(*a) for a in metric_args]
+        else:
+            # the metrics of this configuration are computed while the next one is sampled
+            rows = [metric_pool.submit(signal_metrics, *a) for a in metric_args]
+        runs.append((configuration, rows, sampling_time))
+
+    table = []
+    for configuration, rows, sampling_time in runs:
+        results = pd.DataFrame([row if metric_pool is None else row.result() for row in rows])
+        table.append({
+            **configuration,
+            **{metric: results[metric].mean() for metric in METRICS},
+            "nfe": results["nfe"].mean(),
+            "time": sampling_time,
+            "time_per_file": sampling_time / len(results),
+        })
+    if metric_pool is not None:
+        metric_pool.shutdown()
+
+    table = pd.DataFrame(table)
+    table.to_csv(args.output, index=False)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(table.to_string(index=False, float_format="{:.3f}".format))